@@ -4,6 +4,7 @@ from pprint import pprint
 
 from bs4 import BeautifulSoup
 
+from fragmentcache import OUTCOME_IGNORED, OUTCOME_ITEM, OUTCOME_UNNAMED, fragment_key
 from items import *
 
 # Regex for data parsing. Shared across most implementations, since they imitate
@@ -18,11 +19,18 @@ equipslot_regex = re.compile(r"(Head|Neck|Shoulder|Chest|Shirt|Bracer|One-Hand|T
 quest_regex = re.compile(r"Quest Item")
 trade_goods_regex = re.compile(r"Trade Goods")
 
+# Part of every fragment cache key. Bump it whenever get_item_data or
+# parse_tooltip_field change what they extract, so cached tooltips are parsed again
+FRAGMENT_VERSION = 1
+
 class ArchiveFileParser(object):
     """
     Parses an individual HTML file, does not handle directories
     """
-    def __init__(self, soup):
+    # Name of the site in fragment cache counts
+    site = None
+
+    def __init__(self, soup, item_filter = None, fragment_cache = None, file_item_id = None):
         self.items = set() # all items in this file
 
         """
@@ -30,12 +38,91 @@ class ArchiveFileParser(object):
         """
         self.soup = soup
 
+        """
+        item_filter is an optional ItemDatabaseFilter. Items it discards are
+        dropped as soon as their name is known, before parsing the tooltip
+        """
+        self.item_filter = item_filter
+        self.discarded = 0
+
+        """
+        file_item_id is the item ID in the file name of witem pages, every
+        tooltip on them is that item. None for listing pages
+        """
+        self.file_item_id = file_item_id
+
+        # Tooltips dropped for having no recognisable name
+        self.unnamed = 0
+
+        """
+        fragment_cache is an optional fragmentcache.FragmentCache of the fields
+        extracted from tooltips seen before
+        """
+        self.fragment_cache = fragment_cache
+
         self._ignored_name_phrases = [] #["Elixir", "Potion", "Pattern", "Formula", "Recipe"]
         self._ignored_info_phrases = ["Unknown Item"] #"Slot Bag", "Ammo", "Projectile", "Quest Item", "Trade Goods"
 
     def parse(self):
         raise NotImplementedError("ArchiveDataParser must implement parse")
 
+    def is_discarded(self, name):
+        if self.item_filter is None:
+            return False
+
+        # Names are only looked up on listing pages
+        item_id = self.file_item_id
+        if item_id is None:
+            item_id = ItemNameToID(name)
+
+        if self.item_filter.discards(item_id):
+            self.discarded += 1
+            return True
+
+        return False
+
+    def extract_item(self, fragment):
+        """
+        get_item_data, through the fragment cache if there is one
+        """
+        if self.fragment_cache is None:
+            return self.get_item_data(fragment)
+
+        key = fragment_key(self.site, FRAGMENT_VERSION, fragment)
+        cached = self.fragment_cache.get(self.site, key)
+        if cached is not None:
+            outcome, itemVersion = cached
+            if outcome == OUTCOME_UNNAMED:
+                self.unnamed += 1
+                print "No name found for item"
+                return None
+
+            if itemVersion is None or self.is_discarded(itemVersion["name"]):
+                return None
+
+            return itemVersion
+
+        # Parsed without the item filter, the cached fields then hold for runs
+        # with any filter
+        unnamed = self.unnamed
+        item_filter, self.item_filter = self.item_filter, None
+        try:
+            itemVersion = self.get_item_data(fragment)
+        finally:
+            self.item_filter = item_filter
+
+        if itemVersion is not None:
+            self.fragment_cache.put(self.site, key, OUTCOME_ITEM, itemVersion)
+        elif self.unnamed > unnamed:
+            self.fragment_cache.put(self.site, key, OUTCOME_UNNAMED)
+        else:
+            self.fragment_cache.put(self.site, key, OUTCOME_IGNORED)
+
+        if itemVersion is None or self.is_discarded(itemVersion["name"]):
+            return None
+
+        return itemVersion
+
     def get_quality(self, quality_class):
         """
         Translate a quality class qualifier to real item quality value
@@ -59,11 +146,11 @@ class ArchiveFileParser(object):
         elif equipslot_regex.search(field.td.text) is not None:
             # Item type, equip slot
             tds = field.findChildren()
-            itemVersion["slot"] = tds[0].text
+            itemVersion["slot"] = STRING_POOL.intern(tds[0].text)
 
             # Profession tool, no slot definition?
             if len(tds) > 1:
-                itemVersion["itemType"] = tds[1].text
+                itemVersion["itemType"] = STRING_POOL.intern(tds[1].text)
 
         elif "Armor" in field.text:
             # Armour/damage spread
@@ -119,10 +206,10 @@ class ArchiveFileParser(object):
                     # Items with broken spell effects
                     try:
                         spellId = int(effect["href"].split("=")[1])
-                    except:
+                    except Exception:
                         spellId = -1
 
-                    tooltip = effect.text
+                    tooltip = STRING_POOL.intern(effect.text)
 
                     itemVersion["effects"].append(ItemSpell(spell_index, spellId, tooltip))
                     spell_index += 1
@@ -131,13 +218,16 @@ class ArchiveFileParser(object):
                 if len(spell_effects) == 0:
                     if "Equip:" in field.td.text:
                         # equip effect with unknown spell ID. add it. happens with early snapshots from thott
-                        itemVersion["effects"].append(ItemSpell(len(itemVersion["effects"])+1, -1, field.td.text))
+                        itemVersion["effects"].append(ItemSpell(len(itemVersion["effects"])+1, -1,
+                            STRING_POOL.intern(field.td.text)))
                     else:
-                        itemVersion["flavour"] = field.td.text
+                        itemVersion["flavour"] = STRING_POOL.intern(field.td.text)
 
 class AllakhazamFileParser(ArchiveFileParser):
-    def __init__(self, soup):
-        super(AllakhazamFileParser, self).__init__(soup)
+    site = "allakhazam"
+
+    def __init__(self, soup, item_filter = None, fragment_cache = None, file_item_id = None):
+        super(AllakhazamFileParser, self).__init__(soup, item_filter, fragment_cache, file_item_id)
 
         self._quality = {
             "greyname": 0,
@@ -164,7 +254,7 @@ class AllakhazamFileParser(ArchiveFileParser):
         for item_div in item_displays:
             #pprint(item_div)
 
-            itemv = self.get_item_data(item_div)
+            itemv = self.extract_item(item_div)
 
             if itemv is not None:
                 self.items.add(itemv)
@@ -190,7 +280,7 @@ class AllakhazamFileParser(ArchiveFileParser):
         for sclass in name_span_classes:
             name = item_div.find("span", attrs = {"class": sclass})
             if name is not None:
-                itemVersion["name"] = ItemRandomSuffixStrip(name.text)
+                itemVersion["name"] = STRING_POOL.intern(ItemRandomSuffixStrip(name.text))
                 itemVersion["quality"] = sclass
                 break
 
@@ -198,11 +288,12 @@ class AllakhazamFileParser(ArchiveFileParser):
             for fcolour in self._font_quality:
                 name = item_div.find("font", attrs = {"color": fcolour})
                 if name is not None:
-                    itemVersion["name"] = ItemRandomSuffixStrip(name.text)
+                    itemVersion["name"] = STRING_POOL.intern(ItemRandomSuffixStrip(name.text))
                     itemVersion["quality"] = fcolour
                     break
 
         if itemVersion["name"] is None:
+            self.unnamed += 1
             print "No name found for item"
             print item_div
             return None
@@ -211,6 +302,9 @@ class AllakhazamFileParser(ArchiveFileParser):
             if phrase in itemVersion["name"]:
                 return None
 
+        if self.is_discarded(itemVersion["name"]):
+            return None
+
         # Snapshots 2005-2006 have a table, after that the table is gone. Some items
         # don't have snapshots within this range but are still meant to be in the
         # game (never reported by users or not scraped? dunno)
@@ -228,8 +322,10 @@ class AllakhazamFileParser(ArchiveFileParser):
         #pprint(item_div.table) 
 
 class ThottbotFileParser(ArchiveFileParser):
-    def __init__(self, soup):
-        super(ThottbotFileParser, self).__init__(soup)
+    site = "thottbot"
+
+    def __init__(self, soup, item_filter = None, fragment_cache = None, file_item_id = None):
+        super(ThottbotFileParser, self).__init__(soup, item_filter, fragment_cache, file_item_id)
 
         self.script_tooltip_pattern = re.compile(r'"<table class=ttb', re.MULTILINE | re.DOTALL)
 
@@ -267,7 +363,7 @@ class ThottbotFileParser(ArchiveFileParser):
         for display in item_displays:
             #print "Parsing display"
             #pprint(display)
-            itemv = self.get_item_data(display)
+            itemv = self.extract_item(display)
 
             if itemv is not None:
                 self.items.add(itemv)
@@ -289,11 +385,12 @@ class ThottbotFileParser(ArchiveFileParser):
         for sclass in name_span_classes:
             name = display.find("span", attrs = {"class": sclass})
             if name is not None:
-                itemVersion["name"] = ItemRandomSuffixStrip(name.text)
+                itemVersion["name"] = STRING_POOL.intern(ItemRandomSuffixStrip(name.text))
                 itemVersion["quality"] = sclass
                 break
 
         if itemVersion["name"] is None:
+            self.unnamed += 1
             print "No name found for item"
             print display
             return None
@@ -302,6 +399,9 @@ class ThottbotFileParser(ArchiveFileParser):
             if phrase in itemVersion["name"]:
                 return None
 
+        if self.is_discarded(itemVersion["name"]):
+            return None
+
         for child in display.children:
             self.parse_tooltip_field(itemVersion, child)
 
@@ -0,0 +1,221 @@
+"""
+benchhistory.py
+
+Results of benchmark.py runs kept in a local JSON lines file, one run per line,
+and the comparison of a new run against the runs before it:
+
+    python benchmark.py core --runs 3 --record --compare
+
+Each run records the machine (host, CPU model and count, Python), the commit
+with a flag for uncommitted changes, the benchmark parameters and every
+metric. Only earlier runs on the same machine with the same parameters make up
+the baseline of a metric: the median of its last values. The noise is the
+standard error of the difference between that median and the median of the
+new run's repeats, from the larger median absolute deviation of the two. A
+metric regresses or improves when it moves by more than the larger of
+min_change and noise_factor times the noise, so noisy metrics need a larger
+move to be flagged and more runs narrow the threshold.
+
+Metrics are judged by their unit. Times and sizes, (s) (ms) (us) (h) (KB)
+and (MB), are better lower and rates, (.../s) and speedups, are better higher.
+Percentages are better higher when they measure a gain, reductions, savings
+and hit rates, and better lower when they measure an error. Other metrics
+that are whole numbers, counts and match flags, are reported whenever they
+differ from the baseline, and the rest when they move past the threshold
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import time
+
+from collections import OrderedDict
+
+# Scales a median absolute deviation to the standard deviation of normal noise
+MAD_SCALE = 1.4826
+
+# Standard error of a median of n values is about this times sigma / sqrt(n)
+MEDIAN_ERROR_SCALE = 1.2533
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def median_deviation(values):
+    """
+    Scaled median absolute deviation, 0 for fewer than two values
+    """
+    if len(values) < 2:
+        return 0.0
+
+    center = median(values)
+    return MAD_SCALE * median([abs(value - center) for value in values])
+
+def percentile(values, q):
+    """
+    Nearest rank q-th percentile, q from 0 to 100
+    """
+    values = sorted(values)
+    rank = int(round(q / 100.0 * (len(values) - 1)))
+
+    return values[rank]
+
+# Units of metrics that are better lower
+LOWER_BETTER_UNITS = ["(s)", "(ms)", "(us)", "(h)", "(ms per file)", "(KB)", "(MB)"]
+
+# Words of percentages that are better higher, or lower
+HIGHER_BETTER_PERCENTAGES = ["reduction", "saved", "hit rate", "resolution rate"]
+LOWER_BETTER_PERCENTAGES = ["error"]
+
+def metric_direction(name):
+    """
+    -1 if lower is better, 1 if higher is better, 0 if the metric is not a
+    measure of speed, size or a gain
+    """
+    if name.endswith("/s)") or name.endswith("per second") or name.endswith("speedup"):
+        return 1
+    if any(name.endswith(unit) for unit in LOWER_BETTER_UNITS):
+        return -1
+
+    if name.endswith("(%)"):
+        if any(word in name for word in LOWER_BETTER_PERCENTAGES):
+            return -1
+        if any(word in name for word in HIGHER_BETTER_PERCENTAGES):
+            return 1
+
+    return 0
+
+def machine_info():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except IOError:
+        pass
+
+    return {
+        "host": socket.gethostname(),
+        "cpu": cpu,
+        "cpus": multiprocessing.cpu_count(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+def commit_info(directory = None):
+    """
+    {"commit": hash, "dirty": bool} of the checkout, None values outside git
+    """
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "wb") as devnull:
+            commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = directory,
+                stderr = devnull).strip()
+            status = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd = directory, stderr = devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+    return {"commit": commit, "dirty": bool(status.strip())}
+
+def new_run(params, results, samples):
+    """
+    A history record. results is {benchmark: {metric: value}}, samples the
+    values of every repeat the results were taken from
+    """
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": machine_info(),
+        "git": commit_info(),
+        "params": params,
+        "results": results,
+        "samples": samples,
+    }
+
+class BenchmarkHistory(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+    def runs(self):
+        if not os.path.exists(self.filename):
+            return []
+
+        with open(self.filename, "rb") as f:
+            return [json.loads(line, object_pairs_hook = OrderedDict) for line in f if line.strip()]
+
+    def append(self, run):
+        with open(self.filename, "ab") as f:
+            f.write(json.dumps(run) + "\n")
+
+    def comparable(self, run):
+        """
+        Earlier runs from the same machine with the same parameters, oldest first
+        """
+        return [previous for previous in self.runs()
+            if previous["machine"] == run["machine"] and previous["params"] == run["params"]]
+
+def compare_runs(run, previous, baseline_runs = 5, min_change = 0.05, noise_factor = 3.0):
+    """
+    [(benchmark, metric, baseline, current, change, threshold, verdict)] for
+    every metric of run. change and threshold are relative to the baseline,
+    verdict is "regression", "improvement", "same", "changed" or "new".
+    Whole number metrics without a direction are compared exactly
+    """
+    rows = []
+    for benchmark, metrics in run["results"].iteritems():
+        for metric, current in metrics.iteritems():
+            values = [earlier["results"][benchmark][metric] for earlier in previous
+                if metric in earlier["results"].get(benchmark, {})][-baseline_runs:]
+            if not values:
+                rows.append((benchmark, metric, None, current, None, None, "new"))
+                continue
+
+            baseline = median(values)
+            direction = metric_direction(metric)
+            if direction == 0 and all(float(value).is_integer() for value in values + [current]):
+                verdict = "same" if current == baseline else "changed"
+                rows.append((benchmark, metric, baseline, current, None, None, verdict))
+                continue
+
+            repeats = run["samples"][benchmark][metric]
+            sigma = max(median_deviation(values), median_deviation(repeats))
+            noise = MEDIAN_ERROR_SCALE * sigma * math.sqrt(1.0 / len(values) + 1.0 / len(repeats))
+            scale = abs(baseline) or 1.0
+            change = (current - baseline) / scale
+            threshold = max(min_change, noise_factor * noise / scale)
+
+            if abs(change) <= threshold:
+                verdict = "same"
+            elif direction == 0:
+                verdict = "changed"
+            elif change * direction > 0:
+                verdict = "improvement"
+            else:
+                verdict = "regression"
+
+            rows.append((benchmark, metric, baseline, current, change, threshold, verdict))
+
+    return rows
+
+def format_comparison(rows):
+    lines = ["%-12s %-48s %12s %12s %9s %9s  %s" % ("benchmark", "metric", "baseline", "current", "change",
+        "threshold", "verdict")]
+
+    for benchmark, metric, baseline, current, change, threshold, verdict in rows:
+        lines.append("%-12s %-48s %12s %12.3f %9s %9s  %s" % (benchmark, metric,
+            "-" if baseline is None else "%.3f" % (baseline,), current,
+            "-" if change is None else "%+.1f%%" % (change * 100.0,),
+            "-" if threshold is None else "%.1f%%" % (threshold * 100.0,),
+            verdict.upper() if verdict == "regression" else verdict))
+
+    return lines
@@ -0,0 +1,1656 @@
+"""
+benchmark.py
+
+Offline benchmarks over generated fixtures, so they can be run without a
+waybackdump or parsed.json. Run a single benchmark with
+
+    python benchmark.py index --items 15000
+
+Every benchmark runs in a forked child and reports its peak RSS. With --record
+the results go into a local history, and --compare checks them against the
+earlier runs there (see benchhistory.py):
+
+    python benchmark.py core --runs 3 --record --compare --fail-on-regression
+
+Only timings and sizes are reported here, the results of the paths compared
+are checked by the tests in tests/:
+
+    python -m pytest tests
+"""
+
+import argparse
+import cPickle
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+
+from build_patch_difference import ItemPatchData, build_patch_views, build_sql_migration
+from benchhistory import BenchmarkHistory, compare_runs, format_comparison, median, new_run, percentile
+from catalog import SnapshotCatalog
+from fragmentcache import FragmentCache
+from governor import MemoryGovernor, format_bytes, tree_memory
+from compare_parsed import compare_fingerprint_trees
+from serializers import SERIALIZERS
+from sampling import SAMPLE_METRICS, draw_sample, parse_sample, stratified_total, stratify
+from distributed import ParseCoordinator, iter_work_units, serve
+from items import *
+from itemindex import ItemHistoryIndex
+from parser import *
+from service import UnixHTTPConnection
+from shardstore import ShardedItemStore
+from spellindex import SpellIndex
+from sqlitestore import SqliteItemDatabase
+
+PATCH_LEVELS = [102, 103, 105, 106, 107, 108, 109, 110, 111, 112]
+
+SLOTS = ["Head", "Neck", "Shoulder", "Chest", "Waist", "Legs", "Hands", "Ring",
+    "Trinket", "One-Hand", "Two-Hand", "Main Hand", "Off Hand"]
+ITEM_TYPES = ["Cloth", "Leather", "Mail", "Plate", "Sword", "Axe", "Mace", "Staff",
+    "Polearm", "Dagger"]
+
+def synthetic_store(num_items = 15000, seed = 1):
+    """
+    Build an ItemStore shaped like real parse output: a few patches per item with
+    a handful of (mostly identical) versions scraped from different snapshots
+    """
+    rnd = random.Random(seed)
+
+    item_ids = sorted(DB_ITEM_DATA.keys())
+    if len(item_ids) < num_items:
+        item_ids += range(100000, 100000 + num_items - len(item_ids))
+    item_ids = rnd.sample(item_ids, num_items)
+
+    tooltips = ["Equip: Increases your chance to hit by %d%%." % i for i in range(1, 4)]
+    tooltips += ["Use: Restores %d health over 30 sec." % (i * 100,) for i in range(1, 6)]
+    flavours = ["\"It's a trap!\"", "\"Property of the Defias Brotherhood\"", None]
+
+    store = ItemStore()
+    for item_id in item_ids:
+        base = ItemVersion.new()
+        base["name"] = ID_TO_NAME_HASH.get(item_id, "Synthetic Item %d" % (item_id,))
+        base["quality"] = rnd.randint(0, 5)
+        base["slot"] = rnd.choice(SLOTS)
+        base["itemType"] = rnd.choice(ITEM_TYPES)
+        base["bonding"] = rnd.choice(BIND_TYPES.values())
+        base["requiredlevel"] = rnd.randint(0, 60)
+        base["armor"] = rnd.randint(0, 600)
+        base["flavour"] = rnd.choice(flavours)
+        base["quest"] = rnd.random() < 0.05
+        base["trade_good"] = rnd.random() < 0.05
+
+        if base["slot"] in ("One-Hand", "Two-Hand", "Main Hand"):
+            base["mindamage"] = rnd.randint(5, 100)
+            base["maxdamage"] = base["mindamage"] + rnd.randint(5, 100)
+            base["speed"] = rnd.randint(1, 3)
+
+        for stat in ("stamina", "strength", "agility"):
+            if rnd.random() < 0.3:
+                base[stat] = rnd.randint(1, 20)
+
+        for spell_index in range(rnd.randint(0, 2)):
+            base["effects"].append(ItemSpell(spell_index + 1, rnd.randint(7000, 25000),
+                rnd.choice(tooltips)))
+
+        patches = sorted(rnd.sample(PATCH_LEVELS, rnd.randint(1, 4)))
+        for patch in patches:
+            # Small balance changes between patches
+            if rnd.random() < 0.3:
+                base = ItemVersion(base)
+                base["effects"] = list(base["effects"])
+                base["resistances"] = dict(base["resistances"])
+                base["speed"] = rnd.randint(1, 3)
+                base["stamina"] += rnd.randint(-2, 2)
+
+            for snapshot in range(rnd.randint(1, 3)):
+                itemv = ItemVersion(base)
+                itemv["conflicts"] = []
+                store.add_item(item_id, patch, itemv)
+
+    return store
+
+ALLAKHAZAM_PAGE = """<html><body>
+<div class="wowitem"><span class="%(quality)s">%(name)s</span><table><tr><td>Binds when equipped</td></tr><tr><td>%(slot)s</td><td>%(itemType)s</td></tr><tr><td>%(mindamage)d - %(maxdamage)d Damage</td><td>Speed %(speed)d.00</td></tr><tr><td>+%(stamina)d Stamina</td></tr><tr><td>Requires Level %(requiredlevel)d</td></tr><tr><td><a class="itemeffectlink" href="spell.html?wspell=%(spellId)d">Equip: Improves your chance to hit by 1%%.</a></td></tr></table></div>
+</body></html>
+"""
+
+THOTTBOT_PAGE = """<html><body>
+<table class="ttb"><tr><td><span class="quality-%(qualityId)d">%(name)s</span></td></tr><tr><td>Binds when picked up</td></tr><tr><td>%(slot)s</td><td>%(itemType)s</td></tr><tr><td>%(armor)d Armor</td></tr><tr><td>+%(stamina)d Stamina</td></tr><tr><td>Requires Level %(requiredlevel)d</td></tr></table>
+</body></html>
+"""
+
+ALLAKHAZAM_QUALITY = ["greyname", "whitename", "greenname", "bluename", "purplename", "orangename"]
+
+SNAPSHOTS = ["20050201000000", "20050401000000", "20050601000000", "20050801000000",
+    "20051001000000", "20051201000000", "20060201000000", "20060501000000",
+    "20060701000000", "20060901000000"]
+
+def synthetic_dump(root, snapshots = 4, depth = 3, files_per_dir = 10, seed = 1, skew = None):
+    """
+    Write a waybackdump shaped tree of item pages under root. Each snapshot gets
+    an Allakhazam and a Thottbot directory nested depth levels deep, with
+    files_per_dir pages at each level. skew(index) optionally scales the number
+    of files per snapshot to build uneven trees. Returns the number of files
+    """
+    rnd = random.Random(seed)
+    item_ids = sorted(i for i in DB_ITEM_DATA if "Monster -" not in ID_TO_NAME_HASH[i])
+    written = 0
+
+    for snap_index in range(snapshots):
+        snapshot = SNAPSHOTS[snap_index % len(SNAPSHOTS)][:-4] + "%04d" % (snap_index,)
+        count = files_per_dir if skew is None else max(1, int(files_per_dir * skew(snap_index)))
+
+        for site in ("wow.allakhazam.com", "thottbot.com"):
+            directory = os.path.join(root, snapshot, site)
+            for level in range(depth):
+                directory = os.path.join(directory, "db" if level == 0 else "d%d" % (level,))
+                os.makedirs(directory)
+
+                for i in range(count):
+                    item_id = rnd.choice(item_ids)
+                    values = {
+                        "name": ID_TO_NAME_HASH[item_id].decode("utf-8", "replace").encode("ascii", "xmlcharrefreplace"),
+                        "qualityId": rnd.randint(1, 4),
+                        "slot": rnd.choice(SLOTS),
+                        "itemType": rnd.choice(ITEM_TYPES),
+                        "mindamage": rnd.randint(5, 50),
+                        "maxdamage": rnd.randint(50, 150),
+                        "speed": rnd.randint(1, 3),
+                        "armor": rnd.randint(10, 500),
+                        "stamina": rnd.randint(1, 20),
+                        "requiredlevel": rnd.randint(1, 60),
+                        "spellId": rnd.randint(7000, 25000),
+                    }
+                    values["quality"] = ALLAKHAZAM_QUALITY[values["qualityId"]]
+
+                    if site == "wow.allakhazam.com":
+                        filename = "witem=%d-item.html" % (item_id,)
+                        content = ALLAKHAZAM_PAGE % values
+                    else:
+                        filename = "i=%d-index.html" % (item_id,)
+                        content = THOTTBOT_PAGE % values
+
+                    with open(os.path.join(directory, filename), "wb") as f:
+                        f.write(content)
+                    written += 1
+
+    return written
+
+def legacy_parse_directory(directory, patchLevel, parser):
+    # The recursive listdir/isdir walk with a store per level merged upwards,
+    # kept here to compare against
+    tmp = ItemStore()
+    for item_snapshot in os.listdir(directory):
+        file_path = os.path.join(directory, item_snapshot)
+        if os.path.isdir(file_path):
+            legacy_parse_directory(file_path, patchLevel, parser).merge_into(tmp)
+            continue
+
+        for item_id, patch, item in parse_file(file_path, patchLevel, parser):
+            tmp.add_item(item_id, patch, item)
+
+    return tmp
+
+def legacy_iter_work_items(dump_dir):
+    for snapshot in os.listdir(dump_dir):
+        snapshot_dir = os.path.join(dump_dir, snapshot)
+        for db in WOW_DB_DIRS:
+            item_dir = os.path.join(snapshot_dir, db)
+            if os.path.exists(item_dir) and os.path.isdir(item_dir):
+                yield item_dir, getPatchLevel(snapshot), WOW_DB_DIRS[db]["parser"]
+
+def quietly(func):
+    """
+    Run func with stdout sent to /dev/null, the parsers print every file
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        return func()
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(devnull)
+        os.close(saved)
+
+def timed(func, repeat = 1):
+    """
+    Run func repeat times, returning the last result and the best wall time
+    """
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return result, best
+
+def current_rss():
+    """
+    Resident set size of this process in bytes
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def run_isolated(func):
+    """
+    Run func in a forked child so memory measurements start from the same state
+    and nothing it allocates stays behind in this process
+    """
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return into the caller's code
+        try:
+            os.close(read_fd)
+            with os.fdopen(write_fd, "wb") as f:
+                cPickle.dump(func(), f, cPickle.HIGHEST_PROTOCOL)
+        except:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+        try:
+            result = cPickle.load(f)
+        except EOFError:
+            result = None
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("Isolated benchmark run failed")
+
+    return result
+
+def run_measured(func):
+    """
+    func's results in a forked child, with the peak RSS of the child added
+    """
+    def measured():
+        results = func()
+        results["peak RSS (MB)"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        return results
+
+    return run_isolated(measured)
+
+def bench_index(args):
+    store, build_store_time = timed(lambda: synthetic_store(args.items, args.seed))
+    index, build_time = timed(lambda: ItemHistoryIndex(store))
+
+    queries = OrderedDict([
+        ("two-hand lvl 50-60", lambda: index.query(slot = "Two-Hand", requiredlevel = (50, 60))),
+        ("epic plate", lambda: index.query(quality = 4, itemType = "Plate")),
+        ("bop rings in 1.8", lambda: index.query(slot = "Ring", patch = 108,
+            bonding = BIND_TYPES["BIND_WHEN_PICKED_UP"])),
+        ("spell 7500-7600 users", lambda: index.query(spellId = set(range(7500, 7600)))),
+        ("two-hand speed changed 1.6-1.8", lambda: index.changed("speed", 106, 108,
+            index.query(slot = "Two-Hand", requiredlevel = (50, 60)))),
+        ("speed changed 1.6-1.8, all items", lambda: index.changed("speed", 106, 108)),
+    ])
+
+    results = OrderedDict()
+    results["store build (s)"] = build_store_time
+    results["index build (s)"] = build_time
+
+    for name in queries:
+        matches, elapsed = timed(queries[name], repeat = args.repeat)
+        results["query %s (ms)" % (name,)] = elapsed * 1000.0
+        results["query %s (matches)" % (name,)] = len(matches)
+
+    return results
+
+def bench_sqlite(args):
+    store = synthetic_store(args.items, args.seed)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        json_file = os.path.join(workdir, "parsed.json")
+        sqlite_file = os.path.join(workdir, "parsed.sqlite")
+        db = SqliteItemDatabase(sqlite_file)
+
+        results = OrderedDict()
+        results["json write (s)"] = timed(lambda: dump_parsed_json(store, json_file))[1]
+        results["sqlite write (s)"] = timed(lambda: db.write_store(store))[1]
+        results["json size (MB)"] = os.path.getsize(json_file) / 1048576.0
+        results["sqlite size (MB)"] = os.path.getsize(sqlite_file) / 1048576.0
+
+        results["json full read (s)"] = timed(lambda: load_parsed_json(json_file))[1]
+        results["sqlite full read (s)"] = timed(lambda: db.load_store())[1]
+
+        # What build_patch_difference needs for one patch
+        results["sqlite patch 1.6 inputs (s)"] = timed(lambda: db.load_patch_inputs(106))[1]
+        item_ids = sorted(store.keys())[:20]
+        results["sqlite 20 items (ms)"] = timed(lambda: db.load_items(item_ids), repeat = args.repeat)[1] * 1000.0
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_intern(args):
+    store = synthetic_store(args.items, args.seed)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        json_file = os.path.join(workdir, "parsed.json")
+        dump_parsed_json(store, json_file)
+        del store
+
+        def load(intern_strings):
+            STRING_POOL.clear()
+            before = current_rss()
+            start = time.time()
+            loaded = load_parsed_json(json_file, intern_strings = intern_strings)
+            return current_rss() - before, time.time() - start, len(STRING_POOL)
+
+        plain_rss, plain_time, _ = run_isolated(lambda: load(False))
+        pooled_rss, pooled_time, pool_size = run_isolated(lambda: load(True))
+    finally:
+        shutil.rmtree(workdir)
+
+    results = OrderedDict()
+    results["plain load RSS (MB)"] = plain_rss / 1048576.0
+    results["interned load RSS (MB)"] = pooled_rss / 1048576.0
+    results["RSS reduction (%)"] = 100.0 * (plain_rss - pooled_rss) / max(plain_rss, 1)
+    results["plain load (s)"] = plain_time
+    results["interned load (s)"] = pooled_time
+    results["pooled strings"] = pool_size
+
+    return results
+
+def bench_walk(args):
+    workdir = tempfile.mkdtemp()
+
+    try:
+        num_files = synthetic_dump(workdir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+
+        def legacy_walk():
+            def walk(directory):
+                total = 0
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    total += walk(path) if os.path.isdir(path) else 1
+                return total
+            return walk(workdir)
+
+        def legacy_parse():
+            items = ItemStore()
+            for item_dir, patchLevel, parser in legacy_iter_work_items(workdir):
+                legacy_parse_directory(item_dir, patchLevel, parser).merge_into(items)
+            return items
+
+        results = OrderedDict()
+        results["files"] = num_files
+        results["legacy walk only (ms)"] = timed(legacy_walk, repeat = args.repeat)[1] * 1000.0
+        results["scandir walk only (ms)"] = timed(lambda: sum(1 for w in iter_work_items(workdir)),
+            repeat = args.repeat)[1] * 1000.0
+
+        legacy_time = quietly(lambda: timed(legacy_parse))[1]
+        store, single_time = quietly(lambda: timed(lambda: parse_work_items(iter_work_items(workdir))))
+        parallel_time = quietly(lambda: timed(lambda: parse_work_items(iter_work_items(workdir),
+            processes = args.processes)))[1]
+
+        results["legacy recursive parse (s)"] = legacy_time
+        results["streaming parse (s)"] = single_time
+        results["streaming parse, %d processes (s)" % (args.processes,)] = parallel_time
+        results["items parsed"] = len(store)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_filter(args):
+    workdir = tempfile.mkdtemp()
+
+    try:
+        dump_dir = os.path.join(workdir, "waybackdump")
+        synthetic_dump(dump_dir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+
+        stats = {}
+        def filtered_parse():
+            stats.clear()
+            return parse_work_items(iter_work_items(dump_dir), item_filter = ItemDatabaseFilter(), stats = stats)
+
+        # Best of two, so both sides run with a warm page cache
+        full_store, full_time = quietly(lambda: timed(lambda: parse_work_items(iter_work_items(dump_dir)),
+            repeat = 2))
+        filtered_store, filtered_time = quietly(lambda: timed(filtered_parse, repeat = 2))
+
+        full_file = os.path.join(workdir, "full.json")
+        filtered_file = os.path.join(workdir, "filtered.json")
+        dump_parsed_json(full_store, full_file)
+        dump_parsed_json(filtered_store, filtered_file)
+
+        results = OrderedDict()
+        results["keep-all parse (s)"] = full_time
+        results["filtered parse (s)"] = filtered_time
+        results["parse time reduction (%)"] = 100.0 * (full_time - filtered_time) / full_time
+        results["files skipped"] = stats.get("skipped_files", 0)
+        results["keep-all output (KB)"] = os.path.getsize(full_file) / 1024.0
+        results["filtered output (KB)"] = os.path.getsize(filtered_file) / 1024.0
+        results["output size reduction (%)"] = 100.0 * (1 - float(os.path.getsize(filtered_file)) /
+            os.path.getsize(full_file))
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_targeted(args):
+    # Imported here, the downloader needs waybackpack
+    import download
+
+    class StubDump(download.WaybackDump):
+        # Records requests instead of asking the archive
+        def __init__(self, base_url, download_dir, parsed):
+            super(StubDump, self).__init__(base_url, download_dir)
+            self.requests = []
+            self._parsed_ids = parsed
+
+        def buildAndRetrievePack(self, suffix):
+            self.requests.append(suffix)
+
+    # Pretend half the database has been parsed already
+    rnd = random.Random(args.seed)
+    parsed = set(i for i in DB_ITEM_DATA if rnd.random() < 0.5)
+    latency = args.request_latency
+
+    results = OrderedDict()
+    for task_class in (download.AllakhazamItemTask, download.AllakhazamItemEntryTask,
+            download.AllakhazamItemPriceTask, download.ThottbotItemEntryTask):
+        name = task_class.__name__
+        low, high = task_class.id_range
+        known = sorted(i for i in DB_ITEM_DATA if low <= i < high)
+        unparsed = set(i for i in known if i not in parsed)
+
+        blind = StubDump("http://stub/", os.devnull, parsed)
+        task_class(blind, targeted = False).acquire_packs()
+
+        targeted = StubDump("http://stub/", os.devnull, parsed)
+        task_class(targeted).acquire_packs()
+
+        # Requests issued until every unparsed known ID has been asked for
+        def coverage(requests):
+            remaining = set(unparsed)
+            for count, suffix in enumerate(requests, 1):
+                remaining.discard(int(re.search(r"(\d+)$", suffix).group(1)))
+                if not remaining:
+                    return count
+            return len(requests)
+
+        results["%s blind requests" % (name,)] = len(blind.requests)
+        results["%s targeted requests" % (name,)] = len(targeted.requests)
+        results["%s requests saved (%%)" % (name,)] = 100.0 * (1 - float(len(targeted.requests)) / len(blind.requests))
+        results["%s blind time to coverage (h)" % (name,)] = coverage(blind.requests) * latency / 3600.0
+        results["%s targeted time to coverage (h)" % (name,)] = coverage(targeted.requests) * latency / 3600.0
+
+    return results
+
+def bench_compress(args):
+    import download
+
+    workdir = tempfile.mkdtemp()
+
+    try:
+        plain_dir = os.path.join(workdir, "plain")
+        os.mkdir(plain_dir)
+        synthetic_dump(plain_dir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+
+        compressions = ["gzip"]
+        if download.zstandard is not None:
+            compressions.append("zstd")
+
+        # Same tree, every page rewritten the way download.py --compress does
+        dirs = OrderedDict([("plain", plain_dir)])
+        for compression in compressions:
+            target = os.path.join(workdir, compression)
+            for path in iter_directory_files(plain_dir):
+                dest = os.path.join(target, os.path.relpath(path, plain_dir))
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+
+                with open(path, "rb") as src:
+                    with download.open_compressed(dest, compression) as f:
+                        f.write(src.read())
+            dirs[compression] = target
+
+        results = OrderedDict()
+        plain_size = None
+        for name, directory in dirs.iteritems():
+            size = sum(os.path.getsize(path) for path in iter_directory_files(directory))
+            if plain_size is None:
+                plain_size = size
+
+            parse_time = quietly(lambda: timed(lambda: parse_work_items(iter_work_items(directory)),
+                repeat = 2))[1]
+
+            results["%s size (MB)" % (name,)] = size / 1048576.0
+            results["%s disk saved (%%)" % (name,)] = 100.0 * (1 - float(size) / plain_size)
+            results["%s parse (s)" % (name,)] = parse_time
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_shard(args):
+    # Versions arrive in random item order, as they do when parsing snapshot by snapshot
+    store = synthetic_store(args.items, args.seed)
+    versions = [(item_id, patch, itemv) for item_id in store for patch in store[item_id]
+        for itemv in store[item_id][patch]]
+    random.Random(args.seed).shuffle(versions)
+    num_items = len(store)
+    del store
+
+    workdir = tempfile.mkdtemp()
+
+    try:
+        stream_file = os.path.join(workdir, "versions.pickle")
+        with open(stream_file, "wb") as f:
+            for start in range(0, len(versions), 1000):
+                cPickle.dump(versions[start:start + 1000], f, cPickle.HIGHEST_PROTOCOL)
+        num_versions = len(versions)
+        del versions
+
+        def fill(store):
+            before = peak = current_rss()
+            start = time.time()
+            with open(stream_file, "rb") as f:
+                while True:
+                    try:
+                        chunk = cPickle.load(f)
+                    except EOFError:
+                        break
+                    for item_id, patch, itemv in chunk:
+                        store.add_item(item_id, patch, itemv)
+                    peak = max(peak, current_rss())
+            return store, peak - before, time.time() - start
+
+        def plain():
+            store, growth, fill_time = fill(ItemStore())
+            return growth, fill_time
+
+        def sharded():
+            # Buffered versions count against the cap too
+            with ShardedItemStore(os.path.join(workdir, "shards"), args.shard_size,
+                    args.resident_shards, max_pending = args.shard_size * args.resident_shards) as store:
+                store, growth, fill_time = fill(store)
+                return growth, fill_time, store.loads, store.spills
+
+        plain_growth, plain_time = run_isolated(plain)
+        shard_growth, shard_time, loads, spills = run_isolated(sharded)
+    finally:
+        shutil.rmtree(workdir)
+
+    results = OrderedDict()
+    results["items"] = num_items
+    results["versions"] = num_versions
+    results["resident item ID cap"] = args.shard_size * args.resident_shards
+    results["in-memory fill RSS growth (MB)"] = plain_growth / 1048576.0
+    results["sharded fill RSS growth (MB)"] = shard_growth / 1048576.0
+    results["in-memory fill (s)"] = plain_time
+    results["sharded fill (s)"] = shard_time
+    results["shard loads"] = loads
+    results["shard spills"] = spills
+
+    return results
+
+def bench_lookup(args):
+    store = synthetic_store(args.items, args.seed)
+    item_ids = sorted(store)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        json_file = os.path.join(workdir, "parsed.json")
+        dump_parsed_json(store, json_file)
+        del store
+
+        rnd = random.Random(args.seed)
+        one = set([rnd.choice(item_ids)])
+        low = item_ids[len(item_ids) // 2]
+
+        full, full_time = timed(lambda: load_parsed_json(json_file))
+        single, single_time = timed(lambda: load_parsed_items(json_file, item_ids = one), repeat = args.repeat)
+        ranged, range_time = timed(lambda: load_parsed_items(json_file, id_range = (low, low + 500)),
+            repeat = args.repeat)
+
+        results = OrderedDict()
+        results["full load (ms)"] = full_time * 1000.0
+        results["indexed single item (ms)"] = single_time * 1000.0
+        results["indexed 500 ID range (ms)"] = range_time * 1000.0
+        results["range items"] = len(ranged)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def legacy_calculate_diff(me, other):
+    # ItemVersion.calculate_diff before change masks: start from a full default
+    # version and delete what did not change
+    diff = ItemVersionDifference()
+
+    for key in me:
+        if key == "conflicts" or key == "patch":
+            continue
+
+        if isinstance(me[key], dict):
+            for subkey in me[key]:
+                diff.add_resist_diff(subkey, me, other)
+        elif key == "effects":
+            diff.add_effects_diff(key, me, other)
+        else:
+            diff.add_diff(key, me, other)
+
+    return diff
+
+def legacy_content_key(itemv):
+    # What the old json.dumps based hash was meant to compare
+    return json.dumps(itemv.hash_safe(), sort_keys = True)
+
+def legacy_patch_data(store, patch_level):
+    # Previous ItemPatchData build and filter, copying into new stores
+    item_store = ItemStore()
+    for name, item_id in sorted(NAME_TO_ID_HASH.iteritems(), key = lambda entry: entry[1]):
+        if "Monster -" in name or item_id not in store:
+            continue
+
+        prev_patch = 0
+        for patch in sorted(store[item_id].keys()):
+            if patch > patch_level:
+                break
+            if prev_patch > 0:
+                del item_store[item_id][prev_patch]
+            for itemv in store[item_id][patch]:
+                item_store.add_item(item_id, patch, itemv)
+            prev_patch = patch
+
+    marked_for_deletion = []
+    tmp = ItemStore(item_store)
+    for item_id in tmp:
+        for patch_level in tmp[item_id]:
+            for itemv in tmp[item_id][patch_level]:
+                if itemv["quest"] or itemv["trade_good"] or itemv["quality"] == 0:
+                    marked_for_deletion.append(item_id)
+                    break
+    for item_id in marked_for_deletion:
+        del tmp[item_id]
+
+    filtered_item_store = ItemStore()
+    tmp.merge_into(filtered_item_store)
+
+    return item_store, filtered_item_store
+
+def bench_conflicts(args):
+    import build_patch_difference
+
+    store = synthetic_store(args.items, args.seed)
+    rnd = random.Random(args.seed)
+
+    # Snapshots disagreeing with each other, the conflicts consensus has to settle
+    for item_id in store:
+        for patch in store[item_id]:
+            variants = []
+            for itemv in store[item_id][patch]:
+                roll = rnd.random()
+                if roll < 0.15:
+                    itemv = ItemVersion(itemv)
+                    itemv["stamina"] += 1
+                elif roll < 0.25:
+                    itemv = ItemVersion(itemv)
+                    itemv["resistances"] = dict(itemv["resistances"], fire = rnd.randint(1, 10))
+                elif roll < 0.3:
+                    itemv = ItemVersion(itemv)
+                    itemv["flavour"] = "\"Snapshot %d\"" % (rnd.randint(0, 100),)
+                variants.append(itemv)
+            store[item_id][patch] = variants
+
+    patch_data = []
+    for patch_level in (106, 107):
+        data = ItemPatchData(patch_level)
+        data.build_patch_data(store)
+        data.filter()
+        patch_data.append(data)
+    to_data, from_data = patch_data
+
+    groups = [to_data.filtered_item_store[item_id].values()[0] for item_id in to_data.filtered_item_store]
+    groups += [from_data.filtered_item_store[item_id].values()[0] for item_id in from_data.filtered_item_store]
+
+    def legacy_concensus(versions):
+        occurrences = {}
+        mapping = {}
+        for version in versions:
+            key = legacy_content_key(version)
+            mapping.setdefault(key, version)
+            occurrences[key] = occurrences.get(key, 0) + 1
+
+        concensus_key = max(occurrences.iteritems(), key = lambda entry: entry[1])[0]
+        concensus = mapping[concensus_key]
+        return concensus, [legacy_calculate_diff(concensus, mapping[key]) for key in mapping if key != concensus_key]
+
+    def masked_concensus(versions):
+        occurrences = {}
+        mapping = {}
+        for version in versions:
+            key = version.fingerprint()
+            mapping.setdefault(key, version)
+            occurrences[key] = occurrences.get(key, 0) + 1
+
+        concensus_key = max(occurrences.iteritems(), key = lambda entry: entry[1])[0]
+        concensus = mapping[concensus_key]
+        return concensus, [concensus.diff_view(mapping[key]) for key in mapping if key != concensus_key]
+
+    # Consensus versions of the items in both patches, as build_sql_migration sees them
+    pairs = []
+    for item_id in to_data.filtered_item_store:
+        if item_id in from_data.filtered_item_store:
+            pairs.append((masked_concensus(from_data.filtered_item_store[item_id].values()[0])[0],
+                masked_concensus(to_data.filtered_item_store[item_id].values()[0])[0]))
+
+    def legacy_pairs():
+        return [None if legacy_content_key(me) == legacy_content_key(other) else legacy_calculate_diff(me, other)
+            for me, other in pairs]
+
+    def masked_pairs():
+        return [None if other.matches(me) else me.diff_view(other) for me, other in pairs]
+
+    def clear_fingerprints():
+        for versions in groups:
+            for version in versions:
+                version._fingerprint = None
+
+    results = OrderedDict()
+    results["items"] = len(groups)
+    results["item pairs"] = len(pairs)
+
+    legacy_results, legacy_time = timed(lambda: [legacy_concensus(versions) for versions in groups])
+    clear_fingerprints()
+    masked_results, masked_time = timed(lambda: [masked_concensus(versions) for versions in groups])
+    results["conflict diffs"] = sum(len(conflicts) for concensus, conflicts in legacy_results)
+    results["legacy concensus + conflicts (ms)"] = legacy_time * 1000.0
+    results["masked concensus + lazy conflicts (ms)"] = masked_time * 1000.0
+    results["conflicts written by SQL (materialized)"] = sum(1 for concensus, conflicts in masked_results
+        for conflict in conflicts if conflict.changed(build_patch_difference.SQL_IGNORED_MASK))
+
+    legacy_diffs, legacy_time = timed(legacy_pairs)
+    clear_fingerprints()
+    masked_time = timed(masked_pairs)[1]
+    results["legacy equality + diff (ms)"] = legacy_time * 1000.0
+    results["fingerprint equality + diff view (ms)"] = masked_time * 1000.0
+    results["changed pairs"] = sum(1 for diff in legacy_diffs if diff is not None)
+
+    return results
+
+def bench_service(args):
+    store = synthetic_store(args.items, args.seed)
+    rnd = random.Random(args.seed)
+    item_ids = rnd.sample(sorted(item_id for item_id in store if item_id in ID_TO_NAME_HASH), 20)
+    items = ",".join(str(item_id) for item_id in item_ids)
+
+    workdir = tempfile.mkdtemp()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    socket_path = os.path.join(workdir, "items.sock")
+    devnull = open(os.devnull, "wb")
+    service = None
+
+    def request(path):
+        conn = UnixHTTPConnection(socket_path)
+        conn.request("GET", path)
+        body = conn.getresponse().read()
+        conn.close()
+        return body
+
+    try:
+        dump_parsed_json(store, os.path.join(workdir, "parsed.json"))
+        del store
+
+        # A one-off process loads the item DB and parsed.json for every question
+        start = time.time()
+        subprocess.check_output([sys.executable, os.path.join(package_dir,
+            "build_patch_difference.py"), "--items", items], cwd = workdir)
+        cold_time = time.time() - start
+
+        start = time.time()
+        service = subprocess.Popen([sys.executable, os.path.join(package_dir, "service.py"),
+            "--socket", socket_path, "--dump-dir", os.path.join(workdir, "waybackdump")],
+            cwd = workdir, stdout = devnull, stderr = devnull)
+        while not os.path.exists(socket_path):
+            if service.poll() is not None:
+                raise RuntimeError("service exited with %d" % (service.returncode,))
+            time.sleep(0.05)
+        startup_time = time.time() - start
+
+        diff_path = "/diff?items=%s&format=sql" % (items,)
+        first_time = timed(lambda: request(diff_path))[1]
+        warm_time = timed(lambda: request(diff_path), repeat = args.repeat)[1]
+        item_time = timed(lambda: request("/item/%d" % (item_ids[0],)), repeat = args.repeat)[1]
+
+        results = OrderedDict()
+        results["cold CLI diff, %d items (ms)" % (len(item_ids),)] = cold_time * 1000.0
+        results["service startup (ms)"] = startup_time * 1000.0
+        results["service first diff (ms)"] = first_time * 1000.0
+        results["service warm diff (ms)"] = warm_time * 1000.0
+        results["service item lookup (ms)"] = item_time * 1000.0
+    finally:
+        if service is not None and service.poll() is None:
+            service.terminate()
+            deadline = time.time() + 10.0
+            while service.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if service.poll() is None:
+                service.kill()
+            service.wait()
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    return results
+
+SPELL_TEMPLATES = ["Equip: Increases damage and healing done by magical spells and effects by up to %d.",
+    "Equip: +%d Attack Power.", "Equip: Improves your chance to get a critical strike by %d%%.",
+    "Equip: Restores %d mana per 5 sec.", "Equip: Increased Defense +%d.",
+    "Use: Restores %d health over 30 sec.", "Chance on hit: Deals %d Fire damage to the target.",
+    "Equip: Increases healing done by spells and effects by up to %d."]
+
+def bench_spells(args):
+    rnd = random.Random(args.seed)
+
+    # One spell per template and value, shared by the items carrying it
+    spells = []
+    for template in SPELL_TEMPLATES:
+        for value in range(1, 201):
+            spells.append((7000 + len(spells), template % (value,)))
+
+    store = ItemStore()
+    for item_id in range(args.items):
+        itemv = ItemVersion.new()
+        for index, (spell_id, tooltip) in enumerate(rnd.sample(spells, rnd.randint(1, 3))):
+            itemv["effects"].append(ItemSpell(index + 1, spell_id, tooltip))
+        store.add_item(item_id, 106, itemv)
+
+    # Effects parsed without an ID: the same text, reflowed text, the other
+    # site's wording, and spells nobody recorded an ID for
+    queries = []
+    for i in range(args.items * 20):
+        spell_id, tooltip = rnd.choice(spells)
+        roll = rnd.random()
+        if roll < 0.5:
+            pass
+        elif roll < 0.7:
+            tooltip = "  " + tooltip.upper().replace(" ", "\n ")
+        elif roll < 0.9:
+            tooltip = tooltip.replace("Increases", "Improves").replace("Restores", "Regenerates")
+        else:
+            spell_id, tooltip = -1, rnd.choice(SPELL_TEMPLATES) % (rnd.randint(300, 400),)
+        queries.append((spell_id, tooltip))
+
+    def build():
+        index = SpellIndex()
+        index.add_store(store)
+        index.build()
+        return index
+
+    index, build_time = timed(build)
+
+    start = time.time()
+    resolved = [index.resolve(tooltip) for spell_id, tooltip in queries]
+    lookup_time = time.time() - start
+
+    distinct = set(tooltip for spell_id, tooltip in queries)
+    fresh = build()
+    start = time.time()
+    for tooltip in distinct:
+        fresh.resolve(tooltip)
+    distinct_time = time.time() - start
+
+    results = OrderedDict()
+    results["indexed tooltips"] = len(index)
+    results["index build (ms)"] = build_time * 1000.0
+    results["effects without an ID"] = len(queries)
+    results["resolution rate (%)"] = 100.0 * index.resolution_rate()
+    results["near matches (%)"] = 100.0 * index.near / len(queries)
+    results["lookups per second"] = len(queries) / lookup_time
+    results["distinct tooltip lookups per second"] = len(distinct) / distinct_time
+    # Spells nobody recorded an ID for are right to come back unresolved (-1)
+    results["left unresolved, ID known"] = sum(1 for (spell_id, tooltip), found in zip(queries, resolved)
+        if found == -1 and spell_id != -1)
+    results["resolved to a different ID"] = sum(1 for (spell_id, tooltip), found in zip(queries, resolved)
+        if found != -1 and found != spell_id)
+
+    return results
+
+def bench_distributed(args):
+    workdir = tempfile.mkdtemp()
+    dump_dir = os.path.join(workdir, "waybackdump")
+    socket_path = os.path.join(workdir, "coordinator.sock")
+    devnull = open(os.devnull, "wb")
+    workers = []
+
+    def start_worker():
+        workers.append(subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            "distributed.py"), "worker", "--connect", socket_path, "--dump-dir", dump_dir, "--keep-all"],
+            stdout = devnull, stderr = devnull))
+        return workers[-1]
+
+    def wait_for_lease(coordinator, worker_id, timeout = 30.0):
+        # False when the other workers left no unit to lease, small dumps can
+        # be done before the faulty workers start
+        deadline = time.time() + timeout
+        while not any(lease[1] == worker_id for lease in coordinator.leases.values()):
+            if coordinator.finished.is_set() or not coordinator.pending:
+                return False
+            if time.time() > deadline:
+                raise RuntimeError("Worker %d got no lease in %.0f s" % (worker_id, timeout))
+            time.sleep(0.01)
+        return True
+
+    try:
+        num_files = synthetic_dump(dump_dir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+        single_time = quietly(lambda: timed(lambda: parse_work_items(iter_work_items(dump_dir))))[1]
+
+        coordinator = ParseCoordinator(list(iter_work_units(dump_dir)), lease_timeout = 2.0)
+        start = time.time()
+        server = threading.Thread(target = serve, args = (coordinator, socket_path, 3600.0))
+        server.daemon = True
+        server.start()
+
+        # Worker 1 is killed in the middle of its first unit, its lease is
+        # dropped with the connection
+        killed = start_worker()
+        if wait_for_lease(coordinator, 1):
+            time.sleep(0.2)
+        killed.kill()
+
+        # Worker 2 hangs until its lease has expired, then finishes a unit
+        # someone else may already have completed
+        hung = start_worker()
+        wait_for_lease(coordinator, 2)
+        hung.send_signal(signal.SIGSTOP)
+
+        for i in range(max(1, args.processes)):
+            start_worker()
+
+        time.sleep(coordinator.lease_timeout + 1.0)
+        hung.send_signal(signal.SIGCONT)
+
+        server.join()
+        distributed_time = time.time() - start
+
+        results = OrderedDict()
+        results["files"] = num_files
+        results["work units"] = len(coordinator.units)
+        results["single process parse (s)"] = single_time
+        results["distributed parse with faults (s)"] = distributed_time
+        results["units reissued"] = coordinator.reissued
+        results["duplicate completions dropped"] = coordinator.duplicates
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+            worker.wait()
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_fingerprint(args):
+    store = synthetic_store(args.items, args.seed)
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        old_file = os.path.join(workdir, "parsed_old.json")
+        new_file = os.path.join(workdir, "parsed.json")
+        results = OrderedDict()
+        results["json write, no fingerprints (s)"] = timed(lambda: dump_parsed_json(store, old_file,
+            write_fingerprints = False))[1]
+        results["json write with fingerprints (s)"] = timed(lambda: dump_parsed_json(store, old_file))[1]
+
+        # A parser change touching a few items
+        changed = rnd.sample(sorted(store), 10)
+        for item_id in changed:
+            patch = rnd.choice(sorted(store[item_id]))
+            itemv = ItemVersion(store[item_id][patch][0])
+            itemv["flavour"] = "\"Changed\""
+            store[item_id][patch] = [itemv]
+        del store[rnd.choice([item_id for item_id in sorted(store) if item_id not in changed])]
+        dump_parsed_json(store, new_file)
+
+        def legacy_compare():
+            old = load_parsed_json(old_file)
+            new = load_parsed_json(new_file)
+            return set(item_id for item_id in set(old) | set(new) if item_id not in old or item_id not in new
+                or item_fingerprints(old[item_id])[0] != item_fingerprints(new[item_id])[0])
+
+        def tree_compare():
+            old = FingerprintTree(parsed_fingerprint_filename(old_file))
+            new = FingerprintTree(parsed_fingerprint_filename(new_file))
+            return compare_fingerprint_trees(old, new), new.buckets_read, len(new.buckets)
+
+        legacy_time = timed(legacy_compare)[1]
+        (changes, buckets_read, buckets), tree_time = timed(tree_compare, repeat = args.repeat)
+
+        results["load and compare both files (ms)"] = legacy_time * 1000.0
+        results["fingerprint tree compare (ms)"] = tree_time * 1000.0
+        results["buckets read of %d" % (buckets,)] = buckets_read
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_sample(args):
+    workdir = tempfile.mkdtemp()
+    rnd = random.Random(args.seed)
+
+    try:
+        num_files = synthetic_dump(workdir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+
+        # Pages the parsers trip over: names missing from the item database and
+        # Allakhazam tooltips without a quality span
+        for path, patchLevel, parser, source in iter_work_items(workdir):
+            if rnd.random() < 0.1:
+                with open(path, "rb") as f:
+                    content = f.read()
+                if source[1] == "thottbot.com":
+                    content = re.sub(r'(class="quality-\d">)[^<]*', r"\1Unknown Relic", content)
+                else:
+                    content = re.sub(r'<span class="\w+name">', "<span>", content)
+                with open(path, "wb") as f:
+                    f.write(content)
+
+        # Stratified by layout as with parser.py --sample --catalog
+        catalog = SnapshotCatalog()
+        catalog.refresh(workdir)
+        layouts = catalog.unit_layouts()
+
+        def full_run():
+            strata = stratify(iter_work_items(workdir), layouts)
+            return strata, parse_sample(strata)
+
+        def sample_run():
+            strata = stratify(iter_work_items(workdir), layouts)
+            sample = draw_sample(strata, args.sample_size, args.seed)
+            return strata, parse_sample(sample)
+
+        (strata, full), full_time = quietly(lambda: timed(full_run))
+        (strata, sampled), sample_time = quietly(lambda: timed(sample_run))
+        strata_sizes = dict((stratum, len(files)) for stratum, files in strata.iteritems())
+
+        covered = 0
+        worst = 0.0
+        for metric in SAMPLE_METRICS:
+            truth = sum(stats.get(metric, 0) for results in full.itervalues() for stats in results)
+            estimate, error = stratified_total(strata_sizes, sampled, metric)
+            covered += int(abs(estimate - truth) <= error)
+            if truth:
+                worst = max(worst, abs(estimate - truth) / truth)
+
+        results = OrderedDict()
+        results["files"] = num_files
+        results["strata"] = len(strata)
+        results["sampled files"] = sum(len(stats) for stats in sampled.itervalues())
+        results["full parse (s)"] = full_time
+        results["sample parse (s)"] = sample_time
+        results["metrics with truth inside 95%% CI (of %d)" % (len(SAMPLE_METRICS),)] = covered
+        results["worst relative error (%)"] = worst * 100.0
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_serializers(args):
+    store = synthetic_store(args.items, args.seed)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        results = OrderedDict()
+
+        for name, serializer in SERIALIZERS.iteritems():
+            if not serializer.available():
+                continue
+
+            filename = os.path.join(workdir, "parsed.%s" % (name,))
+            results["%s write (s)" % (name,)] = timed(lambda: serializer.dump(store, filename))[1]
+            results["%s read (s)" % (name,)] = timed(lambda: serializer.load(filename))[1]
+            results["%s size (MB)" % (name,)] = os.path.getsize(filename) / 1048576.0
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_views(args):
+    store = synthetic_store(args.items, args.seed)
+
+    def build(views):
+        before = current_rss()
+        start = time.time()
+        if views:
+            built = build_patch_views(store, PATCH_LEVELS).values()
+            selected = [dict(data.filtered_item_store.patches) for data in built]
+        else:
+            built = [legacy_patch_data(store, patch_level) for patch_level in PATCH_LEVELS]
+            selected = [dict((item_id, filtered[item_id].keys()[0]) for item_id in filtered)
+                for item_store, filtered in built]
+        elapsed = time.time() - start
+
+        return current_rss() - before, elapsed, selected
+
+    legacy_rss, legacy_time, _ = run_isolated(lambda: build(False))
+    views_rss, views_time, views_selected = run_isolated(lambda: build(True))
+
+    results = OrderedDict()
+    results["patch levels"] = len(PATCH_LEVELS)
+    results["filtered items, all levels"] = sum(len(selected) for selected in views_selected)
+    results["store copies build (s)"] = legacy_time
+    results["views build (s)"] = views_time
+    results["store copies RSS (MB)"] = legacy_rss / 1048576.0
+    results["views RSS (MB)"] = views_rss / 1048576.0
+
+    return results
+
+# Files per directory scale of each snapshot in bench_catalog, a few large
+# snapshots in the middle of the walk order among many small ones
+CATALOG_SKEW = [0.2, 0.2, 0.4, 0.2, 4.0, 0.2, 0.6, 0.2, 2.0, 0.2]
+
+# Worker counts the bench_catalog schedules are simulated for
+CATALOG_WORKERS = [4, 8]
+
+def simulate_schedule(durations, workers):
+    """
+    (makespan, tail) of tasks handed in order to the first free of workers.
+    tail is the time between the first worker running out of work and the end
+    """
+    free = [0.0] * workers
+    for duration in durations:
+        heapq.heappush(free, heapq.heappop(free) + duration)
+
+    return max(free), max(free) - min(free)
+
+def bench_catalog(args):
+    workdir = tempfile.mkdtemp()
+    catalog_file = os.path.join(workdir, "catalog.json")
+    dump_dir = os.path.join(workdir, "waybackdump")
+
+    try:
+        num_files = synthetic_dump(dump_dir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed,
+            skew = lambda index: CATALOG_SKEW[index % len(CATALOG_SKEW)])
+
+        results = OrderedDict()
+        results["files"] = num_files
+
+        catalog = SnapshotCatalog(catalog_file)
+        results["catalog build (ms)"] = timed(lambda: catalog.refresh(dump_dir))[1] * 1000.0
+        catalog.save()
+
+        catalog = SnapshotCatalog(catalog_file)
+        results["catalog refresh, unchanged (ms)"] = timed(lambda: catalog.refresh(dump_dir))[1] * 1000.0
+        results["directories listed, unchanged"] = catalog.rescanned
+
+        work_items = list(iter_work_items(dump_dir))
+        with open(work_items[0][0], "rb") as f:
+            content = f.read()
+        with open(os.path.join(os.path.dirname(work_items[0][0]), "witem=1-item.html"), "wb") as f:
+            f.write(content)
+        recounted, refresh_time = timed(lambda: catalog.refresh(dump_dir))
+        results["catalog refresh, one page added (ms)"] = refresh_time * 1000.0
+        results["units recounted, one page added"] = recounted
+
+        # Measured parse time of every file, the schedules below are replayed
+        # with them
+        work_items = list(iter_work_items(dump_dir))
+        durations = {}
+        def parse_all():
+            for work_item in work_items:
+                start = time.time()
+                parse_file(*work_item)
+                durations[work_item[0]] = time.time() - start
+        quietly(parse_all)
+
+        unit_durations = {}
+        for path, patchLevel, parser, source in work_items:
+            unit_id = "%s/%s" % source
+            unit_durations[unit_id] = unit_durations.get(unit_id, 0.0) + durations[path]
+
+        units = list(iter_work_units(dump_dir))
+        walk_chunks = [work_items[i:i + 16] for i in range(0, len(work_items), 16)]
+
+        schedules = OrderedDict([
+            ("units, walk order", [[unit["id"]] for unit in units]),
+            ("units, largest first", [[unit["id"]] for unit in catalog.largest_units_first(units)]),
+        ])
+
+        total = sum(durations.itervalues())
+        results["serial parse (s)"] = total
+
+        for workers in CATALOG_WORKERS:
+            results["%d workers, ideal (s)" % (workers,)] = total / workers
+
+            for name, order in schedules.iteritems():
+                makespan, tail = simulate_schedule([sum(unit_durations[unit_id] for unit_id in task)
+                    for task in order], workers)
+                results["%d workers, %s makespan (s)" % (workers, name)] = makespan
+                results["%d workers, %s tail (s)" % (workers, name)] = tail
+
+            chunk_orders = OrderedDict([
+                ("16 file chunks, walk order", walk_chunks),
+                ("cost balanced chunks", catalog.cost_balanced_chunks(work_items, workers)),
+            ])
+            for name, chunks in chunk_orders.iteritems():
+                makespan, tail = simulate_schedule([sum(durations[work_item[0]] for work_item in chunk)
+                    for chunk in chunks], workers)
+                results["%d workers, %s makespan (s)" % (workers, name)] = makespan
+                results["%d workers, %s tail (s)" % (workers, name)] = tail
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def listing_dump(root, pages, items_per_page, seed = 1):
+    """
+    Thottbot listing pages of items_per_page tooltips each, the large pages
+    that blow up the memory of a parse run. Returns the number of tooltips
+    """
+    rnd = random.Random(seed)
+    names = [ID_TO_NAME_HASH[item_id] for item_id in sorted(DB_ITEM_DATA)
+        if "Monster -" not in ID_TO_NAME_HASH[item_id] and NAME_TO_ID_HASH.get(ID_TO_NAME_HASH[item_id]) == item_id]
+    tooltip = THOTTBOT_PAGE.replace("<html><body>\n", "").replace("</body></html>\n", "")
+
+    for page in range(pages):
+        snapshot = SNAPSHOTS[page % len(SNAPSHOTS)]
+        directory = os.path.join(root, snapshot, "thottbot.com", "db")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tooltips = []
+        for i in range(items_per_page):
+            tooltips.append(tooltip % {
+                "name": rnd.choice(names).decode("utf-8", "replace").encode("ascii", "xmlcharrefreplace"),
+                "qualityId": rnd.randint(1, 4),
+                "slot": rnd.choice(SLOTS),
+                "itemType": rnd.choice(ITEM_TYPES),
+                "armor": rnd.randint(10, 500),
+                "stamina": rnd.randint(1, 20),
+                "requiredlevel": rnd.randint(1, 60),
+            })
+
+        with open(os.path.join(directory, "listing-%d.html" % (page,)), "wb") as f:
+            f.write("<html><body>\n%s</body></html>\n" % ("".join(tooltips),))
+
+    return pages * items_per_page
+
+def bench_governor(args):
+    workdir = tempfile.mkdtemp()
+    dump_dir = os.path.join(workdir, "waybackdump")
+
+    try:
+        tooltips = listing_dump(dump_dir, args.listing_pages, 200, args.seed)
+
+        def parse(budget = None, processes = 1):
+            baseline = tree_memory()
+            if budget is None:
+                # Only samples, the budget is never approached
+                governor = MemoryGovernor(float("inf"), interval = 0.1)
+                store = ItemStore()
+            else:
+                governor = MemoryGovernor(baseline + budget, interval = 0.1, batch_size = 8)
+                store = ShardedItemStore(os.path.join(workdir, "shards"), args.shard_size, max_resident = 1000)
+
+            start = time.time()
+            quietly(lambda: parse_work_items(iter_work_items(dump_dir), store, processes = processes,
+                governor = governor))
+            elapsed = time.time() - start
+            governor.check(force = True)
+
+            return governor.peak - baseline, elapsed, dict(governor.actions)
+
+        results = OrderedDict()
+        results["tooltips"] = tooltips
+
+        for processes in (1, 2):
+            name = "%d process%s" % (processes, "" if processes == 1 else "es")
+            natural_peak, natural_time, actions = run_isolated(lambda: parse(None, processes))
+
+            # Every worker process costs memory no budget takes back, so the
+            # budget is a share of the natural peak with as many processes
+            budget = natural_peak * 3 // 4
+            peak, elapsed, actions = run_isolated(lambda: parse(budget, processes))
+            if peak > budget or peak > natural_peak:
+                raise RuntimeError("%s governed peak of %s is over the %s budget (natural peak %s)" % (name,
+                    format_bytes(peak), format_bytes(budget), format_bytes(natural_peak)))
+
+            results["%s, budget above baseline (MB)" % (name,)] = budget / 1048576.0
+            results["%s, natural peak above baseline (MB)" % (name,)] = natural_peak / 1048576.0
+            results["%s, governed peak above baseline (MB)" % (name,)] = peak / 1048576.0
+            results["%s, natural parse (s)" % (name,)] = natural_time
+            results["%s, governed parse (s)" % (name,)] = elapsed
+            for action in ("shrink", "flush", "pause", "resume", "recycle", "grow"):
+                results["%s, %s actions" % (name, action)] = actions.get(action, 0)
+
+        def failing_parse():
+            # A page the worker can't read, halfway through the run. The run
+            # must fail, not hang in Pool.terminate()
+            signal.alarm(60)
+            work_items = list(iter_work_items(dump_dir))
+            work_items.insert(len(work_items) // 2, (os.path.join(dump_dir, "missing.html"),) + work_items[0][1:])
+            governor = MemoryGovernor(float("inf"), interval = 0.1, batch_size = 2)
+
+            start = time.time()
+            try:
+                quietly(lambda: parse_work_items(work_items, ItemStore(), processes = 2, governor = governor))
+            except IOError:
+                return time.time() - start
+            raise RuntimeError("The worker error was not raised")
+
+        results["worker error, time to fail (s)"] = run_isolated(failing_parse)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+def bench_core(args):
+    """
+    Throughput and latency of the parser, the parsed.json loader, the patch
+    diff and the SQL emitter, the paths archiveparser.py, items.py and
+    build_patch_difference.py changes slow down
+    """
+    workdir = tempfile.mkdtemp()
+
+    try:
+        dump_dir = os.path.join(workdir, "waybackdump")
+        synthetic_dump(dump_dir, snapshots = args.snapshots, depth = args.depth,
+            files_per_dir = args.files_per_dir, seed = args.seed)
+        work_items = list(iter_work_items(dump_dir))
+
+        parse_latencies = []
+        def parse_all():
+            for work_item in work_items:
+                start = time.time()
+                parse_file(*work_item)
+                parse_latencies.append(time.time() - start)
+        quietly(parse_all)
+
+        json_file = os.path.join(workdir, "parsed.json")
+        dump_parsed_json(synthetic_store(args.items, args.seed), json_file)
+        store, load_time = timed(lambda: load_parsed_json(json_file))
+        json_size = os.path.getsize(json_file)
+
+        def diff():
+            views = build_patch_views(store, [106, 107])
+            return views[106].calculate_diff(views[107])
+        item_diff, diff_time = timed(diff)
+
+        sql_latencies = []
+        with open(os.devnull, "wb") as devnull:
+            for item_id in item_diff:
+                start = time.time()
+                build_sql_migration(devnull, {item_id: item_diff[item_id]})
+                sql_latencies.append(time.time() - start)
+    finally:
+        shutil.rmtree(workdir)
+
+    results = OrderedDict()
+    for q in (50, 95, 99):
+        results["parse latency p%d (ms)" % (q,)] = percentile(parse_latencies, q) * 1000.0
+    results["parse throughput (files/s)"] = len(parse_latencies) / sum(parse_latencies)
+    results["load (s)"] = load_time
+    results["load throughput (MB/s)"] = json_size / 1048576.0 / load_time
+    results["diff 1.7 to 1.6 (s)"] = diff_time
+    results["diff throughput (items/s)"] = len(item_diff) / diff_time
+    for q in (50, 99):
+        results["SQL emit latency p%d (us)" % (q,)] = percentile(sql_latencies, q) * 1000000.0
+    results["SQL emit throughput (items/s)"] = len(sql_latencies) / sum(sql_latencies)
+
+    return results
+
+def fragment_dump(root, snapshots, distinct, seed = 1):
+    """
+    Pages that archive the same tooltips again and again, with wayback links
+    that differ per snapshot: every snapshot has Allakhazam item pages and set
+    pages of five items, and Thottbot listings of 25 items, all drawn from
+    distinct tooltips per site. Returns the number of tooltips written
+    """
+    rnd = random.Random(seed)
+    names = [ID_TO_NAME_HASH[item_id] for item_id in sorted(DB_ITEM_DATA)
+        if "Monster -" not in ID_TO_NAME_HASH[item_id] and NAME_TO_ID_HASH.get(ID_TO_NAME_HASH[item_id]) == item_id]
+    names = rnd.sample(names, distinct)
+
+    allakhazam = ALLAKHAZAM_PAGE.replace("<html><body>\n", "").replace("</body></html>\n", "").replace(
+        'href="spell.html', 'href="/web/SNAPSHOT/http://wow.allakhazam.com/db/spell.html')
+    thottbot = THOTTBOT_PAGE.replace("<html><body>\n", "").replace("</body></html>\n", "").replace(
+        "%(name)s", '<a href="/web/SNAPSHOT/http://www.thottbot.com/?i=%(itemId)d">%(name)s</a>')
+
+    tooltips = {"wow.allakhazam.com": [], "thottbot.com": []}
+    for name in names:
+        values = {
+            "itemId": NAME_TO_ID_HASH[name],
+            "name": name.decode("utf-8", "replace").encode("ascii", "xmlcharrefreplace"),
+            "qualityId": rnd.randint(1, 4),
+            "slot": rnd.choice(SLOTS),
+            "itemType": rnd.choice(ITEM_TYPES),
+            "mindamage": rnd.randint(5, 50),
+            "maxdamage": rnd.randint(50, 150),
+            "speed": rnd.randint(1, 3),
+            "armor": rnd.randint(10, 500),
+            "stamina": rnd.randint(1, 20),
+            "requiredlevel": rnd.randint(1, 60),
+            "spellId": rnd.randint(7000, 25000),
+        }
+        values["quality"] = ALLAKHAZAM_QUALITY[values["qualityId"]]
+        tooltips["wow.allakhazam.com"].append((values["itemId"], allakhazam % values))
+        tooltips["thottbot.com"].append((values["itemId"], thottbot % values))
+
+    def write(directory, filename, fragments, snapshot):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write("<html><body>\n%s</body></html>\n" % ("".join(fragments).replace("SNAPSHOT", snapshot),))
+
+    written = 0
+    for snap_index in range(snapshots):
+        snapshot = SNAPSHOTS[snap_index % len(SNAPSHOTS)][:-4] + "%04d" % (snap_index,)
+
+        directory = os.path.join(root, snapshot, "wow.allakhazam.com", "db")
+        for item_id, fragment in rnd.sample(tooltips["wow.allakhazam.com"], distinct // 3):
+            write(directory, "witem=%d-item.html" % (item_id,), [fragment], snapshot)
+            written += 1
+        for page in range(6):
+            items = rnd.sample(tooltips["wow.allakhazam.com"], 5)
+            write(directory, "itemset-%d.html" % (page,), [fragment for item_id, fragment in items], snapshot)
+            written += len(items)
+
+        directory = os.path.join(root, snapshot, "thottbot.com", "db")
+        for page in range(4):
+            items = rnd.sample(tooltips["thottbot.com"], 25)
+            write(directory, "listing-%d.html" % (page,), [fragment for item_id, fragment in items], snapshot)
+            written += len(items)
+
+    return written
+
+def bench_fragments(args):
+    """
+    Parse time without a fragment cache, with an empty one and with the one
+    left by that run, and the hit rate per site. The last run shares an empty
+    cache between args.processes workers, at least two
+    """
+    workdir = tempfile.mkdtemp()
+    dump_dir = os.path.join(workdir, "waybackdump")
+
+    try:
+        tooltips = fragment_dump(dump_dir, args.snapshots, 100, args.seed)
+
+        def parse(cache_file = None, processes = 1):
+            cache = None
+            if cache_file is not None:
+                cache = FragmentCache(cache_file)
+                cache.reset_counts()
+
+            store = ItemStore()
+            start = time.time()
+            quietly(lambda: parse_work_items(iter_work_items(dump_dir), store, processes = processes,
+                item_filter = ItemDatabaseFilter(), fragment_cache = cache))
+            elapsed = time.time() - start
+
+            counts = {}
+            if cache is not None:
+                counts = cache.site_counts()
+                cache.close()
+
+            return elapsed, counts
+
+        results = OrderedDict()
+        results["tooltips"] = tooltips
+
+        plain_time, counts = run_isolated(parse)
+        results["no cache parse (s)"] = plain_time
+
+        cache_file = os.path.join(workdir, "fragments.sqlite")
+        processes = max(2, args.processes)
+        runs = [("cold cache", cache_file, 1), ("warm cache", cache_file, 1),
+            ("%d processes, cold cache" % (processes,), os.path.join(workdir, "shared.sqlite"), processes)]
+        for name, filename, processes in runs:
+            elapsed, counts = run_isolated(lambda: parse(filename, processes))
+            results["%s parse (s)" % (name,)] = elapsed
+            results["%s speedup" % (name,)] = plain_time / elapsed
+            for site in sorted(counts):
+                hits, misses = counts[site]
+                results["%s, %s hit rate (%%)" % (name, site)] = 100.0 * hits / max(1, hits + misses)
+
+        results["cache size (MB)"] = os.path.getsize(cache_file) / 1048576.0
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+BENCHMARKS = OrderedDict([
+    ("index", bench_index),
+    ("sqlite", bench_sqlite),
+    ("intern", bench_intern),
+    ("walk", bench_walk),
+    ("filter", bench_filter),
+    ("targeted", bench_targeted),
+    ("compress", bench_compress),
+    ("shard", bench_shard),
+    ("lookup", bench_lookup),
+    ("conflicts", bench_conflicts),
+    ("service", bench_service),
+    ("spells", bench_spells),
+    ("distributed", bench_distributed),
+    ("fingerprint", bench_fingerprint),
+    ("sample", bench_sample),
+    ("serializers", bench_serializers),
+    ("views", bench_views),
+    ("catalog", bench_catalog),
+    ("governor", bench_governor),
+    ("core", bench_core),
+    ("fragments", bench_fragments),
+])
+
+# Options of the runner itself, left out of the recorded parameters
+RUNNER_OPTIONS = ["benchmark", "runs", "record", "compare", "history", "baseline_runs", "min_change",
+    "noise_factor", "fail_on_regression"]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run offline benchmarks on generated fixtures")
+    parser.add_argument("benchmark", nargs = "*",
+        help = "Benchmarks to run, all if none given: %s" % (", ".join(BENCHMARKS),))
+    parser.add_argument("--items", type = int, default = 15000, help = "Number of synthetic items")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--repeat", type = int, default = 5, help = "Repeats for timed queries, best is kept")
+    parser.add_argument("--snapshots", type = int, default = 10, help = "Snapshots in synthetic dumps")
+    parser.add_argument("--depth", type = int, default = 4, help = "Directory depth in synthetic dumps")
+    parser.add_argument("--files-per-dir", type = int, default = 25, help = "Pages per directory in synthetic dumps")
+    parser.add_argument("--request-latency", type = float, default = 1.5,
+        help = "Seconds per archive request (CDX search and fetch) for simulated downloads")
+    parser.add_argument("--processes", type = int, default = multiprocessing.cpu_count(),
+        help = "Worker processes for parallel benchmarks")
+    parser.add_argument("--shard-size", type = int, default = 500, help = "Item IDs per shard")
+    parser.add_argument("--resident-shards", type = int, default = 2,
+        help = "Shards kept in memory, well below the synthetic dataset")
+    parser.add_argument("--listing-pages", type = int, default = 100,
+        help = "Thottbot listing pages of 200 tooltips in memory benchmarks")
+    parser.add_argument("--sample-size", type = int, default = 200, help = "Files in a sampled parse")
+    parser.add_argument("--runs", type = int, default = 1,
+        help = "Runs of each benchmark, the median of every metric is kept")
+    parser.add_argument("--record", action = "store_true", help = "Append the results to --history")
+    parser.add_argument("--compare", action = "store_true",
+        help = "Compare the results against the earlier runs in --history")
+    parser.add_argument("--history", metavar = "FILE", default = "benchmark_history.jsonl",
+        help = "Local results store, one JSON run per line")
+    parser.add_argument("--baseline-runs", type = int, default = 5,
+        help = "Earlier runs the rolling baseline is the median of")
+    parser.add_argument("--min-change", type = float, default = 0.05,
+        help = "Smallest relative change reported as a regression or improvement")
+    parser.add_argument("--noise-factor", type = float, default = 3.0,
+        help = "Changes within this many noise deviations are not reported")
+    parser.add_argument("--fail-on-regression", action = "store_true",
+        help = "Exit with status 1 if --compare finds a regression")
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %s" % (name,))
+
+    results = OrderedDict()
+    samples = OrderedDict()
+    for name in args.benchmark or BENCHMARKS.keys():
+        print "== %s" % (name,)
+        runs = [run_measured(lambda: BENCHMARKS[name](args)) for i in range(max(1, args.runs))]
+
+        results[name] = OrderedDict()
+        samples[name] = OrderedDict()
+        for key in runs[0]:
+            samples[name][key] = [run[key] for run in runs]
+            results[name][key] = median(samples[name][key])
+            print "  %-50s %12.3f" % (key, results[name][key])
+
+    if not args.record and not args.compare:
+        return
+
+    # Only options that change what is measured have to match in the baseline
+    params = dict((key, value) for key, value in vars(args).iteritems() if key not in RUNNER_OPTIONS)
+    history = BenchmarkHistory(args.history)
+    run = new_run(params, results, samples)
+
+    regressions = 0
+    if args.compare:
+        previous = history.comparable(run)
+        rows = compare_runs(run, previous, args.baseline_runs, args.min_change, args.noise_factor)
+        regressions = sum(1 for row in rows if row[-1] == "regression")
+
+        print
+        print "Against %d earlier runs on this machine (baseline of the last %d):" % (len(previous),
+            args.baseline_runs)
+        for line in format_comparison(rows):
+            print line
+
+    if args.record:
+        history.append(run)
+        print "Recorded in %s at %s%s" % (args.history, run["git"]["commit"] or "unknown commit",
+            " (uncommitted changes)" if run["git"]["dirty"] else "")
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
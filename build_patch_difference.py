@@ -1,86 +1,167 @@
+import argparse
+import bisect
 import json
+import logging
 import operator
 import re
+import sys
 
 from collections import OrderedDict
 
 from pprint import pprint
 
 from items import *
+from governor import MemoryGovernor, format_bytes
+from serializers import SERIALIZERS, load_store, serializer_for
+from spellindex import SpellIndex
+from sqlitestore import SqliteItemDatabase
 
-class ItemPatchData(object):
-    def __init__(self, patch_level):
-        self.patch_level = patch_level
+# Version predicates for ItemPatchData.filter, an item is left out if any of
+# its versions at the selected patch matches one. Any function of an
+# ItemVersion can be used alongside these
+def is_quest_version(itemv):
+    return itemv["quest"]
 
-        self.item_store = ItemStore()
-        self.not_found = []
+def is_trade_good_version(itemv):
+    return itemv["trade_good"]
 
-        self.filtered_item_store = ItemStore()
-        self.filtered_not_found = []
+def quality_below(quality):
+    return lambda itemv: itemv["quality"] < quality
 
-        self.filtered = False
+def in_slots(*slots):
+    return lambda itemv: itemv["slot"] in slots
 
-    def build_patch_data(self, data):
-        # Find the latest version of an item before or at the specified patch level
-        # That's the best we can do if there are no records for our desired patch
+# Trade goods, quest items and grey items
+DEFAULT_VERSION_PREDICATES = [is_quest_version, is_trade_good_version, quality_below(1)]
 
-        for name, item_id in NAME_TO_ID_HASH.iteritems():
-            # Skip database monster items
-            if "Monster -" in name:
-                continue
+class PatchView(object):
+    """
+    Read only {item_id: {patch: versions}} store holding a single patch per
+    item, over a base store shared with other views. Only the item ID to patch
+    mapping is kept, the version sets are the base store's own
+    """
+    def __init__(self, base, patches = None):
+        self.base = base
+        self.patches = {} if patches is None else patches
 
-            if item_id not in data:
-                self.not_found.append(item_id)
-                continue
+    def __len__(self):
+        return len(self.patches)
 
-            patches = data[item_id].keys()
-            patches.sort() # sorted lowest patch to highest
+    def __iter__(self):
+        return iter(self.patches)
 
-            done = False
-            prev_patch = 0
-            for patch in patches:
-                # beyond our desired patch, item does not exist in the
-                # patch we want or not found
-                if patch > self.patch_level:
-                    done = True
-                    break
+    def __contains__(self, item_id):
+        return item_id in self.patches
 
-                # Remove previous patch data since we have data for a more
-                # recent patch
-                if prev_patch > 0:
-                    del self.item_store[item_id][prev_patch]
+    def __getitem__(self, item_id):
+        patch = self.patches[item_id]
+        return {patch: self.base[item_id][patch]}
 
-                for itemv in data[item_id][patch]:
-                    self.item_store.add_item(item_id, patch, itemv)
+    def get(self, item_id, default = None):
+        return self[item_id] if item_id in self.patches else default
 
-                prev_patch = patch
+    def keys(self):
+        return self.patches.keys()
 
-            # Item not found in this patch, nor an earlier version from a previous
-            # patch. Must have been added later or no record
-            if prev_patch == 0 and not done:
-                self.not_found.append(item_id)
+    def versions(self, item_id):
+        """
+        (patch, versions) of an item
+        """
+        patch = self.patches[item_id]
+        return patch, self.base[item_id][patch]
 
-    def filter(self):
-        # Filter out trade goods and quest items from item store
-        marked_for_deletion = []
-        tmp = ItemStore(self.item_store)
+    def restrict(self, item_ids):
+        """
+        View of only the given items
+        """
+        return PatchView(self.base, dict((item_id, self.patches[item_id]) for item_id in item_ids
+            if item_id in self.patches))
 
-        for item_id in tmp:
-            for patch_level in tmp[item_id]:
-                for itemv in tmp[item_id][patch_level]:
-                    if itemv["quest"] or itemv["trade_good"] or itemv["quality"] == 0:
-                        marked_for_deletion.append(item_id)
-                        break
+    def exclude(self, predicates):
+        """
+        View without the items that have a version matching any of the predicates
+        """
+        patches = {}
+        for item_id, patch in self.patches.iteritems():
+            versions = self.base[item_id][patch]
+            if not any(predicate(itemv) for itemv in versions for predicate in predicates):
+                patches[item_id] = patch
+
+        return PatchView(self.base, patches)
+
+def item_patch_lists(data, item_ids = None):
+    """
+    [(item_id, sorted patches)] for the item database items, None as the
+    patches of items missing from data. Shared by the patch views of one store
+    """
+    # Items go in ID order so a sharded store loads each shard only once.
+    # item_ids restricts the patch data to a shard or a few items
+    if item_ids is None:
+        entries = NAME_TO_ID_HASH.iteritems()
+    else:
+        entries = [(ID_TO_NAME_HASH[item_id], item_id) for item_id in item_ids
+            if item_id in ID_TO_NAME_HASH and NAME_TO_ID_HASH.get(ID_TO_NAME_HASH[item_id]) == item_id]
+
+    patch_lists = []
+    for name, item_id in sorted(entries, key = operator.itemgetter(1)):
+        # Skip database monster items
+        if "Monster -" in name:
+            continue
+
+        if item_id not in data or not data[item_id]:
+            patch_lists.append((item_id, None))
+        else:
+            patch_lists.append((item_id, sorted(data[item_id])))
 
-        for item_id in marked_for_deletion:
-            del tmp[item_id]
+    return patch_lists
+
+class ItemPatchData(object):
+    def __init__(self, patch_level, concensus_cache = None):
+        self.patch_level = patch_level
 
-        tmp.merge_into(self.filtered_item_store)
+        # Optional dict of (item_id, patch) -> concensus version, shared between
+        # diffs of the same store by long running callers
+        self.concensus_cache = concensus_cache
+
+        self.item_store = PatchView(ItemStore())
+        self.not_found = []
+
+        self.filtered_item_store = PatchView(ItemStore())
+        self.filtered_not_found = []
+
+        self.filtered = False
+
+    def build_patch_data(self, data, item_ids = None, patch_lists = None):
+        # Find the latest version of an item before or at the specified patch level
+        # That's the best we can do if there are no records for our desired patch.
+        # item_store is a view over data, nothing is copied
+        if patch_lists is None:
+            patch_lists = item_patch_lists(data, item_ids)
+
+        self.item_store = PatchView(data)
+        for item_id, patches in patch_lists:
+            if patches is None:
+                self.not_found.append(item_id)
+                continue
+
+            # Items first seen after our patch were added later, they are
+            # neither in the store nor not found
+            index = bisect.bisect_right(patches, self.patch_level)
+            if index > 0:
+                self.item_store.patches[item_id] = patches[index - 1]
+
+    def filter(self, predicates = None):
+        # Filter out trade goods, quest and grey items, or whatever the
+        # predicates match, from the item store
+        if predicates is None:
+            predicates = DEFAULT_VERSION_PREDICATES
+
+        self.filtered_item_store = self.item_store.exclude(predicates)
 
         # Same with not found, ignore grey items too
+        db_filter = ItemDatabaseFilter()
         for item_id in self.not_found:
-            item = DB_ITEM_DATA[item_id]
-            if (not item["quest"] and not item["trade_good"] and item["quality"] > 0):
+            if not db_filter.discards(item_id):
                 self.filtered_not_found.append(item_id)
 
         self.filtered = True
@@ -109,23 +190,13 @@ class ItemPatchData(object):
                 "removed": False
             }
 
-            current_plevel = self.filtered_item_store[item_id].keys()[0]
-            current_versions = self.filtered_item_store[item_id][current_plevel]
-
-            concensus = self.build_item_concensus(current_versions)
-            concensus["patch"] = current_plevel
-
-            item_diff[item_id]["to"] = concensus
+            current_plevel, current_versions = self.filtered_item_store.versions(item_id)
+            item_diff[item_id]["to"] = self.item_concensus(item_id, current_plevel, current_versions)
 
             if item_id in from_data.filtered_item_store:
                 # item possibly updated
-                from_plevel = from_data.filtered_item_store[item_id].keys()[0]
-                from_versions = from_data.filtered_item_store[item_id][from_plevel]
-
-                from_concensus = self.build_item_concensus(from_versions)
-                from_concensus["patch"] = from_plevel
-
-                item_diff[item_id]["from"] = from_concensus
+                from_plevel, from_versions = from_data.filtered_item_store.versions(item_id)
+                item_diff[item_id]["from"] = self.item_concensus(item_id, from_plevel, from_versions)
 
         removed_items = self.filtered_not_found
         for item_id in from_data.filtered_item_store:
@@ -139,10 +210,21 @@ class ItemPatchData(object):
 
         return OrderedDict(sorted(item_diff.iteritems(), key = lambda i: i[0]))
 
-    def build_item_concensus(self, item_versions):
+    def item_concensus(self, item_id, patch_level, item_versions):
+        if self.concensus_cache is None:
+            return self.build_item_concensus(item_versions, patch_level)
+
+        key = (item_id, patch_level)
+        if key not in self.concensus_cache:
+            self.concensus_cache[key] = self.build_item_concensus(item_versions, patch_level)
+
+        return self.concensus_cache[key]
+
+    def build_item_concensus(self, item_versions, patch_level = None):
         """
         Have a list of item versions, iterate over them to find the most common version
-        and return that. Make a list of conflicts inside the item too for the differing versions
+        and return a copy of it. Make a list of conflicts inside the copy too for the
+        differing versions, the versions in the store are left untouched
         """
 
         #print "FINDING ITEM CONCENSUS"
@@ -155,7 +237,7 @@ class ItemPatchData(object):
         mapping = {}
 
         for version in item_versions:
-            item_hash = hash(version)
+            item_hash = version.fingerprint()
 
             if item_hash not in mapping:
                 mapping[item_hash] = version
@@ -168,7 +250,8 @@ class ItemPatchData(object):
         #pprint(mapping)
 
         concensus_hash = max(occurrences.iteritems(), key = operator.itemgetter(1))[0]
-        concensus = mapping[concensus_hash]
+        concensus = ItemVersion(mapping[concensus_hash])
+        concensus.source = mapping[concensus_hash].source
 
         #print "Concensus is %s" % (concensus_hash,)
 
@@ -176,22 +259,95 @@ class ItemPatchData(object):
             if mhash != concensus_hash:
                 conflict_version = mapping[mhash]
                 
-                conflicts.append(concensus.calculate_diff(conflict_version))
+                # Built lazily, most conflicts are never written out
+                conflicts.append(concensus.diff_view(conflict_version))
+
 
+        concensus["conflicts"] = concensus["conflicts"] + conflicts
+        if patch_level is not None:
+            concensus["patch"] = patch_level
 
-        concensus["conflicts"] += conflicts
+        # Neither conflicts nor patch are fingerprinted
+        concensus._fingerprint = concensus_hash
 
         #pprint(concensus)
 
         return concensus
 
-def build_sql_migration(outfile, diff):
+def build_patch_views(data, patch_levels, item_ids = None, predicates = None, concensus_cache = None):
+    """
+    OrderedDict of patch level -> filtered ItemPatchData, every one a view
+    over data. The item patch lists are built once for all the levels
+    """
+    patch_lists = item_patch_lists(data, item_ids)
+
+    views = OrderedDict()
+    for patch_level in patch_levels:
+        patch_data = ItemPatchData(patch_level, concensus_cache)
+        patch_data.build_patch_data(data, patch_lists = patch_lists)
+        patch_data.filter(predicates)
+        views[patch_level] = patch_data
+
+    return views
+
+def shard_item_ids(shard_size, governor = None):
+    """
+    Item database IDs grouped into (low, high, ids) ranges of shard_size IDs.
+    With a governor the ranges are instead governor.batch_size IDs wide, read
+    again before every range, and memory is checked between ranges
+    """
+    if governor is not None:
+        item_ids = sorted(NAME_TO_ID_HASH.itervalues())
+        index = 0
+        while index < len(item_ids):
+            governor.check()
+            low = item_ids[index]
+            high = low + governor.batch_size
+
+            end = bisect.bisect_left(item_ids, high, index)
+            yield low, high, set(item_ids[index:end])
+            index = end
+        return
+
+    shards = {}
+    for item_id in NAME_TO_ID_HASH.itervalues():
+        shards.setdefault(item_id // shard_size, set()).add(item_id)
+
+    for shard_id in sorted(shards):
+        yield shard_id * shard_size, (shard_id + 1) * shard_size, shards[shard_id]
+
+def iter_shard_diffs(to_patch, from_patch, load_input, shard_size = 2000, governor = None):
+    """
+    Diff the patches one item ID range at a time, yielding (to_data, from_data, diff)
+    for each range. load_input(patch_level, low, high) returns a store holding
+    at least the items in the range, so only one range of patch data is in
+    memory at once. Items never move between ranges, so the diffs together are
+    the same as calculate_diff over the full stores. A governor narrows the
+    ranges as memory use approaches its budget
+    """
+    for low, high, item_ids in shard_item_ids(shard_size, governor):
+        to_data = ItemPatchData(to_patch)
+        to_data.build_patch_data(load_input(to_patch, low, high), item_ids)
+        to_data.filter()
+
+        from_data = ItemPatchData(from_patch)
+        from_data.build_patch_data(load_input(from_patch, low, high), item_ids)
+        from_data.filter()
+
+        yield to_data, from_data, to_data.calculate_diff(from_data)
+
+# Fields build_sql_migration does not write
+SQL_IGNORED_FIELDS = ["flavour", "name", "conflicts", "itemType", "slot"]
+SQL_IGNORED_MASK = field_mask(SQL_IGNORED_FIELDS)
+
+def build_sql_migration(outfile, diff, spell_index = None):
+    """
+    Write the SQL for a diff. Effects parsed without a spell ID are looked up
+    by tooltip in spell_index if given, and left out if still unknown
+    """
     for item_id in diff:
         identifier_tuple = (ID_TO_NAME_HASH[item_id], DB_ITEM_DATA[item_id]["itemlevel"], item_id)
 
-        if item_id == 19165:
-            pprint(diff[item_id])
-
         item_data = diff[item_id]
 
         if item_data["removed"]:
@@ -206,24 +362,32 @@ def build_sql_migration(outfile, diff):
             continue
 
         # Item present in both to and from patch level. Possibly updated
-        if hash(item_data["to"]) == hash(item_data["from"]):
+        if item_data["to"].matches(item_data["from"]):
             outfile.write("-- NO CHANGE: %s (ilevel %d, entry %d)\n" % identifier_tuple)
             continue
 
         # Item changed between patches!
-        item_diff = item_data["from"].calculate_diff(item_data["to"])
+        item_diff = item_data["from"].diff_view(item_data["to"])
 
         outfile.write("-- ITEM %s (ilevel %d, entry %d) CHANGED\n" % identifier_tuple)
 
         def write_conflict(param, value):
+            if not isinstance(value, basestring):
+                value = str(value)
             value = re.sub(r'[^\x00-\x7F]+', '', value)
             outfile.write("-- DESTINATION SOURCE CONFLICT `%s` = `%s`\n" % (param, value))
 
         def write_change(param, value):
+            if not isinstance(value, basestring):
+                value = str(value)
             value = re.sub(r'[^\x00-\x7F]+', '', value)
             outfile.write("-- Modified %s to %s\n" % (param, value))
 
         for conflict in item_data["to"]["conflicts"]:
+            # Nothing would be written, skip building the diff
+            if isinstance(conflict, ItemDiff) and not conflict.changed(SQL_IGNORED_MASK):
+                continue
+
             for key in conflict:
                 if key == "flavour" or key == "name" or key == "conflicts" or key == "itemType" or key == "slot": 
                     continue
@@ -260,8 +424,12 @@ def build_sql_migration(outfile, diff):
                     spell_id = effect["spellId"]
                     index = effect["index"]
                     tooltip = effect["tooltip"]
+                    resolved = False
+                    if spell_id < 0 and spell_index is not None:
+                        spell_id = spell_index.resolve(tooltip)
+                        resolved = True
+
                     if spell_id < 0:
-                        # TODO: Look up spell ID based on tooltip
                         continue
                     
                     if not first_effect:
@@ -269,6 +437,8 @@ def build_sql_migration(outfile, diff):
 
                     param = "Spell #%d" % (index,)
                     value = "%d (%s)" % (spell_id, tooltip)
+                    if resolved:
+                        value += " resolved from tooltip"
                     write_change(param, value)
 
                     trigger = 1
@@ -300,29 +470,158 @@ def build_sql_migration(outfile, diff):
 
         outfile.write(query + ";\n")
 
+def parse_item_ids(value):
+    """
+    Item IDs from a comma separated list of IDs and low-high ranges, inclusive
+    """
+    item_ids = set()
+    for part in value.split(","):
+        if "-" in part:
+            low, high = part.split("-")
+            item_ids.update(range(int(low), int(high) + 1))
+        elif part:
+            item_ids.add(int(part))
+
+    return item_ids
+
+def build_spell_index(sqlite = None, stores = ()):
+    """
+    Tooltip to spell ID index over every effect in the SQLite database, or
+    otherwise in the given stores
+    """
+    spell_index = SpellIndex()
+    if sqlite:
+        for tooltip, spell_id in SqliteItemDatabase(sqlite).known_effects():
+            spell_index.add(tooltip, spell_id)
+    else:
+        for store in stores:
+            spell_index.add_store(store)
+
+    return spell_index
+
+def print_spell_stats(spell_index):
+    print "Resolved %d of %d unknown spell IDs from tooltips (%d exact, %d near)" % (
+        spell_index.exact + spell_index.near, spell_index.exact + spell_index.near + spell_index.unresolved,
+        spell_index.exact, spell_index.near)
+
 def main():
+    arg_parser = argparse.ArgumentParser(description = "Build SQL updates for item changes between two patches")
+    arg_parser.add_argument("--sqlite", metavar = "FILE",
+        help = "Read the per-patch inputs from a database written by parser.py --sqlite instead of parsed.json")
+    arg_parser.add_argument("--shard-size", type = int, metavar = "N",
+        help = "Diff N item IDs at a time, writing the SQL as each range is done")
+    arg_parser.add_argument("--items", type = parse_item_ids, metavar = "IDS",
+        help = "Only load and diff these items, e.g. 19165 or 19000-19100,19165. The diff is pretty printed")
+    arg_parser.add_argument("--memory-budget", type = float, metavar = "MB",
+        help = "Memory budget, --shard-size ranges narrow as it is approached")
+    arg_parser.add_argument("--input", metavar = "FILE", default = "parsed.json",
+        help = "Parsed item store to read, the format follows the extension unless --format is given")
+    arg_parser.add_argument("--format", choices = list(SERIALIZERS),
+        help = "Store format of --input")
+    args = arg_parser.parse_args()
+
+    # Reading item subsets goes through the parsed.json offset index
+    json_input = serializer_for(args.input, args.format).name == "json"
+    if args.shard_size and not args.sqlite and not json_input:
+        arg_parser.error("--shard-size needs a parsed.json --input or --sqlite")
+
+    governor = None
+    if args.memory_budget:
+        logging.basicConfig(level = logging.INFO, format = "%(levelname)s:%(name)s: %(message)s")
+        governor = MemoryGovernor(int(args.memory_budget * 1048576), batch_size = args.shard_size or 2000,
+            min_batch_size = 50)
+
     to_patch = 106
     from_patch = 107
 
-    with open("parsed.json", "rb") as f:
-        item_data = ItemStore()
-
-        tmp = json.load(f)
+    # Build SQL file with statements to update stats/remove items
+    outfile = "item_update_%d_to_%d.sql" % (from_patch, to_patch)
 
-        # Convert unicode keys back to int, json has no int keys
-        for item_id in tmp:
-            for patch_level in tmp[item_id]:
-                for itemv in tmp[item_id][patch_level]:
-                    item_data.add_item(int(item_id), int(patch_level), ItemVersion(itemv))
+    if args.items:
+        if args.sqlite:
+            data = SqliteItemDatabase(args.sqlite).load_items(args.items)
+        elif json_input:
+            data = load_parsed_items(args.input, item_ids = args.items)
+        else:
+            store = load_store(args.input, args.format)
+            data = ItemStore((item_id, store[item_id]) for item_id in args.items if item_id in store)
+
+        to_data = ItemPatchData(to_patch)
+        to_data.build_patch_data(data, args.items)
+        to_data.filter()
+
+        from_data = ItemPatchData(from_patch)
+        from_data.build_patch_data(data, args.items)
+        from_data.filter()
+
+        diff = to_data.calculate_diff(from_data)
+        pprint(dict(diff))
+
+        # Only the loaded items are indexed unless reading from SQLite
+        build_sql_migration(sys.stdout, diff, build_spell_index(args.sqlite, [data]))
+        return
+
+    if args.shard_size:
+        if args.sqlite:
+            db = SqliteItemDatabase(args.sqlite)
+            load_input = lambda patch_level, low, high: db.load_patch_inputs(patch_level, (low, high))
+        else:
+            # Both patches of a range are built from the same items
+            loaded = {}
+            def load_input(patch_level, low, high):
+                if (low, high) not in loaded:
+                    loaded.clear()
+                    loaded[(low, high)] = load_parsed_items(args.input, id_range = (low, high))
+                return loaded[(low, high)]
+
+        # Spells are indexed in a first pass over the ranges, one range in memory at a time
+        spell_index = build_spell_index(args.sqlite, (load_input(to_patch, low, high)
+            for low, high, item_ids in shard_item_ids(args.shard_size)))
+
+        counts = [0] * 8
+        with open(outfile, "wb") as f:
+            for to_data, from_data, diff in iter_shard_diffs(to_patch, from_patch, load_input, args.shard_size,
+                    governor):
+                build_sql_migration(f, diff, spell_index)
+
+                for i, data in enumerate([to_data, from_data]):
+                    counts[i * 4] += len(data.item_store)
+                    counts[i * 4 + 1] += len(data.not_found)
+                    counts[i * 4 + 2] += len(data.filtered_item_store)
+                    counts[i * 4 + 3] += len(data.filtered_not_found)
+
+        print "Num items in 106: %d, not found: %d" % tuple(counts[0:2])
+        print "Num items in FILTERED 106: %d, not found: %d" % tuple(counts[2:4])
+
+        print "Num items in 107: %d, not found: %d" % tuple(counts[4:6])
+        print "Num items in FILTERED 107: %d, not found: %d" % tuple(counts[6:8])
+        print_spell_stats(spell_index)
+        if governor is not None:
+            print governor.summary()
+        return
+
+    if args.sqlite:
+        db = SqliteItemDatabase(args.sqlite)
+        to_input = db.load_patch_inputs(to_patch)
+        from_input = db.load_patch_inputs(from_patch)
+    else:
+        to_input = from_input = load_store(args.input, args.format)
+
+    # Everything is loaded at once here, the governor can only report
+    if governor is not None:
+        governor.check(force = True)
+        if governor.last_usage >= governor.soft_limit * governor.budget:
+            print "Loaded inputs use %s of the %s budget, diff with --shard-size to stay under it" % (
+                format_bytes(governor.last_usage), format_bytes(governor.budget))
 
     to_data = ItemPatchData(to_patch)
-    to_data.build_patch_data(item_data)
+    to_data.build_patch_data(to_input)
     to_data.filter()
     #pprint(to_data.item_store)
     #pprint(to_data.filtered_not_found)
 
     from_data = ItemPatchData(from_patch)
-    from_data.build_patch_data(item_data)
+    from_data.build_patch_data(from_input)
     from_data.filter()
 
     print "Num items in 106: %d, not found: %d" % (len(to_data.item_store.keys()), len(to_data.not_found))
@@ -333,12 +632,13 @@ def main():
 
     diff = to_data.calculate_diff(from_data)
 
-    # Build SQL file with statements to update stats/remove items
-    outfile = "item_update_%d_to_%d.sql" % (from_patch, to_patch)
+    spell_index = build_spell_index(args.sqlite, [to_input])
     with open(outfile, "wb") as f:
-        build_sql_migration(f, diff)
+        build_sql_migration(f, diff, spell_index)
+    print_spell_stats(spell_index)
 
     #with open("patchdiff.json", "wb") as f:
     #    json.dump(diff, f)
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+catalog.py
+
+Sizes of the waybackdump directories, kept in catalog.json so parse runs can
+hand out the expensive work first:
+
+    catalog = SnapshotCatalog("catalog.json")
+    catalog.refresh("waybackdump")
+    catalog.save()
+
+Every (snapshot, site) directory gets its file count, total bytes, patch level
+and page layout. Refreshing is incremental: the mtime, file count, bytes and
+subdirectories of every directory below the sites are kept, and a directory
+whose mtime has not changed is not listed again. Pages are downloaded as .part
+files renamed into place, so a new page always touches its directory.
+
+Work is ordered longest processing time first. The largest units go out
+before the small ones, so the last work handed out is short and the workers
+finish close together instead of one of them running a big directory alone
+at the end of the run
+"""
+
+import json
+import os
+
+from distributed import iter_work_units
+from parser import list_entries
+from sampling import page_layout
+
+# Fixed cost of a file, in bytes parsed: opening it and building the soup and
+# parser cost about as much as parsing this many bytes of page
+PER_FILE_COST = 16384
+
+# A chunk is at most this share of the work left per process, so chunks get
+# smaller towards the end of the run (guided self-scheduling)
+CHUNK_SHARE = 0.5
+
+class SnapshotCatalog(object):
+    def __init__(self, filename = None):
+        self.filename = filename
+        self.dump_dir = None
+
+        # Path relative to the dump -> {"mtime", "files", "bytes", "subdirs"}
+        self.directories = {}
+        # Unit ID ("snapshot/site", as in distributed.py) -> {"snapshot", "db",
+        # "patchLevel", "files", "bytes", "layout"}
+        self.units = {}
+
+        # Directories listed by the last refresh
+        self.rescanned = 0
+
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                data = json.load(f)
+            self.directories = data["directories"]
+            self.units = data["units"]
+
+    def save(self, filename = None):
+        filename = filename or self.filename
+        with open(filename + ".tmp", "wb") as f:
+            json.dump({"directories": self.directories, "units": self.units}, f)
+        os.rename(filename + ".tmp", filename)
+
+    def _scan_directory(self, relative):
+        path = os.path.join(self.dump_dir, relative)
+        mtime = os.stat(path).st_mtime
+
+        entry = self.directories.get(relative)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry, False
+
+        files = 0
+        size = 0
+        subdirs = []
+        for name, child, is_dir in list_entries(path):
+            if is_dir:
+                subdirs.append(name)
+            elif not name.endswith(".part"):
+                files += 1
+                size += os.path.getsize(child)
+
+        entry = {"mtime": mtime, "files": files, "bytes": size, "subdirs": sorted(subdirs)}
+        self.directories[relative] = entry
+        self.rescanned += 1
+
+        return entry, True
+
+    def _first_file(self, relative):
+        # First page of the first directory with any, to read the layout from
+        pending = [relative]
+        while pending:
+            current = pending.pop(0)
+            entry = self.directories[current]
+            if entry["files"]:
+                path = os.path.join(self.dump_dir, current)
+                names = sorted(name for name, child, is_dir in list_entries(path)
+                    if not is_dir and not name.endswith(".part"))
+                if names:
+                    return os.path.join(path, names[0])
+            pending.extend(os.path.join(current, name) for name in entry["subdirs"])
+
+        return None
+
+    def refresh(self, dump_dir):
+        """
+        Bring the catalog up to date with the dump, listing only directories
+        that changed since the last refresh. Returns the number of units
+        whose totals were recounted
+        """
+        self.dump_dir = dump_dir
+        self.rescanned = 0
+
+        visited = set()
+        units = {}
+        recounted = 0
+
+        for unit in iter_work_units(dump_dir):
+            files = 0
+            size = 0
+            changed = False
+
+            # Iterative walk, Thottbot and Allakhazam paths nest deep
+            pending = [os.path.join(unit["snapshot"], unit["db"])]
+            while pending:
+                relative = pending.pop()
+                visited.add(relative)
+
+                entry, rescanned = self._scan_directory(relative)
+                changed = changed or rescanned
+                files += entry["files"]
+                size += entry["bytes"]
+                pending.extend(os.path.join(relative, name) for name in entry["subdirs"])
+
+            previous = self.units.get(unit["id"])
+            if previous is not None and not changed:
+                units[unit["id"]] = previous
+                continue
+
+            layout = previous["layout"] if previous is not None else None
+            if layout is None and files:
+                layout = page_layout(self._first_file(os.path.join(unit["snapshot"], unit["db"])))
+
+            entry = dict(unit, files = files, bytes = size, layout = layout)
+            del entry["id"]
+            units[unit["id"]] = entry
+            recounted += 1
+
+        # Forget directories that are gone
+        for relative in set(self.directories) - visited:
+            del self.directories[relative]
+        self.units = units
+
+        return recounted
+
+    def unit_layouts(self):
+        """
+        {unit ID: page layout} of the catalogued units, for sampling.stratify
+        """
+        return dict((unit_id, unit["layout"]) for unit_id, unit in self.units.iteritems())
+
+    def unit_cost(self, unit_id):
+        """
+        Estimated parse cost of a (snapshot, site) unit, 0 if not catalogued
+        """
+        unit = self.units.get(unit_id)
+        if unit is None:
+            return 0
+
+        return unit["bytes"] + unit["files"] * PER_FILE_COST
+
+    def file_cost(self, file_path):
+        """
+        Estimated parse cost of a file, from the average size of its directory
+        """
+        entry = None
+        if self.dump_dir is not None:
+            entry = self.directories.get(os.path.relpath(os.path.dirname(file_path), self.dump_dir))
+        if entry is None or not entry["files"]:
+            return PER_FILE_COST
+
+        return entry["bytes"] // entry["files"] + PER_FILE_COST
+
+    def largest_units_first(self, units):
+        """
+        distributed.py work units, most expensive first. Ties keep their order
+        """
+        return sorted(units, key = lambda unit: -self.unit_cost(unit["id"]))
+
+    def largest_files_first(self, work_items):
+        """
+        parser.py work items, most expensive first. Ties keep their order
+        """
+        return sorted(work_items, key = lambda work_item: -self.file_cost(work_item[0]))
+
+    def cost_balanced_chunks(self, work_items, processes):
+        """
+        Work items grouped into chunks for processes workers, largest first.
+        Each chunk holds about CHUNK_SHARE of the cost left per process, so
+        chunks shrink as the run goes on and the last ones are small
+        """
+        costed = [(self.file_cost(work_item[0]), work_item) for work_item in work_items]
+        costed.sort(key = lambda entry: -entry[0])
+
+        remaining = sum(cost for cost, work_item in costed)
+        chunks = []
+        chunk = []
+        chunk_cost = 0
+        for cost, work_item in costed:
+            chunk.append(work_item)
+            chunk_cost += cost
+
+            if chunk_cost >= CHUNK_SHARE * remaining / max(1, processes):
+                chunks.append(chunk)
+                remaining -= chunk_cost
+                chunk = []
+                chunk_cost = 0
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
@@ -0,0 +1,120 @@
+"""
+compare_parsed.py
+
+Report the items whose parsed versions differ between two parse runs, e.g.
+before and after an archiveparser.py change:
+
+    python compare_parsed.py parsed_old.json parsed.json
+    python compare_parsed.py parsed_old.json parsed.json --details
+
+Both files are compared through the fingerprint trees dump_parsed_json writes
+next to them. Only buckets whose hashes differ are read, and only items whose
+hashes differ within them are reported, so the work grows with the number of
+changes rather than the size of the dump. A missing or stale tree is rebuilt
+from the parsed file first. Exits with status 1 if anything changed, to be
+used as a gate for parser edits
+"""
+
+import argparse
+import sys
+
+from items import *
+
+def load_fingerprint_tree(filename):
+    """
+    FingerprintTree for a parsed.json, rebuilding it if it is missing or was
+    written for a different file or an earlier version of it
+    """
+    tree_filename = parsed_fingerprint_filename(filename)
+    try:
+        tree = FingerprintTree(tree_filename)
+        if tree.describes(filename):
+            return tree
+    except (IOError, ValueError):
+        pass
+
+    print >> sys.stderr, "Building fingerprint tree for %s" % (filename,)
+    store = load_parsed_json(filename)
+    write_fingerprint_tree(dict((item_id, item_fingerprints(store[item_id])) for item_id in store),
+        tree_filename, parsed_file_signature(filename))
+
+    return FingerprintTree(tree_filename)
+
+def compare_fingerprint_trees(old, new):
+    """
+    {item_id: change} for every item that differs, change being "added",
+    "removed", or the sorted list of patches whose version sets differ
+    """
+    changes = {}
+    if old.root == new.root:
+        return changes
+
+    if old.bucket_size != new.bucket_size:
+        raise ValueError("Fingerprint trees use different bucket sizes")
+
+    for bucket_id in sorted(set(old.buckets) | set(new.buckets)):
+        old_entry = old.buckets.get(bucket_id)
+        new_entry = new.buckets.get(bucket_id)
+        if old_entry is not None and new_entry is not None and old_entry[0] == new_entry[0]:
+            continue
+
+        old_items = old.bucket(bucket_id)
+        new_items = new.bucket(bucket_id)
+
+        for item_id in set(old_items) | set(new_items):
+            if item_id not in new_items:
+                changes[item_id] = "removed"
+            elif item_id not in old_items:
+                changes[item_id] = "added"
+            elif old_items[item_id][0] != new_items[item_id][0]:
+                old_patches = old_items[item_id][1]
+                new_patches = new_items[item_id][1]
+                changes[item_id] = sorted(patch for patch in set(old_patches) | set(new_patches)
+                    if old_patches.get(patch) != new_patches.get(patch))
+
+    return changes
+
+def print_details(old_file, new_file, changes):
+    # Versions only found on one side, for the changed patches
+    item_ids = set(item_id for item_id in changes if isinstance(changes[item_id], list))
+    old_store = load_parsed_items(old_file, item_ids = item_ids)
+    new_store = load_parsed_items(new_file, item_ids = item_ids)
+
+    encoder = CustomEncoder(sort_keys = True)
+    for item_id in sorted(item_ids):
+        for patch in changes[item_id]:
+            old_versions = set(encoder.encode(itemv) for itemv in old_store.get(item_id, {}).get(patch, ()))
+            new_versions = set(encoder.encode(itemv) for itemv in new_store.get(item_id, {}).get(patch, ()))
+
+            for version in sorted(old_versions - new_versions):
+                print "  %d @ %d - %s" % (item_id, patch, version)
+            for version in sorted(new_versions - old_versions):
+                print "  %d @ %d + %s" % (item_id, patch, version)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = "List items whose parsed versions differ between two parse runs")
+    arg_parser.add_argument("old", help = "parsed.json of the earlier run")
+    arg_parser.add_argument("new", help = "parsed.json of the later run")
+    arg_parser.add_argument("--details", action = "store_true", help = "Print the versions that differ")
+    args = arg_parser.parse_args()
+
+    old = load_fingerprint_tree(args.old)
+    new = load_fingerprint_tree(args.new)
+    changes = compare_fingerprint_trees(old, new)
+
+    for item_id in sorted(changes):
+        change = changes[item_id]
+        if isinstance(change, list):
+            change = "changed in %s" % (", ".join(str(patch) for patch in change),)
+        print "%d %s %s" % (item_id, ID_TO_NAME_HASH.get(item_id, "?"), change)
+
+    if args.details and changes:
+        print_details(args.old, args.new, changes)
+
+    print >> sys.stderr, "%d items changed, %d of %d buckets read" % (len(changes),
+        new.buckets_read, len(new.buckets))
+
+    sys.exit(1 if changes else 0)
+
+if __name__ == "__main__":
+    main()
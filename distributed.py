@@ -0,0 +1,445 @@
+"""
+distributed.py
+
+Parse one waybackdump on several machines. The coordinator splits the dump
+into work units of one site directory of one snapshot, and leases them to
+workers over TCP or a unix socket:
+
+    python distributed.py coordinator --listen 0.0.0.0:8766 --output parsed.json
+    python distributed.py worker --connect coordinator-host:8766 --dump-dir /mnt/waybackdump
+
+Workers read the dump from their own --dump-dir (a shared or copied tree),
+parse a unit and send back every version it produced in one message. The
+coordinator merges a unit only once, on the first completion it receives, so a
+unit re-run after its lease expired is not counted twice. A worker that
+disconnects loses its leases straight away, one that hangs loses them when
+they run out. Parsed output is written once every unit is done.
+
+Messages are JSON objects, one per line, in request/response pairs started by
+the worker:
+
+    {"op": "lease"}                              -> {"unit": {...}, "lease": 1, "timeout": 300}
+                                                    {"wait": 1.0} or {"done": true}
+    {"op": "renew", "lease": 1}                  -> {"ok": true}
+    {"op": "complete", "lease": 1, "unit": "...", "versions": [[item_id, patch, fields, source], ...]}
+                                                 -> {"ok": true, "accepted": true}
+    {"op": "fail", "lease": 1, "unit": "...", "error": "..."}
+                                                 -> {"ok": true}
+"""
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque, OrderedDict
+
+from fragmentcache import FragmentCache
+from items import *
+from parser import WOW_DB_DIRS, getPatchLevel, iter_directory_files, list_entries, parse_file
+from sqlitestore import SqliteItemDatabase
+
+def iter_work_units(dump_dir):
+    """
+    Yield a unit dict for every (snapshot, site directory) pair in the dump,
+    with the same snapshot filtering as parser.iter_work_items
+    """
+    for snapshot, snapshot_dir, is_dir in sorted(list_entries(dump_dir)):
+        if not is_dir or not snapshot.isdigit():
+            continue
+
+        # Ignore snapshots from before 2004 or after 2006
+        s_year = int(snapshot[0:4])
+        if s_year < 2004 or s_year >= 2007:
+            continue
+
+        for db in sorted(WOW_DB_DIRS):
+            if os.path.isdir(os.path.join(snapshot_dir, db)):
+                yield {
+                    "id": "%s/%s" % (snapshot, db),
+                    "snapshot": snapshot,
+                    "db": db,
+                    "patchLevel": getPatchLevel(snapshot)
+                }
+
+def parse_address(value):
+    """
+    host:port for TCP, anything with a slash is a unix socket path
+    """
+    if "/" in value:
+        return value
+
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+def encode_versions(parsed):
+    # source is an attribute, not one of the fields
+    return [[item_id, patchLevel, item, item.source] for item_id, patchLevel, item in parsed]
+
+def decode_versions(versions):
+    store = ItemStore()
+    for item_id, patchLevel, fields, source in versions:
+        itemv = ItemVersion(pool_fields(fields))
+        if source is not None:
+            itemv.source = tuple(source)
+        store.add_item(item_id, patchLevel, itemv)
+
+    return store
+
+class ParseCoordinator(object):
+    """
+    Unit bookkeeping shared by the connection handlers. All state changes
+    happen under one lock, merging included
+    """
+    def __init__(self, units, lease_timeout = 300.0, max_attempts = 3):
+        self.units = OrderedDict((unit["id"], unit) for unit in units)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        self._lease_ids = itertools.count(1)
+
+        self.pending = deque(self.units)
+        # lease_id -> (unit_id, worker, expires)
+        self.leases = {}
+        self.attempts = {}
+        self.completed = set()
+        self.failed = {}
+
+        self.store = ItemStore()
+        self.versions = 0
+
+        self.reissued = 0
+        self.duplicates = 0
+
+        self.finished = threading.Event()
+        if not self.units:
+            self.finished.set()
+
+    def _requeue(self, lease_id, error):
+        unit_id, worker, expires = self.leases.pop(lease_id)
+        if unit_id in self.completed or unit_id in self.failed:
+            return
+
+        # Another lease may still be running the unit
+        if any(lease[0] == unit_id for lease in self.leases.itervalues()):
+            return
+
+        # Units that keep killing or hanging their workers are given up on
+        if self.attempts[unit_id] >= self.max_attempts:
+            self.failed[unit_id] = error
+            self._check_finished()
+            return
+
+        self.pending.appendleft(unit_id)
+        self.reissued += 1
+
+    def _reap(self):
+        now = time.time()
+        for lease_id in [lease_id for lease_id, lease in self.leases.iteritems() if lease[2] < now]:
+            self._requeue(lease_id, "Lease expired")
+
+    def _check_finished(self):
+        if len(self.completed) + len(self.failed) == len(self.units):
+            self.finished.set()
+
+    def lease(self, worker):
+        with self._lock:
+            self._reap()
+
+            if self.finished.is_set():
+                return {"done": True}
+
+            if not self.pending:
+                # Everything is leased, wait in case a lease is given up
+                return {"wait": 1.0}
+
+            unit_id = self.pending.popleft()
+            self.attempts[unit_id] = self.attempts.get(unit_id, 0) + 1
+
+            lease_id = next(self._lease_ids)
+            self.leases[lease_id] = (unit_id, worker, time.time() + self.lease_timeout)
+
+            return {"unit": self.units[unit_id], "lease": lease_id, "timeout": self.lease_timeout}
+
+    def renew(self, lease_id):
+        with self._lock:
+            if lease_id not in self.leases:
+                return {"ok": False}
+
+            unit_id, worker, expires = self.leases[lease_id]
+            self.leases[lease_id] = (unit_id, worker, time.time() + self.lease_timeout)
+            return {"ok": True}
+
+    def complete(self, lease_id, unit_id, versions):
+        fragment = decode_versions(versions)
+
+        with self._lock:
+            self.leases.pop(lease_id, None)
+
+            # First completion wins, even from an expired lease
+            if unit_id in self.completed:
+                self.duplicates += 1
+                return {"ok": True, "accepted": False}
+
+            fragment.merge_into(self.store)
+            self.versions += len(versions)
+            self.completed.add(unit_id)
+            self.failed.pop(unit_id, None)
+            if unit_id in self.pending:
+                self.pending.remove(unit_id)
+
+            self._check_finished()
+            return {"ok": True, "accepted": True}
+
+    def fail(self, lease_id, unit_id, error):
+        with self._lock:
+            if lease_id in self.leases:
+                self._requeue(lease_id, error)
+
+            return {"ok": True}
+
+    def release(self, worker):
+        """
+        Give up the leases of a worker that went away
+        """
+        with self._lock:
+            for lease_id in [lease_id for lease_id, lease in self.leases.iteritems() if lease[1] == worker]:
+                self._requeue(lease_id, "Worker disconnected")
+
+    def progress(self):
+        with self._lock:
+            return "%d/%d units, %d leased, %d failed, %d reissued, %d duplicates" % (len(self.completed),
+                len(self.units), len(self.leases), len(self.failed), self.reissued, self.duplicates)
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        coordinator = self.server.coordinator
+        worker = next(self.server.worker_ids)
+
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                op = message.get("op")
+
+                if op == "lease":
+                    reply = coordinator.lease(worker)
+                elif op == "renew":
+                    reply = coordinator.renew(message["lease"])
+                elif op == "complete":
+                    reply = coordinator.complete(message["lease"], message["unit"], message["versions"])
+                elif op == "fail":
+                    reply = coordinator.fail(message["lease"], message["unit"], message["error"])
+                else:
+                    reply = {"ok": False, "error": "Unknown op %r" % (op,)}
+
+                self.wfile.write(json.dumps(reply) + "\n")
+                self.wfile.flush()
+        except (IOError, socket.error):
+            pass
+        finally:
+            # Killed or disconnected workers don't hold on to their units
+            coordinator.release(worker)
+
+class CoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, coordinator):
+        SocketServer.TCPServer.__init__(self, address, CoordinatorHandler)
+        self.coordinator = coordinator
+        self.worker_ids = itertools.count(1)
+
+class UnixCoordinatorServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, coordinator):
+        if os.path.exists(address):
+            os.remove(address)
+
+        SocketServer.UnixStreamServer.__init__(self, address, CoordinatorHandler)
+        self.coordinator = coordinator
+        self.worker_ids = itertools.count(1)
+
+def serve(coordinator, address, report_interval = 10.0):
+    """
+    Serve units until every one is completed or failed. Returns the coordinator
+    """
+    if isinstance(address, tuple):
+        server = CoordinatorServer(address, coordinator)
+    else:
+        server = UnixCoordinatorServer(address, coordinator)
+
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while not coordinator.finished.wait(report_interval):
+            print coordinator.progress()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+
+    return coordinator
+
+def connect(address, retries = 30):
+    for attempt in range(retries):
+        if isinstance(address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.connect(address)
+            return sock
+        except socket.error:
+            sock.close()
+            if attempt == retries - 1:
+                raise
+            time.sleep(1.0)
+
+def run_worker(address, dump_dir, item_filter = None, fragment_cache = None):
+    """
+    Lease, parse and return units until the coordinator has none left.
+    Returns the number of units parsed
+    """
+    sock = connect(address)
+    f = sock.makefile("rwb")
+
+    def call(message):
+        f.write(json.dumps(message, cls = CustomEncoder) + "\n")
+        f.flush()
+        line = f.readline()
+        if not line:
+            raise IOError("Coordinator closed the connection")
+        return json.loads(line)
+
+    units = 0
+    try:
+        while True:
+            reply = call({"op": "lease"})
+            if reply.get("done"):
+                break
+            if "wait" in reply:
+                time.sleep(reply["wait"])
+                continue
+
+            unit, lease_id = reply["unit"], reply["lease"]
+            renew_interval = reply["timeout"] / 3.0
+            last_renew = time.time()
+
+            item_dir = os.path.join(dump_dir, unit["snapshot"], unit["db"])
+            parser = WOW_DB_DIRS[unit["db"]]["parser"]
+            source = (unit["snapshot"], unit["db"])
+
+            parsed = []
+            try:
+                for file_path in iter_directory_files(item_dir):
+                    parsed += parse_file(file_path, unit["patchLevel"], parser, source, item_filter,
+                        fragment_cache = fragment_cache)
+
+                    if time.time() - last_renew > renew_interval:
+                        call({"op": "renew", "lease": lease_id})
+                        last_renew = time.time()
+            except Exception:
+                call({"op": "fail", "lease": lease_id, "unit": unit["id"], "error": traceback.format_exc()})
+                continue
+
+            call({"op": "complete", "lease": lease_id, "unit": unit["id"], "versions": encode_versions(parsed)})
+            units += 1
+
+            # One string pool generation per unit, a worker runs for the whole dump
+            STRING_POOL.reset()
+    finally:
+        f.close()
+        sock.close()
+
+    return units
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = "Parse a waybackdump with workers on several machines")
+    sub = arg_parser.add_subparsers(dest = "mode")
+
+    coordinator_parser = sub.add_parser("coordinator")
+    coordinator_parser.add_argument("--dump-dir", default = "waybackdump")
+    coordinator_parser.add_argument("--listen", default = "127.0.0.1:8766",
+        help = "host:port, or a unix socket path")
+    coordinator_parser.add_argument("--output", default = "parsed.json")
+    coordinator_parser.add_argument("--sqlite", metavar = "FILE", help = "Also write a SQLite database")
+    coordinator_parser.add_argument("--lease-timeout", type = float, default = 300.0,
+        help = "Seconds before the unit of a silent worker is handed out again")
+    coordinator_parser.add_argument("--max-attempts", type = int, default = 3)
+    coordinator_parser.add_argument("--local-workers", type = int, default = 0,
+        help = "Also start this many workers on this machine")
+    coordinator_parser.add_argument("--keep-all", action = "store_true", help = "Local workers keep filtered items")
+    coordinator_parser.add_argument("--fragment-cache", metavar = "FILE",
+        help = "Tooltip cache shared by the local workers")
+    coordinator_parser.add_argument("--catalog", metavar = "FILE",
+        help = "Directory size catalog, refreshed before the run, to lease the largest units first")
+
+    worker_parser = sub.add_parser("worker")
+    worker_parser.add_argument("--connect", default = "127.0.0.1:8766",
+        help = "host:port, or a unix socket path")
+    worker_parser.add_argument("--dump-dir", default = "waybackdump")
+    worker_parser.add_argument("--keep-all", action = "store_true", help = "Don't skip filtered items")
+    worker_parser.add_argument("--fragment-cache", metavar = "FILE",
+        help = "SQLite cache of parsed tooltips, shared with the other workers on this machine")
+
+    args = arg_parser.parse_args()
+
+    if args.mode == "worker":
+        item_filter = None if args.keep_all else ItemDatabaseFilter()
+        fragment_cache = FragmentCache(args.fragment_cache) if args.fragment_cache else None
+        run_worker(parse_address(args.connect), args.dump_dir, item_filter, fragment_cache)
+        if fragment_cache is not None:
+            fragment_cache.close()
+        return
+
+    units = list(iter_work_units(args.dump_dir))
+    if args.catalog:
+        from catalog import SnapshotCatalog
+
+        catalog = SnapshotCatalog(args.catalog)
+        catalog.refresh(args.dump_dir)
+        catalog.save()
+        units = catalog.largest_units_first(units)
+
+    coordinator = ParseCoordinator(units, args.lease_timeout, args.max_attempts)
+    print "%d work units in %s" % (len(coordinator.units), args.dump_dir)
+
+    workers = []
+    for i in range(args.local_workers):
+        command = [sys.executable, os.path.abspath(__file__), "worker", "--connect", args.listen,
+            "--dump-dir", args.dump_dir]
+        if args.keep_all:
+            command.append("--keep-all")
+        if args.fragment_cache:
+            command.extend(["--fragment-cache", args.fragment_cache])
+        workers.append(subprocess.Popen(command))
+
+    try:
+        serve(coordinator, parse_address(args.listen))
+    finally:
+        for worker in workers:
+            worker.wait()
+
+    print coordinator.progress()
+    for unit_id in sorted(coordinator.failed):
+        print "Failed %s:\n%s" % (unit_id, coordinator.failed[unit_id])
+
+    dump_parsed_json(coordinator.store, args.output)
+    if args.sqlite:
+        SqliteItemDatabase(args.sqlite).write_store(coordinator.store)
+
+if __name__ == "__main__":
+    main()
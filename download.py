@@ -1,30 +1,180 @@
 from waybackpack import *
 
 import argparse
+import gzip
+import json
 import logging
 import os
+import re
 import urlparse
 
+import requests
+
 import threading
 import time
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from items import DB_ITEM_DATA
+from metrics import MetricsRegistry, format_duration
+
 logger = logging.getLogger()
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+COMPRESSIONS = ["gzip", "zstd"]
+
+class _ZstdFile(object):
+    # Minimal writable file ending the zstd frame on close
+    def __init__(self, filepath):
+        self._file = open(filepath, "wb")
+        self._writer = zstandard.ZstdCompressor(level=3).stream_writer(self._file)
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def close(self):
+        self._writer.flush(zstandard.FLUSH_FRAME)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_compressed(filepath, compression=None):
+    """
+    Writable file compressing into filepath. File names are not changed, the
+    parser tells compressed pages apart by their magic bytes
+    """
+    if compression is None:
+        return open(filepath, "wb")
+    if compression == "gzip":
+        return gzip.open(filepath, "wb", 6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package")
+        return _ZstdFile(filepath)
+
+    raise ValueError("Unknown compression %s" % (compression,))
+
+class MeteredSession(Session):
+    """
+    waybackpack Session counting every response by status code, and the
+    4xx/5xx retries it makes internally, for the site host the session
+    downloads from. Those retries are how the archive throttles us, and they
+    never surface as exceptions
+    """
+    def __init__(self, metrics, host, **kwargs):
+        super(MeteredSession, self).__init__(**kwargs)
+
+        self.metrics = metrics
+        self.host = host
+
+    def get(self, url, **kwargs):
+        # Session.get with counters, its retry loop can't be hooked otherwise
+        headers = {
+            "User-Agent": self.user_agent,
+        }
+        retries = 0
+        while True:
+            res = requests.get(
+                url,
+                allow_redirects=self.follow_redirects,
+                headers=headers,
+                stream=True,
+                **kwargs
+            )
+            self.metrics.inc("wayback_responses_total", host=self.host, status=str(res.status_code))
+
+            if res.status_code // 100 not in [ 4, 5 ]:
+                return res
+
+            retries += 1
+            if retries > self.max_retries:
+                logger.info("HTTP status code: {0}, maximum retries reached, skipping.".format(res.status_code))
+                self.metrics.inc("wayback_gave_up_total", host=self.host, status=str(res.status_code))
+                return None
+
+            logger.info("HTTP status code: {0}, waiting 1 second before retrying.".format(res.status_code))
+            self.metrics.inc("wayback_http_retries_total", host=self.host, status=str(res.status_code))
+            time.sleep(1)
+
 class ModifiedPack(Pack):
     def __init__(self,
         url,
         timestamps=None,
         uniques_only=False,
-        session=None):
+        session=None,
+        metrics=None):
 
         super(ModifiedPack, self).__init__(url, timestamps, uniques_only, session)
 
+        self.metrics = metrics or MetricsRegistry()
+
         print self.parsed_url
 
+    def fetch_to(self, asset, filedir, filepath, raw, root, stream, compression):
+        """
+        Fetch one snapshot into filepath, returning the number of bytes fetched.
+        The file is written under a temporary name and renamed once complete, so
+        an interrupted fetch never leaves a truncated page behind
+        """
+        try:
+            os.makedirs(filedir)
+        except OSError:
+            pass
+
+        tmp_filepath = filepath + ".part"
+        fetched = 0
+
+        try:
+            with open_compressed(tmp_filepath, compression) as f:
+                logger.info("Writing to {0}\n".format(filepath))
+
+                # Non-raw snapshots have the wayback toolbar stripped out of the
+                # whole page, so only raw ones can be streamed
+                if stream and raw:
+                    res = self.session.get(asset.get_archive_url(raw))
+                    if res is None:
+                        raise IOError("No response for {0} @ {1}".format(asset.original_url, asset.timestamp))
+
+                    for chunk in res.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+                        fetched += len(chunk)
+                else:
+                    content = asset.fetch(
+                        session=self.session,
+                        raw=raw,
+                        root=root
+                    )
+                    f.write(content)
+                    fetched = len(content)
+        except:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+
+        os.rename(tmp_filepath, filepath)
+
+        return fetched
+
     def download_to(self, directory,
         raw=False,
         root=settings.DEFAULT_ROOT,
-        ignore_errors=False):
+        ignore_errors=False,
+        on_written=None,
+        stream=False,
+        compression=None):
+        """
+        on_written, if given, is called with the path of every file written.
+        With stream, raw snapshots are written to disk in chunks as they arrive
+        instead of being held in memory. compression is None, "gzip" or "zstd"
+        """
 
         for asset in self.assets:
             path_head, path_tail = os.path.split(self.parsed_url.path)
@@ -49,15 +199,17 @@ class ModifiedPack(Pack):
                     asset.timestamp)
             )
 
+            host = self.parsed_url.netloc
+            start = time.time()
             try:
-                content = asset.fetch(
-                    session=self.session,
-                    raw=raw,
-                    root=root
-                )
+                self.metrics.inc("wayback_requests_total", host=host, kind="snapshot")
+                fetched = self.fetch_to(asset, filedir, filepath, raw, root, stream, compression)
+                self.metrics.observe("wayback_request_seconds", time.time() - start, host=host, kind="snapshot")
             except Exception as e:
+                ex_name = ".".join([ e.__module__, e.__class__.__name__ ])
+                self.metrics.inc("wayback_errors_total", host=host, exception=ex_name)
+
                 if ignore_errors == True:
-                    ex_name = ".".join([ e.__module__, e.__class__.__name__ ])
                     logger.error("ERROR -- {0} @ {1} -- {2}: {3}".format(
                         asset.original_url,
                         asset.timestamp,
@@ -68,19 +220,21 @@ class ModifiedPack(Pack):
                 else:
                     raise
 
-            try:
-                os.makedirs(filedir)
-            except OSError:
-                pass
-            with open(filepath, "wb") as f:
-                logger.info("Writing to {0}\n".format(filepath))
-                f.write(content)
+            self.metrics.inc("wayback_bytes_total", fetched, host=host)
+            self.metrics.inc("wayback_bytes_written_total", os.path.getsize(filepath), host=host)
+            self.metrics.inc("wayback_snapshots_written_total", host=host)
+
+            if on_written is not None:
+                on_written(filepath)
 
 class WaybackDump(object):
-    def __init__(self, base_url, download_dir, from_date = "2004", to_date = "2006"):
+    def __init__(self, base_url, download_dir, from_date = "2004", to_date = "2006", metrics = None):
         self.base_url = base_url
         self.download_dir = download_dir
 
+        # Shared between dumps so one file covers the whole download
+        self.metrics = metrics or MetricsRegistry()
+
         self.from_date = from_date
         self.to_date = to_date
 
@@ -89,15 +243,34 @@ class WaybackDump(object):
 
         self._finished_tasks = []
 
+        # Called with each written file path, see ModifiedPack.download_to
+        self.on_written = None
+
+        self.parsed_file = "parsed.json"
+        self._parsed_ids = None
+
+        # Item ID tasks only request IDs from item_db.csv, see ItemIdTask
+        self.targeted = True
+        self.sweep_gaps = False
+
+        # Write pages in chunks as they arrive, optionally compressed
+        self.stream = False
+        self.compression = None
+
     def buildAndRetrievePack(self, suffix):
         try:
             url = self.base_url + suffix
+            host = urlparse.urlparse(url).netloc
 
-            session = Session(
+            session = MeteredSession(
+                self.metrics,
+                host,
                 user_agent=settings.DEFAULT_USER_AGENT,
                 follow_redirects=True
             )
 
+            self.metrics.inc("wayback_requests_total", host=host, kind="cdx")
+            start = time.time()
             snapshots = search(url,
                 session=session,
                 from_date=self.from_date,
@@ -105,27 +278,75 @@ class WaybackDump(object):
                 uniques_only=True,
                 collapse=None
             )
+            self.metrics.observe("wayback_request_seconds", time.time() - start, host=host, kind="cdx")
 
             timestamps = [ snap["timestamp"] for snap in snapshots ]
 
             pack = ModifiedPack(
                 url,
                 timestamps=timestamps,
-                session=session
+                session=session,
+                metrics=self.metrics
             )
 
             pack.download_to(
                 self.download_dir,
                 raw=True,
                 root=settings.DEFAULT_ROOT,
-                ignore_errors=True
+                ignore_errors=True,
+                on_written=self.on_written,
+                stream=self.stream,
+                compression=self.compression
             )
         except Exception as e:
             print e
             print "Exception getting pack. Retry"
 
+            ex_name = ".".join([ e.__module__, e.__class__.__name__ ])
+            self.metrics.inc("wayback_errors_total", host=host, exception=ex_name)
+            self.metrics.inc("wayback_retries_total", host=host)
+
             self.buildAndRetrievePack(suffix)
 
+    def downloaded_ids(self, suffix_format):
+        """
+        IDs with a page for suffix_format (e.g. "item.html?witem=%d") already
+        downloaded in any snapshot, found from the file names download_to writes
+        """
+        url = urlparse.urlparse(self.base_url + suffix_format)
+        path_head, path_tail = os.path.split(url.path)
+        if path_tail == "":
+            path_tail = "index.html"
+
+        prefix = url.query + "-" if url.query != "" else ""
+        pattern = re.compile("^" + re.escape(prefix + path_tail).replace(re.escape("%d"), r"(\d+)") + "$")
+
+        ids = set()
+        if not os.path.isdir(self.download_dir):
+            return ids
+
+        for timestamp in os.listdir(self.download_dir):
+            filedir = os.path.join(self.download_dir, timestamp, url.netloc, path_head.lstrip("/"))
+            if not os.path.isdir(filedir):
+                continue
+
+            for filename in os.listdir(filedir):
+                res = pattern.match(filename)
+                if res:
+                    ids.add(int(res.group(1)))
+
+        return ids
+
+    def parsed_ids(self):
+        # Item IDs already in the parse output, if there is one
+        if self._parsed_ids is None:
+            self._parsed_ids = set()
+            if self.parsed_file is not None and os.path.exists(self.parsed_file):
+                with open(self.parsed_file, "rb") as f:
+                    self._parsed_ids = set(int(item_id) for item_id in json.load(f))
+
+        return self._parsed_ids
+
     def task_completed(self, task):
         self._finished_tasks.append(task)
 
@@ -146,33 +367,110 @@ class WaybackDump(object):
     def finished(self):
         return len(self._tasks) == len(self._finished_tasks)
 
+    def progress(self):
+        # Compact per task progress with an ETA from the rate so far
+        return " | ".join(task.progress() for task in self._tasks)
+
 class WaybackDumpTask(object):
     def __init__(self, master):
         self.master = master
 
+        # Packs to retrieve, when known, and retrieved so far. Tasks set total
+        # in acquire_packs and fetch through retrieve() to keep these current
+        self.total = None
+        self.done = 0
+        self.started = None
+
     def acquire_packs(self):
         raise NotImplementedError("WaybackDumpTask must implement acquire_packs")
 
+    def retrieve(self, suffix):
+        result = self.master.buildAndRetrievePack(suffix)
+        self.done += 1
+
+        return result
+
+    def progress(self):
+        name = self.__class__.__name__
+        if self.total is None or self.started is None:
+            return "%s %d" % (name, self.done)
+
+        eta = None
+        if self.done > 0:
+            elapsed = time.time() - self.started
+            eta = elapsed / self.done * (self.total - self.done)
+
+        return "%s %d/%d %.1f%% ETA %s" % (name, self.done, self.total,
+            100.0 * self.done / max(self.total, 1), format_duration(eta))
+
     def execute(self):
+        self.started = time.time()
         self.acquire_packs()
 
         self.master.task_completed(self)
 
+class ItemIdTask(WaybackDumpTask):
+    """
+    Fetches one page per item ID. Only IDs in item_db.csv within id_range are
+    requested, those without a downloaded page or parsed data first. With
+    sweep_gaps the IDs in the range missing from the database are tried
+    afterwards, one every gap_delay seconds so it stays in the background
+    """
+    url_format = None
+    id_range = None
+
+    def __init__(self, master, targeted = None, sweep_gaps = None, gap_delay = 1.0):
+        super(ItemIdTask, self).__init__(master)
+
+        # Defaults come from the dump, set from the command line
+        self.targeted = master.targeted if targeted is None else targeted
+        self.sweep_gaps = master.sweep_gaps if sweep_gaps is None else sweep_gaps
+        self.gap_delay = gap_delay
+
+    def work_list(self):
+        """
+        (item IDs to request in order, gap IDs for the background sweep)
+        """
+        if not self.targeted:
+            return list(xrange(*self.id_range)), []
+
+        known = sorted(i for i in DB_ITEM_DATA if self.id_range[0] <= i < self.id_range[1])
+
+        have = self.master.downloaded_ids(self.url_format) | self.master.parsed_ids()
+        missing = [i for i in known if i not in have]
+        present = [i for i in known if i in have]
+
+        gaps = []
+        if self.sweep_gaps:
+            gaps = [i for i in xrange(*self.id_range) if i not in DB_ITEM_DATA]
+
+        return missing + present, gaps
+
+    def acquire_packs(self):
+        ids, gaps = self.work_list()
+        self.total = len(ids) + len(gaps)
+
+        for i in ids:
+            self.retrieve(self.url_format % i)
+
+        for i in gaps:
+            self.retrieve(self.url_format % i)
+            time.sleep(self.gap_delay)
+
 """
         ALLAKHAZAM
 
 """
-class AllakhazamItemTask(WaybackDumpTask):
-    def __init__(self, master):
-        super(AllakhazamItemTask, self).__init__(master)
+class AllakhazamItemTask(ItemIdTask):
+    # Get all individual item IDs
+    url_format = "item.html?witem=%d"
+    id_range = (1, 24284)
 
-    def acquire_packs(Self):
-        # Get all individual item IDs
-        for i in xrange(1, 24284):
-            self.buildItemPack(i)
+    def __init__(self, master, **kwargs):
+        super(AllakhazamItemTask, self).__init__(master, **kwargs)
 
     def buildItemPack(self, itemId):
-        return self.master.buildAndRetrievePack("item.html?witem=%d" % itemId)
+        return self.retrieve(self.url_format % itemId)
 
 class AllakhazamItemSetTask(WaybackDumpTask):
     def __init__(self, master):
@@ -182,40 +480,39 @@ class AllakhazamItemSetTask(WaybackDumpTask):
         # Get item set pages. There are 172 sets in the game ranging from low
         # 100 IDs to high 500 IDs, just check the range. Anything not existing
         # will be ignored anyway
+        self.total = 599
         for i in xrange(1, 600):
             self.buildItemSetPack(i)
 
     def buildItemSetPack(self, setId):
-        return self.master.buildAndRetrievePack("db/itemset.html?setid=%d" % setId)
+        return self.retrieve("db/itemset.html?setid=%d" % setId)
 
-class AllakhazamItemEntryTask(WaybackDumpTask):
-    def __init__(self, master):
-        super(AllakhazamItemEntryTask, self).__init__(master)
+class AllakhazamItemEntryTask(ItemIdTask):
+    # Get item entries, blind sweeps will be mostly misses
+    url_format = "db/item.html?entryid=%d"
+    id_range = (2000, 60000)
 
-    def acquire_packs(self):
-        # Get item entries, will be misses
-        for i in xrange(2000, 60000):
-            self.buildItemEntryPack(i)
+    def __init__(self, master, **kwargs):
+        super(AllakhazamItemEntryTask, self).__init__(master, **kwargs)
 
     def buildItemEntryPack(self, entryId):
-        return self.master.buildAndRetrievePack("db/item.html?entryid=%d" % entryId)
+        return self.retrieve(self.url_format % entryId)
 
-class AllakhazamItemPriceTask(WaybackDumpTask):
-    def __init__(self, master):
-        super(AllakhazamItemPriceTask, self).__init__(master)
+class AllakhazamItemPriceTask(ItemIdTask):
+    # Get all individual item IDs. Price may have multiple snapshots
+    # that differ to the plain item info
+    url_format = "db/price.html?witem=%d"
+    id_range = (1, 24284)
 
-    def acquire_packs(self):
-        # Get all individual item IDs. Price may have multiple snapshots
-        # that differ to the plain item info
-        for i in xrange(1, 24284):
-            self.buildItemPricePack(i)
+    def __init__(self, master, **kwargs):
+        super(AllakhazamItemPriceTask, self).__init__(master, **kwargs)
 
     def buildItemPricePack(self, itemId):
-        return self.master.buildAndRetrievePack("db/price.html?witem=%d" % itemId)
+        return self.retrieve(self.url_format % itemId)
 
 class AllakhazamWayback(WaybackDump):
-    def __init__(self, download_dir):
-        super(AllakhazamWayback, self).__init__("http://wow.allakhazam.com/", download_dir)
+    def __init__(self, download_dir, metrics = None):
+        super(AllakhazamWayback, self).__init__("http://wow.allakhazam.com/", download_dir, metrics = metrics)
 
     def generate_tasks(self):
         pass
@@ -233,45 +530,48 @@ class ThottbotRangedWeaponTask(WaybackDumpTask):
         super(ThottbotRangedWeaponTask, self).__init__(master)
 
     def acquire_packs(self):
-        self.master.buildAndRetrievePack("?r=ranged")
+        self.total = 1
+        self.retrieve("?r=ranged")
 
 class ThottbotItemSetTask(WaybackDumpTask):
     def __init__(self, master):
         super(ThottbotItemSetTask, self).__init__(master)
 
     def acquire_packs(self):
+        self.total = 599
         for i in xrange(1, 600):
             self.buildItemSetPack(i)
 
     def buildItemSetPack(self, setId):
-        return self.master.buildAndRetrievePack("?set=%d" % setId)
+        return self.retrieve("?set=%d" % setId)
 
 class ThottbotProfessionTask(WaybackDumpTask):
     def __init__(self, master):
         super(ThottbotProfessionTask, self).__init__(master)
 
     def acquire_packs(self):
-        for prof in ["Tailoring", "Blacksmithing", "Leatherworking", "Engineering"]:
+        profs = ["Tailoring", "Blacksmithing", "Leatherworking", "Engineering"]
+        self.total = len(profs)
+        for prof in profs:
             self.buildProfPack(prof)
 
     def buildProfPack(self, prof):
-        return self.master.buildAndRetrievePack("?t=%s" % prof)
+        return self.retrieve("?t=%s" % prof)
 
-class ThottbotItemEntryTask(WaybackDumpTask):
-    def __init__(self, master):
-        super(ThottbotItemEntryTask, self).__init__(master)
+class ThottbotItemEntryTask(ItemIdTask):
+    # Item entries, blind sweeps will be lots of misses over a big range
+    url_format = "?i=%d"
+    id_range = (1, 60000)
 
-    def acquire_packs(self):
-        # Item entries, will be lots of misses, but check a big range
-        for i in xrange(1, 60000):
-            self.buildItemPack(i)
+    def __init__(self, master, **kwargs):
+        super(ThottbotItemEntryTask, self).__init__(master, **kwargs)
 
     def buildItemPack(self, itemId):
-        return self.master.buildAndRetrievePack("?i=%d" % itemId)
+        return self.retrieve(self.url_format % itemId)
 
 class ThottbotWayback(WaybackDump):
-    def __init__(self, download_dir):
-        super(ThottbotWayback, self).__init__("http://thottbot.com/", download_dir)
+    def __init__(self, download_dir, metrics = None):
+        super(ThottbotWayback, self).__init__("http://thottbot.com/", download_dir, metrics = metrics)
 
     def generate_tasks(self):
         # Easy list of all ranged weapons
@@ -287,19 +587,54 @@ class ThottbotWayback(WaybackDump):
         #self._tasks.append(ThottbotItemEntryTask(self))
         pass
 
-def main():
-    logging.basicConfig(
-        level=(logging.INFO),
-        format="%(levelname)s:%(name)s: %(message)s"
-    )
+def build_dumps(download_dir="waybackdump", targeted=True, sweep_gaps=False, metrics=None,
+        stream=False, compression=None):
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compression needs the zstandard package")
 
-    allakhazam = AllakhazamWayback("waybackdump")
+    metrics = metrics or MetricsRegistry()
+
+    allakhazam = AllakhazamWayback(download_dir, metrics=metrics)
     #allakhazam.execute()
 
-    thottbot = ThottbotWayback("waybackdump")
+    thottbot = ThottbotWayback(download_dir, metrics=metrics)
 
     dumps = [ allakhazam, thottbot ]
-    
+    for d in dumps:
+        d.targeted = targeted
+        d.sweep_gaps = sweep_gaps
+        d.stream = stream
+        d.compression = compression
+
+    return dumps
+
+def progress_line(dumps):
+    metrics = dumps[0].metrics
+    elapsed = max(time.time() - metrics.started, 1e-6)
+
+    request_count = metrics.total("wayback_requests_total")
+    errors = metrics.total("wayback_errors_total")
+    http_retries = metrics.total("wayback_http_retries_total")
+    written = metrics.total("wayback_snapshots_written_total")
+
+    return "%.2f req/s, %d requests, %d errors, %d HTTP retries, %d snapshots, %.1f MB (%.1f MB on disk) | %s" % (
+        request_count / elapsed, request_count, errors, http_retries, written,
+        metrics.total("wayback_bytes_total") / 1048576.0,
+        metrics.total("wayback_bytes_written_total") / 1048576.0,
+        " | ".join(d.progress() for d in dumps if d._tasks))
+
+def run_dumps(dumps, metrics_file=None, metrics_format="json", metrics_interval=10.0, stop=None):
+    """
+    Run the dumps until they have all finished, or until the stop event is set
+    """
+    metrics = dumps[0].metrics
+    last_report = time.time()
+
+    def report():
+        logger.info(progress_line(dumps))
+        if metrics_file:
+            metrics.write(metrics_file, metrics_format)
+
     try:
         for d in dumps:
             d.execute()
@@ -312,13 +647,47 @@ def main():
                 if not d.finished:
                     finished = False
 
-            if finished:
+            if finished or (stop is not None and stop.is_set()):
                 break
 
+            if time.time() - last_report >= metrics_interval:
+                report()
+                last_report = time.time()
+
             time.sleep(1)
 
+        report()
+
     except KeyboardInterrupt:
+        report()
         quit()
 
+def main():
+    logging.basicConfig(
+        level=(logging.INFO),
+        format="%(levelname)s:%(name)s: %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(description="Download archived item pages from the wayback machine")
+    parser.add_argument("--blind", action="store_true",
+        help="Sweep the full item ID ranges instead of only IDs in item_db.csv")
+    parser.add_argument("--sweep-gaps", action="store_true",
+        help="After the known IDs, slowly try the IDs missing from item_db.csv")
+    parser.add_argument("--stream", action="store_true",
+        help="Write pages to disk in chunks instead of holding whole responses in memory")
+    parser.add_argument("--compress", choices=COMPRESSIONS,
+        help="Compress written pages, parser.py reads them transparently")
+    parser.add_argument("--metrics-file", metavar="FILE",
+        help="Periodically rewrite download metrics to this file")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+        help="Seconds between progress lines and metrics file updates")
+    args = parser.parse_args()
+
+    run_dumps(build_dumps(targeted=not args.blind, sweep_gaps=args.sweep_gaps,
+        stream=args.stream, compression=args.compress),
+        metrics_file=args.metrics_file, metrics_format=args.metrics_format,
+        metrics_interval=args.metrics_interval)
+
 if __name__ == "__main__":
     main()
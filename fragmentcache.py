@@ -0,0 +1,250 @@
+"""
+fragmentcache.py
+
+Tooltips extracted once per distinct markup instead of once per page. The same
+tooltip is archived on the item page at dozens of timestamps, on Allakhazam
+item set and price pages and in Thottbot set and profession listings:
+
+    cache = FragmentCache("fragments.sqlite")
+    parse_work_items(iter_work_items("waybackdump"), store, fragment_cache = cache)
+
+Every div.wowitem or table.ttb is hashed after normalization and the fields
+get_item_data extracted from it are looked up by that hash. Only fragments not
+seen before are parsed. Normalization strips the wayback link rewriting,
+/web/<timestamp>/ in every href, so a tooltip hashes the same in every
+snapshot. Nothing else is touched, tooltip text keeps its whitespace.
+
+The cache is a local SQLite file shared by all worker processes of a run and
+kept between runs. Each process keeps the entries it used in memory, writes
+the new ones at the end of every page and adds its hits and misses per site
+to the counts table, which the process that started the run reads back.
+
+Fragments without a name or with an ignored phrase are cached as such. New
+fragments are parsed without the item filter, so an entry holds for runs with
+any filter, and the filter of the run is applied to what the cache returns
+"""
+
+import cPickle
+import hashlib
+import os
+import re
+import sqlite3
+
+from collections import Counter
+
+from items import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fragments (
+    key BLOB PRIMARY KEY,
+    site TEXT NOT NULL,
+    outcome INTEGER NOT NULL,
+    fields BLOB
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counts (
+    site TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    misses INTEGER NOT NULL
+);
+"""
+
+# What get_item_data made of a fragment
+OUTCOME_ITEM = 0
+OUTCOME_IGNORED = 1
+OUTCOME_UNNAMED = 2
+
+# Entries kept in memory per process, all are dropped when it fills up
+MEMO_SIZE = 100000
+
+# Links rewritten by the wayback machine, /web/20051230123456/http://... with
+# an optional host and a suffix such as im_ on embedded resources
+WAYBACK_PREFIX = re.compile(r"(?:https?://web\.archive\.org)?/web/\d+[a-z_]*/")
+
+def normalize_fragment(markup):
+    return WAYBACK_PREFIX.sub("", markup)
+
+def fragment_key(site, version, fragment):
+    """
+    Hash of a BeautifulSoup tag's normalized markup. version is the parser's
+    FRAGMENT_VERSION, so entries from older parsers are never hit
+    """
+    markup = normalize_fragment(unicode(fragment)).encode("utf-8")
+    return hashlib.sha1("%s:%d:%s" % (site, version, markup)).digest()
+
+def copy_fields(fields):
+    # Containers are filled in place by the parser, keep a copy of our own
+    fields = dict(fields)
+    if "resistances" in fields:
+        fields["resistances"] = dict(fields["resistances"])
+    if "effects" in fields:
+        fields["effects"] = list(fields["effects"])
+
+    return fields
+
+# Instances by file name, see FragmentCache.__reduce__
+_shared = {}
+
+# Connections inherited from a parent process. Closing one in the child could
+# clean up the WAL file under the parent, so they are left open
+_inherited = []
+
+def shared_fragment_cache(filename):
+    cache = _shared.get(filename)
+    if cache is None:
+        cache = FragmentCache(filename)
+
+    return cache
+
+class FragmentCache(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+
+        self.hits = Counter()
+        self.misses = Counter()
+
+        self._conn = None
+        self._memo = {}
+        self._pending = []
+        self._counted_hits = Counter()
+        self._counted_misses = Counter()
+
+        _shared.setdefault(filename, self)
+
+    def __reduce__(self):
+        # Pool tasks pickle their arguments, a worker picks up its own
+        # instance instead of a fresh one per task
+        return shared_fragment_cache, (self.filename,)
+
+    def _check_process(self):
+        # A forked worker starts over with its own connection and counts, and
+        # doesn't write its parent's pending entries again
+        if self.pid == os.getpid():
+            return
+
+        self.pid = os.getpid()
+        if self._conn is not None:
+            _inherited.append(self._conn)
+            self._conn = None
+
+        self.hits = Counter()
+        self.misses = Counter()
+        self._pending = []
+        self._counted_hits = Counter()
+        self._counted_misses = Counter()
+
+    @property
+    def conn(self):
+        self._check_process()
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, timeout = 60.0)
+            # Readers don't block the writer, and the other way around
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.executescript(SCHEMA)
+
+        return self._conn
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM fragments").fetchone()[0]
+
+    def get(self, site, key):
+        """
+        (outcome, ItemVersion or None) for a fragment seen before, None if it
+        was not
+        """
+        self._check_process()
+        entry = self._memo.get(key)
+        if entry is None:
+            row = self.conn.execute("SELECT outcome, fields FROM fragments WHERE key = ?",
+                (sqlite3.Binary(key),)).fetchone()
+            if row is None:
+                self.misses[site] += 1
+                return None
+
+            outcome, fields = row
+            if fields is not None:
+                fields = pool_fields(cPickle.loads(str(fields)))
+            entry = self._remember(key, outcome, fields)
+
+        self.hits[site] += 1
+
+        outcome, fields = entry
+        if fields is None:
+            return outcome, None
+
+        itemv = ItemVersion.new()
+        itemv.update(copy_fields(fields))
+
+        return outcome, itemv
+
+    def put(self, site, key, outcome, itemv = None):
+        self._check_process()
+        fields = None if itemv is None else copy_fields(itemv)
+        self._remember(key, outcome, fields)
+        self._pending.append((sqlite3.Binary(key), site, outcome,
+            None if fields is None else sqlite3.Binary(cPickle.dumps(fields, cPickle.HIGHEST_PROTOCOL))))
+
+    def _remember(self, key, outcome, fields):
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo.clear()
+
+        entry = self._memo[key] = (outcome, fields)
+        return entry
+
+    def flush(self):
+        """
+        Write new fragments and the hits and misses since the last flush
+        """
+        self._check_process()
+        sites = set(self.hits) | set(self.misses)
+        counts = [(site, self.hits[site] - self._counted_hits[site], self.misses[site] - self._counted_misses[site])
+            for site in sites]
+        counts = [count for count in counts if count[1] or count[2]]
+
+        if not self._pending and not counts:
+            return
+
+        with self.conn:
+            # Another worker may have parsed the same fragment meanwhile
+            self.conn.executemany("INSERT OR IGNORE INTO fragments VALUES (?, ?, ?, ?)", self._pending)
+            for site, hits, misses in counts:
+                self.conn.execute("INSERT OR IGNORE INTO counts VALUES (?, 0, 0)", (site,))
+                self.conn.execute("UPDATE counts SET hits = hits + ?, misses = misses + ? WHERE site = ?",
+                    (hits, misses, site))
+
+        self._pending = []
+        self._counted_hits = Counter(self.hits)
+        self._counted_misses = Counter(self.misses)
+
+    def reset_counts(self):
+        """
+        Start counting hits and misses of a new run
+        """
+        self.flush()
+        with self.conn:
+            self.conn.execute("DELETE FROM counts")
+
+    def site_counts(self):
+        """
+        {site: (hits, misses)} of every process since reset_counts()
+        """
+        self.flush()
+        return dict((str(site), (hits, misses))
+            for site, hits, misses in self.conn.execute("SELECT site, hits, misses FROM counts"))
+
+def format_site_counts(counts):
+    lines = []
+    for site in sorted(counts):
+        hits, misses = counts[site]
+        total = hits + misses
+        lines.append("Fragment cache %s: %d of %d tooltips cached (%.1f%%)" % (site, hits, total,
+            100.0 * hits / total if total else 0.0))
+
+    return lines
@@ -0,0 +1,298 @@
+"""
+governor.py
+
+Keep a parse run under a memory budget instead of finding out from the OOM
+killer:
+
+    governor = MemoryGovernor(4 * 1024 ** 3, batch_size = 16)
+    parse_work_items(iter_work_items("waybackdump"), store, processes = 4, governor = governor)
+
+The governor samples the memory of this process and its worker processes
+every interval seconds, as proportional set size so pages shared with forked
+workers are not counted once per worker. Callers check it between units of
+work and it answers pressure in steps, logging each one:
+
+    above soft_limit of the budget   batches shrink by half and the store
+                                     releases memory, a ShardedItemStore
+                                     writing out and dropping resident shards
+    above hard_limit                 intake pauses until work in flight has
+                                     drained, then resumes even if still over.
+                                     A GovernedIntake instead ends the pool's
+                                     task stream, so its worker processes can
+                                     be replaced by fresh ones
+    below low_limit                  batches grow back by doubling
+
+batch_size is whatever the caller hands out at once: files per pool task in
+parser.py, item IDs per range in build_patch_difference.py --shard-size
+"""
+
+import itertools
+import logging
+import os
+import threading
+import time
+
+from collections import Counter
+
+logger = logging.getLogger()
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Seconds GovernedIntake waits at a time, between checks for close()
+ADMIT_WAIT = 0.1
+
+def process_memory(pid = "self"):
+    """
+    Proportional set size of a process in bytes, or its resident set size
+    where /proc has no smaps_rollup
+    """
+    try:
+        with open("/proc/%s/smaps_rollup" % (pid,)) as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    with open("/proc/%s/statm" % (pid,)) as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+def child_pids(pid = None):
+    """
+    IDs of the direct children of a process, this one by default
+    """
+    pid = os.getpid() if pid is None else pid
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open("/proc/%s/stat" % (name,)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+
+        # The command name is in parentheses and may hold spaces
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(name))
+
+    return children
+
+def tree_memory():
+    """
+    Memory of this process and its worker processes, in bytes
+    """
+    total = process_memory()
+    for pid in child_pids():
+        try:
+            total += process_memory(pid)
+        except IOError:
+            # Exited since it was listed
+            pass
+
+    return total
+
+def format_bytes(size):
+    return "%.1f MB" % (size / 1048576.0,)
+
+class MemoryGovernor(object):
+    def __init__(self, budget, soft_limit = 0.75, hard_limit = 0.9, low_limit = 0.5, interval = 0.5,
+            batch_size = 16, min_batch_size = 1, usage = tree_memory):
+        self.budget = budget
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.low_limit = low_limit
+        self.interval = interval
+
+        self.batch_size = batch_size
+        self.max_batch_size = batch_size
+        self.min_batch_size = max(1, min(min_batch_size, batch_size))
+
+        self.usage = usage
+
+        # Set while work may be taken in, cleared while paused
+        self.intake = threading.Event()
+        self.intake.set()
+
+        self.last_usage = 0
+        self.peak = 0
+        self.samples = 0
+        self.actions = Counter()
+        self._last_sample = None
+
+    @property
+    def paused(self):
+        return not self.intake.is_set()
+
+    @property
+    def over_soft_limit(self):
+        return self.last_usage >= self.soft_limit * self.budget
+
+    @property
+    def over_hard_limit(self):
+        return self.last_usage >= self.hard_limit * self.budget
+
+    def _act(self, action, message):
+        self.actions[action] += 1
+        logger.info("Memory %s of %s, %s" % (format_bytes(self.last_usage), format_bytes(self.budget), message))
+
+    def sample(self):
+        """
+        Sample memory without responding to it, returns the usage in bytes
+        """
+        self._last_sample = time.time()
+        self.last_usage = usage = self.usage()
+        self.peak = max(self.peak, usage)
+        self.samples += 1
+
+        return usage
+
+    def check(self, store = None, in_flight = 0, force = False):
+        """
+        Sample memory if interval has passed, or force is set, and respond to
+        it. Under pressure store.release() is called if the store has one,
+        returning the (shards, versions) it wrote to disk. in_flight is the
+        amount of work handed out and not done yet. Returns the last sampled
+        usage in bytes
+        """
+        if not force and self._last_sample is not None and time.time() - self._last_sample < self.interval:
+            return self.last_usage
+
+        usage = self.sample()
+
+        if self.over_soft_limit:
+            if self.batch_size > self.min_batch_size:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                self._act("shrink", "batch size down to %d" % (self.batch_size,))
+
+            release = getattr(store, "release", None)
+            if release is not None:
+                shards, versions = release()
+                if shards or versions:
+                    self._act("flush", "%d store shards and %d buffered versions written to disk" % (
+                        shards, versions))
+
+        if self.over_hard_limit and in_flight > 0:
+            if not self.paused:
+                self.intake.clear()
+                self._act("pause", "intake paused with %d in flight" % (in_flight,))
+        elif self.paused:
+            self.intake.set()
+            if self.over_hard_limit:
+                self._act("resume", "nothing in flight, intake resumed over the limit")
+            else:
+                self._act("resume", "intake resumed")
+
+        if usage < self.low_limit * self.budget and self.batch_size < self.max_batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+            self._act("grow", "batch size up to %d" % (self.batch_size,))
+
+        return usage
+
+    def summary(self):
+        return "Memory peak %s of %s budget, %s" % (format_bytes(self.peak), format_bytes(self.budget),
+            ", ".join("%d %s" % (self.actions[action], action) for action in sorted(self.actions)) or "no actions")
+
+class GovernedIntake(object):
+    """
+    Work items in lists of the governor's current batch size, as the task
+    iterable of a multiprocessing pool. A pool's feeder thread reads ahead
+    through all its tasks, so at most window lists are handed out before
+    done() is called for one, and none while the governor has intake paused.
+
+    Memory a worker process has grown to is not given back until it exits.
+    Once the governor is over its hard limit, iteration stops early with
+    recycle set, after at least one list, and the next iteration picks up
+    where it stopped. Replace the pool in between:
+
+        while True:
+            pool = multiprocessing.Pool(processes)
+            ... pool.imap_unordered(func, intake) ...
+            pool.close()
+            pool.join()
+            if not intake.recycle:
+                break
+            intake.recycled()
+
+    Call close() before terminating the pool. Pool.terminate() joins the
+    feeder thread, which may be waiting here for a done() that never comes
+    """
+    def __init__(self, governor, work_items, window):
+        self.governor = governor
+        self.work_items = iter(work_items)
+
+        self._slots = threading.Condition(threading.Lock())
+        self._free = window
+        self.in_flight = 0
+        self.closed = False
+
+        self.recycle = False
+        self.generations = 1
+        # Read but not handed out when iteration stopped for a recycle
+        self._batch = None
+
+    def _admit(self, handed_out):
+        """
+        Wait for a free slot and for intake to be open. False once closed, or
+        with recycle set once over the hard limit after handed_out lists
+        """
+        with self._slots:
+            while self._free <= 0 and not self.closed:
+                self._slots.wait(ADMIT_WAIT)
+
+        # Only the feeder thread takes slots, a free one stays free
+        while True:
+            if self.closed:
+                return False
+            if handed_out > 0 and self.governor.over_hard_limit:
+                self.recycle = True
+                return False
+            if self.governor.intake.wait(ADMIT_WAIT):
+                break
+
+        with self._slots:
+            self._free -= 1
+            self.in_flight += 1
+
+        return not self.closed
+
+    def done(self):
+        with self._slots:
+            self._free += 1
+            self.in_flight -= 1
+            self._slots.notify()
+
+    def recycled(self):
+        """
+        Call once the pool that stopped for a recycle is gone, before handing
+        this intake to the next one
+        """
+        self.recycle = False
+        self.generations += 1
+
+        # The old workers' memory was counted in the last sample. Only a
+        # sample, without them batches would grow straight back
+        self.governor.sample()
+        self.governor._act("recycle", "worker processes replaced, generation %d" % (self.generations,))
+
+    def close(self):
+        """
+        Stop handing out work and let a waiting feeder thread finish
+        """
+        self.closed = True
+        with self._slots:
+            self._slots.notify_all()
+        self.governor.intake.set()
+
+    def __iter__(self):
+        handed_out = 0
+        while True:
+            if self._batch is None:
+                self._batch = list(itertools.islice(self.work_items, self.governor.batch_size))
+            if not self._batch or not self._admit(handed_out):
+                return
+
+            batch, self._batch = self._batch, None
+            handed_out += 1
+            yield batch
@@ -0,0 +1,177 @@
+"""
+itemindex.py
+
+Secondary indexes over the parsed item history, so questions like "all Two-Hand
+weapons with required level 50-60 whose speed changed between 1.6 and 1.8" can
+be answered without walking the nested ItemStore dicts:
+
+    index = ItemHistoryIndex(load_parsed_json("parsed.json"))
+    two_handers = index.query(slot = "Two-Hand", requiredlevel = (50, 60))
+    result = two_handers & index.changed("speed", 106, 108)
+"""
+
+import bisect
+
+from items import *
+
+# Fields looked up by exact value through a hash index
+EQUALITY_FIELDS = ["slot", "itemType", "quality", "bonding", "spellId", "patch"]
+
+# Fields looked up by an inclusive (low, high) range through a sorted index
+RANGE_FIELDS = ["requiredlevel"]
+
+class ItemHistoryIndex(object):
+    """
+    Index entries are (item_id, patch) pairs, so predicates on different fields
+    are intersected per patch before being reduced to a set of item IDs
+    """
+    def __init__(self, item_store, equality_fields = None, range_fields = None):
+        self.item_store = item_store
+
+        self.equality_fields = equality_fields or EQUALITY_FIELDS
+        self.range_fields = range_fields or RANGE_FIELDS
+
+        # field -> value -> set of (item_id, patch)
+        self._equality = {}
+        # field -> ([sorted values], [(item_id, patch) at the same position])
+        self._range = {}
+        # item_id -> sorted patch levels, for "as of patch" lookups
+        self._patches = {}
+
+        self.build()
+
+    def build(self):
+        self._equality = dict((field, {}) for field in self.equality_fields)
+        self._range = {}
+        self._patches = {}
+
+        range_pairs = dict((field, []) for field in self.range_fields)
+
+        for item_id in self.item_store:
+            self._patches[item_id] = sorted(self.item_store[item_id].keys())
+
+            for patch in self.item_store[item_id]:
+                entry = (item_id, patch)
+
+                for itemv in self.item_store[item_id][patch]:
+                    for field in self.equality_fields:
+                        for value in self._field_values(itemv, field, patch):
+                            postings = self._equality[field].setdefault(value, set())
+                            postings.add(entry)
+
+                    for field in self.range_fields:
+                        for value in self._field_values(itemv, field, patch):
+                            range_pairs[field].append((value, entry))
+
+        for field in range_pairs:
+            range_pairs[field].sort()
+            values = [pair[0] for pair in range_pairs[field]]
+            entries = [pair[1] for pair in range_pairs[field]]
+            self._range[field] = (values, entries)
+
+    def _field_values(self, itemv, field, patch):
+        if field == "patch":
+            return [patch]
+
+        if field == "spellId":
+            return [effect["spellId"] for effect in itemv["effects"]]
+
+        if field in itemv and itemv[field] is not None:
+            return [itemv[field]]
+
+        return []
+
+    def _lookup(self, field, value):
+        # Set of matching (item_id, patch) entries for a single predicate
+        if field in self._range:
+            if not isinstance(value, tuple):
+                value = (value, value)
+
+            low, high = value
+            values, entries = self._range[field]
+
+            start = 0 if low is None else bisect.bisect_left(values, low)
+            end = len(values) if high is None else bisect.bisect_right(values, high)
+
+            return set(entries[start:end])
+
+        if field in self._equality:
+            # A list or set of values is an OR over them
+            if isinstance(value, (list, set, frozenset)):
+                matches = set()
+                for v in value:
+                    matches |= self._equality[field].get(v, set())
+                return matches
+
+            return self._equality[field].get(value, set())
+
+        raise KeyError("Field %s is not indexed" % (field,))
+
+    def query(self, **predicates):
+        """
+        Item IDs which have a patch where every predicate matches. Range fields
+        take a (low, high) tuple with None for an open end
+        """
+        if not predicates:
+            return set(self._patches.keys())
+
+        matches = [self._lookup(field, predicates[field]) for field in predicates]
+
+        # Intersect smallest first, the rest only need membership tests
+        matches.sort(key = len)
+        entries = matches[0]
+        for other in matches[1:]:
+            if not entries:
+                break
+            entries = entries & other
+
+        return set(entry[0] for entry in entries)
+
+    def patch_at(self, item_id, patch_level):
+        """
+        Latest patch with data for this item at or before patch_level, or None
+        """
+        patches = self._patches.get(item_id)
+        if not patches:
+            return None
+
+        pos = bisect.bisect_right(patches, patch_level)
+        if pos == 0:
+            return None
+
+        return patches[pos - 1]
+
+    def versions_at(self, item_id, patch_level):
+        patch = self.patch_at(item_id, patch_level)
+        if patch is None:
+            return set()
+
+        return self.item_store[item_id][patch]
+
+    def values_at(self, item_id, field, patch_level):
+        values = set()
+        for itemv in self.versions_at(item_id, patch_level):
+            if field in itemv:
+                values.add(itemv[field])
+
+        return values
+
+    def changed(self, field, from_patch, to_patch, item_ids = None):
+        """
+        Item IDs whose values for field differ between the versions known at
+        from_patch and to_patch. Items missing at either patch are not changed
+        """
+        if item_ids is None:
+            item_ids = self._patches.keys()
+
+        changed = set()
+        for item_id in item_ids:
+            from_values = self.values_at(item_id, field, from_patch)
+            if not from_values:
+                continue
+
+            to_values = self.values_at(item_id, field, to_patch)
+            if to_values and from_values != to_values:
+                changed.add(item_id)
+
+        return changed
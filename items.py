@@ -1,5 +1,7 @@
 import csv
+import hashlib
 import json
+import os
 import re
 
 # Core bonding enum, for auto updating of bonding type?
@@ -11,23 +13,142 @@ BIND_TYPES = {
     "BIND_QUEST_ITEM"                             : 4,
 }
 
-NAME_TO_ID_HASH = {}
-ID_TO_NAME_HASH = {}
-DB_ITEM_DATA = {}
-with open("item_db.csv", "rb") as f:
-    # entry, itemlevel, name, flags, class, quality, randomproperty
-    for row in csv.reader(f):
-        NAME_TO_ID_HASH[row[2]] = int(row[0])
-        ID_TO_NAME_HASH[int(row[0])] = row[2]
-
-        DB_ITEM_DATA[int(row[0])] = {
-            "name": row[2],
-            "itemlevel": int(row[1]),
-            "quest": int(row[4]) == 12,
-            "trade_good": int(row[4]) == 7,
-            "quality": int(row[5]),
-            "random_property": int(row[6])
-        }
+ITEM_DB_FILE = "item_db.csv"
+
+def _loading(name):
+    # dict method that fills the item_db.csv tables first
+    method = getattr(dict, name)
+
+    def wrapper(self, *args):
+        if not _ITEM_DB_STATE["loaded"]:
+            load_item_db()
+        return method(self, *args)
+
+    wrapper.__name__ = name
+    return wrapper
+
+class ItemDbTable(dict):
+    """
+    A lookup table from item_db.csv. The tables are only filled by load_item_db
+    on first use, so importing this module reads nothing
+    """
+    def __getitem__(self, key):
+        if not _ITEM_DB_STATE["loaded"]:
+            load_item_db()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if not _ITEM_DB_STATE["loaded"]:
+            load_item_db()
+        return dict.__contains__(self, key)
+
+    __iter__ = _loading("__iter__")
+    __len__ = _loading("__len__")
+    get = _loading("get")
+    has_key = _loading("has_key")
+    keys = _loading("keys")
+    values = _loading("values")
+    items = _loading("items")
+    iterkeys = _loading("iterkeys")
+    itervalues = _loading("itervalues")
+    iteritems = _loading("iteritems")
+    copy = _loading("copy")
+
+_ITEM_DB_STATE = { "loaded": False, "filename": None }
+
+NAME_TO_ID_HASH = ItemDbTable()
+ID_TO_NAME_HASH = ItemDbTable()
+DB_ITEM_DATA = ItemDbTable()
+
+def load_item_db(filename = None):
+    """
+    Fill the item_db.csv tables in place, so modules holding them through
+    "from items import *" see the data. Done on first use of a table, call it
+    again to reload. Without a filename, item_db.csv is read from the working
+    directory, or from next to this module
+    """
+    if filename is None:
+        filename = ITEM_DB_FILE
+        if not os.path.exists(filename):
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), ITEM_DB_FILE)
+
+    names, ids, data = {}, {}, {}
+    with open(filename, "rb") as f:
+        # entry, itemlevel, name, flags, class, quality, randomproperty
+        for row in csv.reader(f):
+            names[row[2]] = int(row[0])
+            ids[int(row[0])] = row[2]
+
+            data[int(row[0])] = {
+                "name": row[2],
+                "itemlevel": int(row[1]),
+                "quest": int(row[4]) == 12,
+                "trade_good": int(row[4]) == 7,
+                "quality": int(row[5]),
+                "random_property": int(row[6])
+            }
+
+    for table, values in ((NAME_TO_ID_HASH, names), (ID_TO_NAME_HASH, ids), (DB_ITEM_DATA, data)):
+        dict.clear(table)
+        dict.update(table, values)
+
+    _ITEM_DB_STATE["loaded"] = True
+    _ITEM_DB_STATE["filename"] = filename
+
+class StringPool(object):
+    """
+    Pool of shared strings, so the same tooltip, flavour text, slot or name seen
+    across thousands of snapshots is stored once and compares by identity.
+
+    Strings not looked up since the previous reset() are dropped on the next
+    one, so a long running process can keep the pool bounded
+    """
+    def __init__(self):
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def intern(self, value):
+        if value is None:
+            return None
+
+        pooled = self._current.get(value)
+        if pooled is not None:
+            return pooled
+
+        # Used again since the last reset, keep it another generation
+        pooled = self._previous.pop(value, value)
+        self._current[pooled] = pooled
+
+        return pooled
+
+    def reset(self):
+        self._previous = self._current
+        self._current = {}
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+STRING_POOL = StringPool()
+
+def pool_fields(fields):
+    """
+    Strings of fields unpickled or decoded from another process put back into
+    STRING_POOL, as the parser does. Interned in a worker they only share
+    storage until they are pickled
+    """
+    for key in ("name", "slot", "itemType", "flavour"):
+        if key in fields:
+            fields[key] = STRING_POOL.intern(fields[key])
+
+    if "effects" in fields:
+        fields["effects"] = [ItemSpell(effect["index"], effect["spellId"], STRING_POOL.intern(effect["tooltip"]))
+            for effect in fields["effects"]]
+
+    return fields
 
 def ItemNameToID(name):
     # go through item list, find name, return ID. Exact match for now
@@ -39,6 +160,45 @@ def ItemNameToID(name):
 
     return -1
 
+# Items ItemPatchData.filter throws away, decided from the item database alone
+def is_quest_item(entry):
+    return entry["quest"]
+
+def is_trade_good(entry):
+    return entry["trade_good"]
+
+def is_grey_item(entry):
+    return entry["quality"] == 0
+
+DISCARD_PREDICATES = {
+    "quest": is_quest_item,
+    "trade_good": is_trade_good,
+    "grey": is_grey_item
+}
+
+class ItemDatabaseFilter(object):
+    """
+    Discards items whose item_db.csv entry matches any of the predicates, so
+    their pages can be skipped before parsing. Items missing from the database
+    are always kept
+    """
+    def __init__(self, predicates = None):
+        if predicates is None:
+            predicates = DISCARD_PREDICATES.values()
+
+        self.predicates = list(predicates)
+
+    def discards(self, item_id):
+        entry = DB_ITEM_DATA.get(item_id)
+        if entry is None:
+            return False
+
+        for predicate in self.predicates:
+            if predicate(entry):
+                return True
+
+        return False
+
 def ItemHasRandomAffix(item_name):
     name = ItemRandomSuffixStrip(item_name)
     
@@ -92,6 +252,13 @@ def ItemRandomSuffixStrip(name):
     return item_name
 
 class ItemVersion(dict):
+    # (snapshot, site) the version was parsed from, when known. Not part of the
+    # item data, so it is neither hashed nor written to parsed.json
+    source = None
+
+    # Cached fingerprint(), cleared whenever a key is set or removed
+    _fingerprint = None
+
     def __init__(self, *args, **kwargs):
         super(ItemVersion, self).__init__(*args, **kwargs)
 
@@ -99,37 +266,98 @@ class ItemVersion(dict):
             self["conflicts"] = []
 
     def __hash__(self):
-        return id(json.dumps(self.hash_safe(), sort_keys = True))
+        # Versions differing only in flavour text hash the same and are told
+        # apart by dict equality
+        return hash(self.fingerprint())
+
+    def __setitem__(self, key, value):
+        self._fingerprint = None
+        super(ItemVersion, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._fingerprint = None
+        super(ItemVersion, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._fingerprint = None
+        super(ItemVersion, self).update(*args, **kwargs)
+
+    def pop(self, *args):
+        self._fingerprint = None
+        return super(ItemVersion, self).pop(*args)
+
+    def setdefault(self, key, default = None):
+        self._fingerprint = None
+        return super(ItemVersion, self).setdefault(key, default)
 
     def hash_safe(self):
         # Strip unnecessary keys from the dict for hashing so we can avoid
         # duplicates
         copy = self.copy()
-        del copy["flavour"]
-        del copy["conflicts"]
+        for key in FINGERPRINT_IGNORED:
+            copy.pop(key, None)
 
         return copy
 
-    def calculate_diff(self, other):
-        if not isinstance(other, ItemVersion):
-            raise RuntimeError("Cannot compare item diff between non-item")
+    def fingerprint(self):
+        """
+        Digest of the item data without flavour text, conflicts and patch. Cached
+        until a key is set, so resistances and effects have to be replaced
+        rather than changed in place once a fingerprint has been taken
+        """
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.md5(json.dumps(self.hash_safe(), sort_keys = True)).digest()
+
+        return self._fingerprint
 
-        diff = ItemVersionDifference()
+    def matches(self, other):
+        # Same item data, apart from flavour text, conflicts and patch
+        return self is other or self.fingerprint() == other.fingerprint()
 
+    def compare(self, other):
+        """
+        Bitmask of the DIFF_FIELDS that calculate_diff would report as changed
+        going from this version to other, 0 if there is nothing to report
+        """
+        if self.matches(other):
+            if self.get("flavour") != other.get("flavour"):
+                return FIELD_BITS["flavour"]
+            return 0
+
+        mask = 0
         for key in self:
             if key == "conflicts" or key == "patch":
                 continue
 
-            # Resists
-            if isinstance(self[key], dict):
-                for subkey in self[key]:
-                    diff.add_resist_diff(subkey, self, other)
-            elif key == "effects":
-                diff.add_effects_diff(key, self, other)
-            else:
-                diff.add_diff(key, self, other)
+            mine = self[key]
+            if key not in other:
+                mask |= FIELD_BITS.get(key, OTHER_FIELDS_BIT)
+                continue
+            theirs = other[key]
 
-        return diff
+            # Pooled strings are shared between versions, identity is the cheap check
+            if mine is theirs:
+                continue
+
+            if key == "effects":
+                # Only indexes 1-5 present on the other side are compared
+                for spell_index in range(1, min(6, len(theirs))):
+                    if spell_index >= len(mine) or mine[spell_index] != theirs[spell_index]:
+                        mask |= FIELD_BITS["effects"]
+                        break
+            elif mine != theirs:
+                mask |= FIELD_BITS.get(key, OTHER_FIELDS_BIT)
+
+        return mask
+
+    def diff_view(self, other):
+        if not isinstance(other, ItemVersion):
+            raise RuntimeError("Cannot compare item diff between non-item")
+
+        return ItemDiff(self, other)
+
+    def calculate_diff(self, other):
+        return self.diff_view(other).materialize()
 
     @classmethod
     def new(cls):
@@ -164,6 +392,119 @@ class ItemVersion(dict):
                 "trade_good": False
             })
 
+# Defaults for fields a version never set
+_VERSION_DEFAULTS = ItemVersion.new()
+
+# Left out of fingerprints, so versions differing only in these match
+FINGERPRINT_IGNORED = ["flavour", "conflicts", "patch"]
+
+# Fields compared by ItemVersion.compare, one bit each in the change mask. Any
+# other key shares a single bit
+DIFF_FIELDS = sorted(key for key in _VERSION_DEFAULTS if key != "conflicts")
+FIELD_BITS = dict((key, 1 << i) for i, key in enumerate(DIFF_FIELDS))
+OTHER_FIELDS_BIT = 1 << len(DIFF_FIELDS)
+
+def field_mask(fields):
+    mask = 0
+    for field in fields:
+        mask |= FIELD_BITS.get(field, OTHER_FIELDS_BIT)
+
+    return mask
+
+class ItemDiff(object):
+    """
+    Changes going from one version to another. The change mask is computed up
+    front and is enough to tell whether anything changed. The diff itself,
+    an ItemVersionDifference in the calculate_diff format, is only built from
+    the changed fields when it is first read
+    """
+    def __init__(self, me, other):
+        self.me = me
+        self.other = other
+        self.mask = me.compare(other)
+
+        self._diff = None
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    def changed(self, ignored = 0):
+        # True if anything outside the ignored field mask changed
+        return (self.mask & ~ignored) != 0
+
+    def materialize(self):
+        if self._diff is not None:
+            return self._diff
+
+        me, other, mask = self.me, self.other, self.mask
+
+        # Always present in calculate_diff output, even when empty
+        diff = ItemVersionDifference.blank()
+
+        # Fields the version lacks keep their defaults
+        for key in _VERSION_DEFAULTS:
+            if key not in me:
+                value = _VERSION_DEFAULTS[key]
+                if isinstance(value, (dict, list)):
+                    value = type(value)(value)
+                dict.__setitem__(diff, key, value)
+
+        for key in me:
+            if key == "conflicts" or key == "patch":
+                continue
+
+            if isinstance(me[key], dict):
+                # Unchanged schools are left out, ones the version lacks stay at 0
+                resistances = diff["resistances"]
+                for subkey in _VERSION_DEFAULTS["resistances"]:
+                    if subkey not in me[key]:
+                        resistances[subkey] = 0
+
+                for subkey in me[key]:
+                    if mask & FIELD_BITS["resistances"] and \
+                            me["resistances"][subkey] != other["resistances"][subkey]:
+                        resistances[subkey] = other["resistances"][subkey]
+
+            elif key == "effects":
+                if mask & FIELD_BITS["effects"]:
+                    diff.add_effects_diff(key, me, other)
+
+            elif key not in other:
+                if key not in _VERSION_DEFAULTS:
+                    continue
+                dict.__setitem__(diff, key, _VERSION_DEFAULTS[key])
+
+            elif key not in _VERSION_DEFAULTS or mask & FIELD_BITS[key]:
+                # Non-standard keys are always reported, as calculate_diff did
+                if key in _VERSION_DEFAULTS and (me[key] is other[key] or me[key] == other[key]):
+                    continue
+                dict.__setitem__(diff, key, other[key])
+
+        self._diff = diff
+        return diff
+
+    # Read-only mapping over the materialized diff
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __contains__(self, key):
+        return key in self.materialize()
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def keys(self):
+        return self.materialize().keys()
+
+    def iteritems(self):
+        return self.materialize().iteritems()
+
+    def __repr__(self):
+        return repr(self.materialize())
+
 class ItemVersionDifference(ItemVersion):
     def __init__(self, *args, **kwargs):
         super(ItemVersionDifference, self).__init__(*args, **kwargs)
@@ -173,6 +514,14 @@ class ItemVersionDifference(ItemVersion):
         for key in tmp:
             self[key] = tmp[key]
 
+    @classmethod
+    def blank(cls):
+        # Only the keys every diff has, for ItemDiff to fill with changed fields
+        diff = cls.__new__(cls)
+        dict.update(diff, conflicts = [], resistances = {}, effects = [])
+
+        return diff
+
     def add_diff(self, key, me, other):
         # Ignore values which are the same
         if key in me and key not in other:
@@ -181,7 +530,8 @@ class ItemVersionDifference(ItemVersion):
         if key not in me and key in other:
             self[key] = other[key]
 
-        elif me[key] == other[key] and key in self:
+        # Pooled strings are shared between versions, identity is the cheap check
+        elif (me[key] is other[key] or me[key] == other[key]) and key in self:
             del self[key]
         
         else:
@@ -195,18 +545,19 @@ class ItemVersionDifference(ItemVersion):
         self["resistances"][subkey] = other["resistances"][subkey]
 
     def add_effects_diff(self, key, me, other):
-        for spell_index in range(1,6):
+        # Indexes 1-5, only as far as the other side has effects
+        for spell_index in range(1, min(6, len(other[key]))):
             if spell_index >= len(me[key]):
                 my_effect = None
             else:
                 my_effect = me[key][spell_index]
 
-            if spell_index >= len(other[key]):
-                other_effect = None
-            else:
-                other_effect = other[key][spell_index]
+            other_effect = other[key][spell_index]
+            if my_effect is other_effect:
+                continue
 
-            if my_effect != other_effect and other_effect is not None:
+            # Dict comparison checks identity of the pooled tooltips first
+            if my_effect != other_effect:
                 self[key].append(ItemSpell(spell_index, other_effect["spellId"], other_effect["tooltip"]))
 
 
@@ -227,27 +578,303 @@ class ItemStore(dict):
             self[item_id] = {}
 
         if patchLevel not in self[item_id]:
-            self[item_id][patchLevel] = set()
+            self[item_id][patchLevel] = []
 
-        self[item_id][patchLevel].add(item)
+        # A list, identical versions from different snapshots are kept so
+        # build_item_concensus can count them
+        self[item_id][patchLevel].append(item)
 
     def merge_into(self, base):
         """
         Merges data in this store into the base store, without overwriting anything
         """
         for item_id in self:
-            # speedup, just assign full value if not existing
-            if item_id not in base:
-                base[item_id] = self[item_id]
+            base.merge_item(item_id, self[item_id])
+
+    def merge_item(self, item_id, patches):
+        """
+        Merges the patches of one item into this store, without overwriting anything
+        """
+        # speedup, just assign full value if not existing
+        if item_id not in self:
+            self[item_id] = patches
+            return
+
+        for patch in patches:
+            # Another speedup
+            if patch not in self[item_id]:
+                self[item_id][patch] = patches[patch]
                 continue
 
-            for patch in self[item_id]:
-                # Another speedup
-                if patch not in base[item_id]:
-                    base[item_id][patch] = self[item_id][patch]
-                    continue
+            for item_version in patches[patch]:
+                # if we hit here then item_id and patch are both in the store, and
+                # therefore we have a new version of the item at this patch level
+                self[item_id][patch].append(item_version)
+
+# Enable json serialization of the item sets
+class CustomEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if (isinstance(obj, set)):
+            return list(obj)
+
+        if isinstance(obj, ItemDiff):
+            return obj.materialize()
+
+        return json.JSONEncoder.default(self, obj)
+
+def parsed_index_filename(filename):
+    return filename + ".idx"
+
+# Item IDs per bucket, the top level of the fingerprint tree
+FINGERPRINT_BUCKET_SIZE = 1000
+
+# Bytes hashed at each end of a parsed.json to tell rewrites of the same size apart
+FINGERPRINT_SAMPLE_SIZE = 65536
+
+def parsed_fingerprint_filename(filename):
+    return filename + ".fp"
+
+def parsed_file_signature(filename):
+    """
+    {"size", "mtime", "sample"} of a parsed.json, sample being a hash of its
+    first and last FINGERPRINT_SAMPLE_SIZE bytes
+    """
+    size = os.path.getsize(filename)
+    sample = hashlib.md5()
+    with open(filename, "rb") as f:
+        sample.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+        if size > FINGERPRINT_SAMPLE_SIZE:
+            f.seek(max(FINGERPRINT_SAMPLE_SIZE, size - FINGERPRINT_SAMPLE_SIZE))
+            sample.update(f.read())
+
+    return {"size": size, "mtime": os.path.getmtime(filename), "sample": sample.hexdigest()}
+
+def _combine_hashes(hashes):
+    return hashlib.md5("".join(hashes)).hexdigest()
+
+# sort_keys would rule out the C encoder, keys are sorted by _content_hash instead
+_CONTENT_ENCODER = CustomEncoder()
+
+def _content_hash(itemv):
+    # resistances and effects are the only nested dicts parsers fill in
+    content = dict(itemv)
+    if "resistances" in content:
+        content["resistances"] = sorted(content["resistances"].iteritems())
+    if "effects" in content:
+        content["effects"] = [sorted(effect.iteritems()) for effect in content["effects"]]
+
+    return hashlib.md5(_CONTENT_ENCODER.encode(sorted(content.iteritems()))).hexdigest()
+
+def item_fingerprints(patches):
+    """
+    (item hash, {patch: version set hash}) for an item's {patch: versions}.
+    Unlike ItemVersion.fingerprint every parsed field counts, flavour included,
+    and a set hash covers each version, repeats included
+    """
+    patch_hashes = {}
+    for patch in patches:
+        patch_hashes[patch] = _combine_hashes(sorted(_content_hash(itemv) for itemv in patches[patch]))
+
+    item_hash = _combine_hashes("%s:%s" % (patch, patch_hashes[patch]) for patch in sorted(patch_hashes))
+    return item_hash, patch_hashes
+
+def write_fingerprint_tree(fingerprints, filename, signature, bucket_size = FINGERPRINT_BUCKET_SIZE):
+    """
+    Write {item_id: item_fingerprints(...)} as a three level tree: a header
+    line with the root hash, and the hash, offset and length of every item ID
+    bucket, then one line per bucket with its item and version set hashes.
+    signature is the parsed_file_signature of the parsed.json the tree describes
+    """
+    buckets = {}
+    for item_id in fingerprints:
+        buckets.setdefault(item_id // bucket_size, []).append(item_id)
+
+    lines = []
+    entries = []
+    offset = 0
+    for bucket_id in sorted(buckets):
+        item_ids = sorted(buckets[bucket_id])
+        line = json.dumps([[item_id, fingerprints[item_id][0], fingerprints[item_id][1]]
+            for item_id in item_ids]) + "\n"
+        bucket_hash = _combine_hashes("%d:%s" % (item_id, fingerprints[item_id][0]) for item_id in item_ids)
+
+        entries.append([bucket_id, bucket_hash, offset, len(line)])
+        lines.append(line)
+        offset += len(line)
+
+    header = {
+        "size": signature["size"],
+        "mtime": signature["mtime"],
+        "sample": signature["sample"],
+        "bucket_size": bucket_size,
+        "root": _combine_hashes("%d:%s" % (entry[0], entry[1]) for entry in entries),
+        "buckets": entries
+    }
+
+    with open(filename + ".tmp", "wb") as f:
+        f.write(json.dumps(header) + "\n")
+        for line in lines:
+            f.write(line)
+    os.rename(filename + ".tmp", filename)
+
+class FingerprintTree(object):
+    """
+    Reader for a fingerprint tree file. The header is read up front, buckets
+    are read on request
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, "rb") as f:
+            header = json.loads(f.readline())
+            self._body_offset = f.tell()
+
+        self.size = header["size"]
+        # Trees written before these were recorded never match
+        self.mtime = header.get("mtime")
+        self.sample = header.get("sample")
+        self.bucket_size = header["bucket_size"]
+        self.root = header["root"]
+
+        # bucket_id -> (hash, offset, length)
+        self.buckets = dict((entry[0], tuple(entry[1:])) for entry in header["buckets"])
+        self.buckets_read = 0
+
+    def describes(self, filename):
+        """
+        Whether the tree was written for filename as it is now. The size alone
+        misses a rewrite that keeps the byte length
+        """
+        signature = parsed_file_signature(filename)
+        return (self.size, self.mtime, self.sample) == (signature["size"], signature["mtime"], signature["sample"])
+
+    def bucket(self, bucket_id):
+        """
+        {item_id: (item hash, {patch: version set hash})} for one bucket
+        """
+        if bucket_id not in self.buckets:
+            return {}
+
+        bucket_hash, offset, length = self.buckets[bucket_id]
+        with open(self.filename, "rb") as f:
+            f.seek(self._body_offset + offset)
+            entries = json.loads(f.read(length))
+        self.buckets_read += 1
+
+        # json has no int keys
+        return dict((item_id, (item_hash, dict((int(patch), patch_hash) for patch, patch_hash in patches.iteritems())))
+            for item_id, item_hash, patches in entries)
+
+def dump_parsed_json(item_store, filename, write_index = True, write_fingerprints = True):
+    """
+    Write the store as parsed.json, one item at a time so a sharded store is
+    never fully resident. Unless disabled, a sidecar index with the byte offset
+    and length of every item's value is written next to it for load_parsed_items,
+    and a fingerprint tree for comparing parse runs
+    """
+    encoder = CustomEncoder()
+    index = []
+    fingerprints = {}
+
+    with open(filename, "wb") as f:
+        f.write("{")
+        for count, item_id in enumerate(item_store):
+            if count > 0:
+                f.write(", ")
+            f.write(encoder.encode(str(item_id)) + ": ")
+
+            patches = item_store[item_id]
+            value = encoder.encode(patches)
+            index.append([item_id, f.tell(), len(value)])
+            f.write(value)
+
+            if write_fingerprints:
+                fingerprints[item_id] = item_fingerprints(patches)
+        f.write("}")
+
+    signature = parsed_file_signature(filename)
+
+    if write_index:
+        index_filename = parsed_index_filename(filename)
+        with open(index_filename + ".tmp", "wb") as f:
+            json.dump(dict(signature, items = index), f)
+        os.rename(index_filename + ".tmp", index_filename)
+
+    if write_fingerprints:
+        write_fingerprint_tree(fingerprints, parsed_fingerprint_filename(filename), signature)
+
+def _intern_values(obj):
+    # json object_hook, so repeated strings of every decoded dict share one copy
+    for key in obj:
+        if isinstance(obj[key], basestring):
+            obj[key] = STRING_POOL.intern(obj[key])
+
+    return obj
+
+def _add_parsed_item(item_data, item_id, patches):
+    # Convert unicode keys back to int, json has no int keys
+    for patch_level in patches:
+        for itemv in patches[patch_level]:
+            item_data.add_item(int(item_id), int(patch_level), ItemVersion(itemv))
+
+def load_parsed_json(filename, intern_strings = True):
+    """
+    Load the parse output written by parser.py back into an ItemStore
+    """
+    item_data = ItemStore()
+
+    with open(filename, "rb") as f:
+        if intern_strings:
+            tmp = json.load(f, object_hook = _intern_values)
+        else:
+            tmp = json.load(f)
+
+    for item_id in tmp:
+        _add_parsed_item(item_data, item_id, tmp[item_id])
+
+    return item_data
+
+def load_parsed_items(filename, item_ids = None, id_range = None, intern_strings = True):
+    """
+    Load only the given item IDs and/or the (low, high) item ID range, high
+    exclusive, from parsed.json. Each item is read through the sidecar index
+    written by dump_parsed_json. Without an index, or with one that does not
+    match the file, the whole file is loaded and filtered
+    """
+    def wanted(item_id):
+        if item_ids is not None and item_id in item_ids:
+            return True
+        if id_range is not None and id_range[0] <= item_id < id_range[1]:
+            return True
+        return False
+
+    item_data = ItemStore()
+    object_hook = _intern_values if intern_strings else None
+
+    index = None
+    try:
+        with open(parsed_index_filename(filename), "rb") as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    # The size alone misses a rewrite that keeps the byte length, indexes
+    # written before the signature was recorded never match
+    signature = parsed_file_signature(filename)
+    if index is None or any(index.get(key) != signature[key] for key in signature):
+        full = load_parsed_json(filename, intern_strings)
+        for item_id in full:
+            if wanted(item_id):
+                item_data[item_id] = full[item_id]
+        return item_data
+
+    with open(filename, "rb") as f:
+        # In file order, so reads move forward through the file
+        for item_id, offset, length in sorted(index["items"], key = lambda entry: entry[1]):
+            if not wanted(item_id):
+                continue
+
+            f.seek(offset)
+            _add_parsed_item(item_data, item_id, json.loads(f.read(length), object_hook = object_hook))
 
-                for item_version in self[item_id][patch]:
-                    # if we hit here then item_id and patch are both in the base, and
-                    # therefore we have a new version of the item at this patch level
-                    base[item_id][patch].add(item_version)
+    return item_data
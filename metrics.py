@@ -0,0 +1,146 @@
+"""
+metrics.py
+
+Thread safe counters and latency histograms for the downloader, written out
+periodically as JSON or Prometheus text so a running dump can be watched
+"""
+
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds, the last bucket catches everything
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf")]
+
+class Histogram(object):
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return self.buckets[-1]
+
+class MetricsRegistry(object):
+    """
+    Counters and histograms keyed by name and a sorted tuple of label pairs
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+        self.started = time.time()
+
+    def inc(self, name, amount = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def get(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name):
+        # Sum of a counter over all its labels
+        with self._lock:
+            return sum(value for (key, labels), value in self._counters.items() if key == name)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())]
+
+            histograms = []
+            for (name, labels), hist in sorted(self._histograms.items()):
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": hist.count,
+                    "sum": hist.total,
+                    "p50": hist.quantile(0.5),
+                    "p95": hist.quantile(0.95),
+                    "buckets": [[bound if bound != float("inf") else "+Inf", count]
+                        for bound, count in zip(hist.buckets, hist.counts)]
+                })
+
+        return {
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "histograms": histograms
+        }
+
+    def to_prometheus(self):
+        def format_labels(labels, extra = None):
+            pairs = sorted(labels.items()) + (extra or [])
+            if not pairs:
+                return ""
+            return "{%s}" % (",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in pairs),)
+
+        lines = []
+        snapshot = self.snapshot()
+
+        for counter in snapshot["counters"]:
+            lines.append("%s%s %s" % (counter["name"], format_labels(counter["labels"]), counter["value"]))
+
+        for hist in snapshot["histograms"]:
+            cumulative = 0
+            for bound, count in hist["buckets"]:
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (hist["name"],
+                    format_labels(hist["labels"], [("le", bound)]), cumulative))
+            lines.append("%s_sum%s %f" % (hist["name"], format_labels(hist["labels"]), hist["sum"]))
+            lines.append("%s_count%s %d" % (hist["name"], format_labels(hist["labels"]), hist["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, format = "json"):
+        """
+        Rewrite the metrics file atomically, readers never see a partial file
+        """
+        if format == "prometheus":
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent = 1, sort_keys = True)
+
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(content)
+        os.rename(tmp_filename, filename)
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
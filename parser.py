@@ -5,13 +5,38 @@ Parse all downloaded wayback item records and store them in an easy to read
 JSON object
 """
 
+import argparse
+import functools
+import gzip
+import io
+import multiprocessing
 import os
 import re
 import json
+import logging
 import traceback
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from archiveparser import *
 from items import *
+from serializers import SERIALIZERS, dump_store, load_store
+from fragmentcache import FragmentCache, format_site_counts
+from governor import GovernedIntake, MemoryGovernor
+from quarantine import GuardedWorkerPool, QuarantineManifest
+from shardstore import ShardedItemStore
+from sqlitestore import SqliteItemDatabase
 
 from bs4 import BeautifulSoup
 
@@ -31,6 +56,9 @@ WOW_DB_DIRS = {
     }
 }
     
+# Parser classes by name, for work items read back from a quarantine manifest
+PARSERS = dict((db["parser"].__name__, db["parser"]) for db in WOW_DB_DIRS.values())
+
 # 2004 format is just butchered HTML, not clean to parse with the rest
 def getItemData2004(item_div):
     pass
@@ -61,105 +89,486 @@ def getPatchLevel(snapshot):
     else:
         return 112 # 1.12
 
-def parse_directory(directory, patchLevel, parser):
-    # Dict of all items parsed in this directory, similar to the top-level items. merge after each parse
-    # Walk over each item in the snapshot - can be multiple items in a single snap
-
-    tmp = ItemStore()
-    for item_snapshot in os.listdir(directory):
-        file_path = os.path.join(directory, item_snapshot)
-        print file_path
-        if os.path.isdir(file_path):
-            # Subdirectory, parse recursively and merge
-            parse_directory(file_path, patchLevel, parser).merge_into(tmp)
+def list_entries(directory):
+    """
+    Yield (name, path, is_dir) for each entry in a directory. With scandir the
+    file type comes from the listing itself, saving a stat call per entry
+    """
+    if scandir is not None:
+        for entry in scandir(directory):
+            yield entry.name, entry.path, entry.is_dir()
+        return
+
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        yield name, path, os.path.isdir(path)
+
+def iter_directory_files(directory):
+    # Iterative walk with an explicit stack, Thottbot and Allakhazam paths nest deep
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        for name, path, is_dir in list_entries(current):
+            if is_dir:
+                pending.append(path)
+            elif not name.endswith(".part"):
+                # .part files are downloads still in progress
+                yield path
+
+def iter_work_items(dump_dir):
+    """
+    Yield a (path, patchLevel, parser, source) work item for every file to parse
+    in the dump directory. source is the (snapshot, site) the file belongs to
+    """
+    for snapshot, snapshot_dir, is_dir in list_entries(dump_dir):
+        # Skip non-snapshot directories in current working dir
+        if not is_dir:
+            continue
+
+        # Ignore snapshots from before 2004 or after 2006
+        s_year = int(snapshot[0:4])
+        if s_year < 2004 or s_year >= 2007:
             continue
 
-        with open(file_path, "rb") as fitem:
-            # Parse the HTML file
-            soup = BeautifulSoup(fitem.read(), "html.parser")
+        patchLevel = getPatchLevel(snapshot)
+
+        for db in WOW_DB_DIRS:
+            item_dir = os.path.join(snapshot_dir, db)
+            if os.path.isdir(item_dir):
+                parser = WOW_DB_DIRS[db]["parser"]
+
+                for file_path in iter_directory_files(item_dir):
+                    yield file_path, patchLevel, parser, (snapshot, db)
+
+def work_item_for_path(dump_dir, file_path):
+    """
+    Work item for a single file under the dump directory, or None if it is not
+    a page we parse. Used for files that show up one at a time
+    """
+    relative = os.path.relpath(file_path, dump_dir).split(os.sep)
+    if len(relative) < 3 or relative[1] not in WOW_DB_DIRS:
+        return None
+
+    snapshot, db = relative[0], relative[1]
+    if not snapshot.isdigit():
+        return None
+
+    # Ignore snapshots from before 2004 or after 2006
+    s_year = int(snapshot[0:4])
+    if s_year < 2004 or s_year >= 2007:
+        return None
+
+    return file_path, getPatchLevel(snapshot), WOW_DB_DIRS[db]["parser"], (snapshot, db)
+
+def item_id_from_filename(item_snapshot):
+    # Allakhazam item pages carry the item ID in the file name, witem=1234-item.html
+    if "witem=" in item_snapshot:
+        return int(item_snapshot.split("=")[1].split("-")[0])
+
+    return None
+
+def filter_work_items(work_items, item_filter, stats = None):
+    """
+    Drop work items for pages of a single item the filter discards, before they
+    are read at all. stats, if given, counts the skipped files and bytes
+    """
+    for work_item in work_items:
+        item_id = item_id_from_filename(os.path.basename(work_item[0]))
+        if item_id is not None and item_filter.discards(item_id):
+            if stats is not None:
+                stats["skipped_files"] = stats.get("skipped_files", 0) + 1
+                stats["skipped_bytes"] = stats.get("skipped_bytes", 0) + os.path.getsize(work_item[0])
+            continue
 
-            parser_instance = parser(soup)
+        yield work_item
+
+GZIP_MAGIC = "\x1f\x8b"
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd"
+
+def read_page(file_path):
+    """
+    Content of a downloaded page. Pages written with download.py --compress are
+    recognised by their magic bytes, so plain and compressed dumps can be mixed
+    """
+    with open(file_path, "rb") as f:
+        content = f.read()
+
+    if content.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj = io.BytesIO(content)).read()
+
+    if content.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("%s is zstd compressed, install the zstandard package" % (file_path,))
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+
+    return content
+
+def parse_file(file_path, patchLevel, parser, source = None, item_filter = None, stats = None,
+        fragment_cache = None):
+    """
+    Parse a single archived page, returning a list of (item_id, patchLevel, item).
+    stats, if given, counts the page's tooltips: items kept, no_name, no_id,
+    discarded and quality_N per quality class. Tooltips found in fragment_cache
+    are not parsed again, new ones are written to it at the end of the page
+    """
+    print file_path
+
+    directory, item_snapshot = os.path.split(file_path)
+    parsed = []
+
+    file_item_id = item_id_from_filename(item_snapshot)
+    if file_item_id is not None and item_filter is not None and item_filter.discards(file_item_id):
+        return parsed
+
+    # Parse the HTML file
+    soup = BeautifulSoup(read_page(file_path), "html.parser")
+
+    parser_instance = parser(soup, item_filter, fragment_cache, file_item_id)
+    try:
+        parser_instance.parse()
+    except:
+        print "Exception processing item - dir: %s, snapshot: %s" % (directory, item_snapshot)
+        raise
+
+    if fragment_cache is not None:
+        fragment_cache.flush()
+
+    # The tree is all reference cycles, left to the garbage collector the
+    # trees of several pages pile up. decompose() on the soup itself doesn't
+    # unlink its children
+    for tag in soup.find_all(recursive = False):
+        tag.decompose()
+    soup.decompose()
+
+    for item in parser_instance.items:
+        try:
+            if file_item_id is not None:
+                item_id = file_item_id
+            else:
+                item_id = ItemNameToID(item["name"])
+
+                # of the Boar, of the Eagle, etc
+                if item_id < 0 and item["name"] is not None:
+                    try:
+                        item_id = ItemNameToID(item["name"])
+                    except ValueError:
+                        pass
+
+            if item_id < 0:
+                print "Item %s has no ID (%s @ %s)" % (item["name"], item_snapshot, directory)
+                if stats is not None:
+                    stats["no_id"] = stats.get("no_id", 0) + 1
+                continue
+
+            # fix item quality, 0-5
+            item["quality"] = parser_instance.get_quality(item["quality"])
+
+            # Some unequippable item that we don't care about, likely from crafting
+            # or disenchant info?
+            #if not item["slot"]:
+            #    continue
+
+            item.source = source
+            parsed.append((item_id, patchLevel, item))
+
+            if stats is not None:
+                quality = "quality_%d" % (item["quality"],)
+                stats[quality] = stats.get(quality, 0) + 1
+        except Exception as e:
+            print "Exception handling processed item"
+            pprint(item)
+            traceback.print_exc()
+
+    if stats is not None:
+        stats["items"] = stats.get("items", 0) + len(parsed)
+        stats["no_name"] = stats.get("no_name", 0) + parser_instance.unnamed
+        stats["discarded"] = stats.get("discarded", 0) + parser_instance.discarded
+
+    return parsed
+
+def _parse_work_item(work_item, item_filter = None, fragment_cache = None):
+    return parse_file(*work_item, item_filter = item_filter, fragment_cache = fragment_cache)
+
+def _parse_work_chunk(work_items, item_filter = None, fragment_cache = None):
+    parsed = []
+    for work_item in work_items:
+        parsed.extend(parse_file(*work_item, item_filter = item_filter, fragment_cache = fragment_cache))
+
+    return parsed
+
+def _add_pooled(store, parsed):
+    # Strings a worker interned arrive as copies of their own, they are pooled
+    # again here so versions from every worker share them
+    for item_id, patchLevel, item in parsed:
+        pool_fields(item)
+        store.add_item(item_id, patchLevel, item)
+
+def parse_work_items(work_items, store = None, processes = 1, item_filter = None, stats = None,
+        quarantine = None, time_budget = None, catalog = None, governor = None, fragment_cache = None):
+    """
+    Single consumer for a stream of work items, every parsed version is added
+    straight into one store. With processes > 1 the files are parsed by a pool
+    and the results still funnel into the same store.
+
+    With a quarantine manifest, every file is parsed in an isolated worker
+    process: failures, crashes and files running past time_budget seconds
+    are recorded in the manifest and the run keeps going.
+
+    With a refreshed catalog.SnapshotCatalog and several processes, the work
+    items are read up front and handed out largest first, in chunks of
+    shrinking cost for the pool.
+
+    With a governor.MemoryGovernor, memory is checked as results come in.
+    The pool is fed batches of the governor's batch size, a few per process,
+    and the store is asked to release memory under pressure. Over the hard
+    limit the pool is replaced, so memory held by its workers is given back.
+
+    With a fragmentcache.FragmentCache, every process looks tooltips up in
+    the same cache file and only parses the ones not in it
+    """
+    if store is None:
+        store = ItemStore()
+
+    if item_filter is not None:
+        work_items = filter_work_items(work_items, item_filter, stats)
+
+    if catalog is not None and processes > 1:
+        if quarantine is not None or governor is not None:
+            work_items = catalog.largest_files_first(work_items)
+        else:
+            work_items = catalog.cost_balanced_chunks(work_items, processes)
+
+    if quarantine is not None:
+        pool = GuardedWorkerPool(functools.partial(_parse_work_item, item_filter = item_filter,
+            fragment_cache = fragment_cache),
+            processes, time_budget)
+
+        for work_item, parsed, error in pool.imap_unordered(work_items):
+            if error is not None:
+                print "Quarantined %s: %s" % (work_item[0], error.strip().splitlines()[-1])
+                quarantine.add(work_item, error)
+                quarantine.save()
+                continue
+
+            # Parsed fine, possibly a retry after a parser fix
+            if work_item[0] in quarantine.entries:
+                quarantine.remove(work_item[0])
+                quarantine.save()
+
+            _add_pooled(store, parsed)
+
+            if governor is not None:
+                governor.check(store)
+
+    elif processes > 1 and governor is not None:
+        intake = GovernedIntake(governor, work_items, processes * 2)
+        while True:
+            pool = multiprocessing.Pool(processes)
             try:
-                parser_instance.parse()
+                results = pool.imap_unordered(functools.partial(_parse_work_chunk, item_filter = item_filter,
+                    fragment_cache = fragment_cache), intake)
+                while True:
+                    try:
+                        parsed = results.next(governor.interval)
+                    except multiprocessing.TimeoutError:
+                        governor.check(store, intake.in_flight)
+                        continue
+                    except StopIteration:
+                        break
+
+                    intake.done()
+                    _add_pooled(store, parsed)
+                    governor.check(store, intake.in_flight)
+                pool.close()
             except:
-                print "Exception processing item - dir: %s, snapshot: %s" % (directory, item_snapshot)
+                intake.close()
+                pool.terminate()
                 raise
+            finally:
+                pool.join()
+
+            # Over the hard limit, start over with fresh workers
+            if not intake.recycle:
+                break
+            intake.recycled()
+
+    elif processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            if catalog is not None:
+                results = pool.imap_unordered(functools.partial(_parse_work_chunk, item_filter = item_filter,
+                    fragment_cache = fragment_cache), work_items)
+            else:
+                results = pool.imap_unordered(functools.partial(_parse_work_item, item_filter = item_filter,
+                    fragment_cache = fragment_cache), work_items, chunksize = 16)
+            for parsed in results:
+                _add_pooled(store, parsed)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for work_item in work_items:
+            for item_id, patchLevel, item in parse_file(*work_item, item_filter = item_filter,
+                    fragment_cache = fragment_cache):
+                store.add_item(item_id, patchLevel, item)
 
-            for item in parser_instance.items:
-                try:
-                    if "witem=" in item_snapshot:
-                        item_id = int(item_snapshot.split("=")[1].split("-")[0])
-                    else:
-                        item_id = ItemNameToID(item["name"])
+            if governor is not None:
+                governor.check(store)
 
-                        # of the Boar, of the Eagle, etc
-                        if item_id < 0 and item["name"] is not None:
-                            try:
-                                item_id = ItemNameToID(item["name"])
-                            except ValueError:
-                                pass
+    # One pool generation per run, strings no run has seen since the previous
+    # one are dropped. Keeps the pool bounded in the service's repeated runs
+    STRING_POOL.reset()
 
-                    if item_id < 0:
-                        print "Item %s has no ID (%s @ %s)" % (item["name"], item_snapshot, directory)
-                        continue
+    return store
+
+def parse_directory(directory, patchLevel, parser, source = None, item_filter = None):
+    # All items parsed in this directory and its subdirectories
+    work_items = ((file_path, patchLevel, parser, source) for file_path in iter_directory_files(directory))
+
+    return parse_work_items(work_items, item_filter = item_filter)
 
-                    # fix item quality, 0-5
-                    item["quality"] = parser_instance.get_quality(item["quality"])
+def main():
+    arg_parser = argparse.ArgumentParser(description = "Parse downloaded wayback item records")
+    arg_parser.add_argument("--sqlite", metavar = "FILE",
+        help = "Also write the parsed items into a SQLite database")
+    arg_parser.add_argument("--processes", type = int, default = 1,
+        help = "Number of parser processes")
+    arg_parser.add_argument("--discard", default = ",".join(sorted(DISCARD_PREDICATES)),
+        help = "Comma separated item database filters applied while parsing: %s" % (
+            ", ".join(sorted(DISCARD_PREDICATES)),))
+    arg_parser.add_argument("--keep-all", action = "store_true",
+        help = "Parse every page, for full archive runs")
+    arg_parser.add_argument("--keep-going", action = "store_true",
+        help = "Quarantine files that fail to parse instead of aborting the run")
+    arg_parser.add_argument("--retry-quarantine", action = "store_true",
+        help = "Only re-parse the quarantined files, merging them into the existing output")
+    arg_parser.add_argument("--quarantine", metavar = "FILE", default = "quarantine.json",
+        help = "Quarantine manifest for --keep-going and --retry-quarantine")
+    arg_parser.add_argument("--file-timeout", type = float, default = 60.0,
+        help = "Per-file time budget in seconds with --keep-going")
+    arg_parser.add_argument("--shard-dir", metavar = "DIR",
+        help = "Keep parsed items in item ID range shards spilled to DIR instead of all in memory")
+    arg_parser.add_argument("--shard-size", type = int, default = 2000,
+        help = "Item IDs per shard with --shard-dir or --memory-budget")
+    arg_parser.add_argument("--resident-shards", type = int, default = 4,
+        help = "Shards kept in memory with --shard-dir or --memory-budget")
+    arg_parser.add_argument("--catalog", metavar = "FILE",
+        help = "Directory size catalog, refreshed before the run, to hand files to the --processes "
+            "workers largest first and to stratify --sample by page layout")
+    arg_parser.add_argument("--memory-budget", type = float, metavar = "MB",
+        help = "Memory budget of the run and its workers. Batches shrink, store shards are written "
+            "out to --shard-dir or a temporary directory, workers are replaced and intake pauses as "
+            "it is approached")
+    arg_parser.add_argument("--fragment-cache", metavar = "FILE",
+        help = "SQLite cache of parsed tooltips, shared by the worker processes and kept between runs")
+    arg_parser.add_argument("--output", metavar = "FILE", default = "parsed.json",
+        help = "Parsed item store to write, the format follows the extension unless --format is given")
+    arg_parser.add_argument("--format", choices = list(SERIALIZERS),
+        help = "Store format of --output")
+    arg_parser.add_argument("--sample", type = int, metavar = "N",
+        help = "Parse a stratified sample of about N files into parsed_sample.json and estimate "
+            "the metrics of a full run")
+    arg_parser.add_argument("--sample-seed", type = int, default = 1, help = "Seed of the --sample draw")
+    arg_parser.add_argument("--sample-min", type = int, default = 2,
+        help = "Files sampled from every site and patch level stratum, and layout with --catalog")
+    args = arg_parser.parse_args()
+
+    item_filter = None
+    if not args.keep_all and args.discard:
+        names = args.discard.split(",")
+        for name in names:
+            if name not in DISCARD_PREDICATES:
+                arg_parser.error("Unknown filter %s" % (name,))
+
+        item_filter = ItemDatabaseFilter([DISCARD_PREDICATES[name] for name in names])
 
-                    # Some unequippable item that we don't care about, likely from crafting
-                    # or disenchant info?
-                    #if not item["slot"]:
-                    #    continue
+    # Storage format is: items: { itemId: { patchLevel: [{itemVersion}, ...], ... } }
+    DB_DUMP_DIR = os.path.join(os.getcwd(), "waybackdump")
 
-                    tmp.add_item(item_id, patchLevel, item)
-                except Exception as e:
-                    print "Exception handling processed item"
-                    pprint(item)
-                    traceback.print_exc()
+    catalog = None
+    if args.catalog:
+        from catalog import SnapshotCatalog
 
-    return tmp
+        catalog = SnapshotCatalog(args.catalog)
+        recounted = catalog.refresh(DB_DUMP_DIR)
+        catalog.save()
+        print "Catalog: %d units, %d recounted, %d directories listed" % (len(catalog.units), recounted,
+            catalog.rescanned)
 
-# Enable json serialization of the item sets
-class CustomEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if (isinstance(obj, set)):
-            return list(obj)
+    if args.sample:
+        import sampling
 
-        return json.JSONEncoder.default(self, obj)
+        # Layouts from the catalog, one page read per directory
+        layouts = catalog.unit_layouts() if catalog is not None else None
+        strata = sampling.stratify(iter_work_items(DB_DUMP_DIR), layouts)
+        sample = sampling.draw_sample(strata, args.sample, args.sample_seed, args.sample_min)
 
+        items = ItemStore()
+        results = sampling.parse_sample(sample, items, item_filter)
+        for line in sampling.sample_report(strata, results):
+            print line
 
-def main():
-    # Storage format is: items: { itemId: { patchLevel: [{itemVersion}, ...], ... } }
-    items = ItemStore()
+        dump_parsed_json(items, "parsed_sample.json")
+        return
 
-    DB_DUMP_DIR = os.path.join(os.getcwd(), "waybackdump")
+    quarantine = None
+    if args.keep_going or args.retry_quarantine:
+        quarantine = QuarantineManifest(args.quarantine)
 
-    for snapshot in os.listdir(DB_DUMP_DIR):
-        snapshot_dir = os.path.join(DB_DUMP_DIR, snapshot)
-        # Skip non-snapshot directories in current working dir
-        if not os.path.isdir(snapshot_dir):
-            continue
+    if args.shard_dir or args.memory_budget:
+        # Under a budget the shards go to a temporary directory without --shard-dir
+        items = ShardedItemStore(args.shard_dir, args.shard_size, args.resident_shards)
+    else:
+        items = ItemStore()
 
-        # Ignore snapshots from before 2004 or after 2006
-        s_year = int(snapshot[0:4])
-        if s_year < 2004 or s_year >= 2007:
-            continue
+    if args.retry_quarantine:
+        work_items = quarantine.work_items(PARSERS)
+        if os.path.exists(args.output):
+            load_store(args.output, args.format).merge_into(items)
+    else:
+        work_items = iter_work_items(DB_DUMP_DIR)
 
-        patchLevel = getPatchLevel(snapshot)
+    governor = None
+    if args.memory_budget:
+        logging.basicConfig(level = logging.INFO, format = "%(levelname)s:%(name)s: %(message)s")
+        governor = MemoryGovernor(int(args.memory_budget * 1048576))
 
-        for db in WOW_DB_DIRS:
-            item_dir = os.path.join(snapshot_dir, db)
-            if os.path.exists(item_dir) and os.path.isdir(item_dir):
-                parser = WOW_DB_DIRS[db]["parser"]
+    fragment_cache = None
+    if args.fragment_cache:
+        fragment_cache = FragmentCache(args.fragment_cache)
+        fragment_cache.reset_counts()
 
-                parse_directory(item_dir, patchLevel, parser).merge_into(items)
-        
-        #if len(items.keys()) > 20:
-        #    break
+    stats = {}
+    parse_work_items(work_items, items, processes = args.processes, item_filter = item_filter,
+        stats = stats, quarantine = quarantine, time_budget = args.file_timeout, catalog = catalog,
+        governor = governor, fragment_cache = fragment_cache)
+
+    if governor is not None:
+        print governor.summary()
+
+    if fragment_cache is not None:
+        for line in format_site_counts(fragment_cache.site_counts()):
+            print line
+        fragment_cache.close()
+
+    if stats:
+        print "Skipped %d filtered item pages (%d bytes)" % (stats["skipped_files"], stats["skipped_bytes"])
+
+    if quarantine is not None and len(quarantine) > 0:
+        print "%d files quarantined, see %s" % (len(quarantine), args.quarantine)
 
     #pprint(items)
 
-    with open("parsed.json", "wb") as f:
-        json.dump(items, f, cls = CustomEncoder)
+    dump_store(items, args.output, args.format)
+
+    if args.sqlite:
+        SqliteItemDatabase(args.sqlite).write_store(items)
+
+    if isinstance(items, ShardedItemStore):
+        items.close()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+pipeline.py
+
+Parse archived pages while they are still being downloaded. Written file paths
+go onto a bounded queue consumed by parser processes, and parsed versions are
+appended to a SQLite store as they arrive.
+
+    python pipeline.py download     # run download.py with parsing attached
+    python pipeline.py watch        # parse files dropped into waybackdump/ by anyone
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+
+from Queue import Empty, Full
+
+from items import *
+from parser import list_entries, parse_file, work_item_for_path
+from sqlitestore import SqliteItemDatabase
+
+logger = logging.getLogger()
+
+# Seconds the writer waits for results before checking the workers are alive
+WORKER_CHECK_INTERVAL = 1.0
+
+# Files a parser worker parses per string pool generation
+POOL_GENERATION_FILES = 1000
+
+def _parser_worker(dump_dir, paths, results, item_filter):
+    # Ctrl+C reaches the whole process group. The parent decides when to stop,
+    # the workers finish the published files and send their sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    files = 0
+    while True:
+        path = paths.get()
+        if path is None:
+            results.put(None)
+            break
+
+        work_item = work_item_for_path(dump_dir, path)
+        if work_item is None:
+            continue
+
+        try:
+            parsed = parse_file(*work_item, item_filter = item_filter)
+        except Exception:
+            logger.error("Failed to parse {0}\n{1}".format(path, traceback.format_exc()))
+            continue
+
+        if parsed:
+            # Blocks when the writer falls behind
+            results.put(parsed)
+
+        # Workers live as long as the watch, keep their string pool bounded
+        files += 1
+        if files % POOL_GENERATION_FILES == 0:
+            STRING_POOL.reset()
+
+class ParsePipeline(object):
+    """
+    Bounded path queue -> parser processes -> bounded result queue -> one writer
+    thread appending to SQLite. When the parsers or the writer fall behind the
+    queues fill up and publish() blocks, which throttles the producer
+    """
+    def __init__(self, dump_dir, output, processes = 2, max_pending = 256, batch_size = 2000,
+            flush_interval = 5.0, item_filter = None):
+        self.dump_dir = dump_dir
+        self.db = SqliteItemDatabase(output)
+
+        self.processes = processes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.item_filter = item_filter
+
+        self._paths = multiprocessing.Queue(max_pending)
+        self._results = multiprocessing.Queue(max_pending)
+
+        self._workers = []
+        self._writer = None
+
+        self.published = 0
+        self.written = 0
+
+    def start(self):
+        for i in range(self.processes):
+            worker = multiprocessing.Process(target = _parser_worker,
+                args = (self.dump_dir, self._paths, self._results, self.item_filter))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._writer = threading.Thread(target = self._write_results)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def publish(self, path):
+        self._paths.put(os.path.abspath(path))
+        self.published += 1
+
+    def close(self, timeout = 300.0):
+        """
+        Parse everything published so far, then stop the workers and writer.
+        Workers still running after timeout seconds are terminated, and the
+        results they had not handed over are lost
+        """
+        deadline = time.time() + timeout
+        try:
+            for worker in self._workers:
+                self._paths.put(None, timeout = max(0.0, deadline - time.time()))
+        except Full:
+            logger.warning("Parser workers did not take the stop request in time")
+
+        self._writer.join(max(0.0, deadline - time.time()))
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.time()))
+            if worker.is_alive():
+                logger.warning("Terminating parser worker {0}".format(worker.pid))
+                worker.terminate()
+                worker.join()
+
+        # Stops once it sees the workers gone
+        self._writer.join(WORKER_CHECK_INTERVAL * 5)
+        if self._writer.is_alive():
+            logger.warning("Result writer did not finish, {0} versions written".format(self.written))
+
+    def _write_results(self):
+        # The sqlite connection has to be created on the thread using it
+        self.db.create_indexes()
+
+        pending = ItemStore()
+        pending_versions = 0
+        last_flush = time.time()
+        finished = 0
+
+        # Until every worker has sent its sentinel or died without one
+        while finished < len(self._workers):
+            try:
+                parsed = self._results.get(timeout = min(self.flush_interval, WORKER_CHECK_INTERVAL))
+            except Empty:
+                if not any(worker.is_alive() for worker in self._workers):
+                    logger.warning("All parser workers exited, stopping the writer")
+                    break
+                parsed = []
+
+            if parsed is None:
+                finished += 1
+                parsed = []
+
+            for item_id, patchLevel, item in parsed:
+                pending.add_item(item_id, patchLevel, item)
+                pending_versions += 1
+
+            if pending_versions >= self.batch_size or \
+                    (pending_versions and time.time() - last_flush >= self.flush_interval):
+                self._flush(pending, pending_versions)
+                pending = ItemStore()
+                pending_versions = 0
+                last_flush = time.time()
+
+        if pending_versions:
+            self._flush(pending, pending_versions)
+
+        self.db.close()
+
+    def _flush(self, pending, count):
+        self.db.append(pending)
+        self.written += count
+        logger.info("Appended {0} versions to {1} ({2} total)".format(count, self.db.filename, self.written))
+
+def poll_new_files(dump_dir, directories, now, settle, skip = False):
+    """
+    Yield the files of the dump that settled since the last poll. directories
+    is kept between polls, {path: {"mtime", "seen", "subdirs", "unsettled"}}
+    with seen the (name, inode) of every file already yielded. A file is new
+    if its directory listing has it and seen doesn't, whatever its mtime, so
+    pages moved or copied in with an older mtime are picked up too. A
+    directory is only listed again if its mtime changed or it had files too
+    recent to publish. Adding, renaming or removing a file always changes the
+    mtime of its directory. With skip, files found are recorded as seen and
+    not yielded
+    """
+    cutoff = now - settle
+    visited = set()
+    pending = [dump_dir]
+
+    while pending:
+        directory = pending.pop()
+        visited.add(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            continue
+
+        entry = directories.get(directory)
+        if entry is not None and entry["mtime"] == mtime and not entry["unsettled"]:
+            pending.extend(entry["subdirs"])
+            continue
+
+        previous = set() if entry is None else entry["seen"]
+        seen = set()
+        subdirs = []
+        unsettled = False
+        try:
+            for name, path, is_dir in list_entries(directory):
+                if is_dir:
+                    subdirs.append(path)
+                    continue
+
+                # .part files are downloads still in progress
+                if name.endswith(".part"):
+                    continue
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                # A file replaced under the same name is a new file
+                key = (name, stat.st_ino)
+                if key in previous or skip:
+                    seen.add(key)
+                elif stat.st_mtime > cutoff:
+                    unsettled = True
+                else:
+                    seen.add(key)
+                    yield path
+        except OSError:
+            continue
+
+        # Names gone from the listing are dropped
+        directories[directory] = {"mtime": mtime, "seen": seen, "subdirs": subdirs, "unsettled": unsettled}
+        pending.extend(subdirs)
+
+    # Forget directories that are gone
+    for directory in set(directories) - visited:
+        del directories[directory]
+
+def watch(dump_dir, pipeline, interval = 10.0, settle = 5.0, existing = False, stop = None):
+    """
+    Poll the dump directory and publish every new file. Files modified within
+    the last settle seconds may still be being written and wait for the next
+    poll. Runs until interrupted or the stop event is set
+    """
+    directories = {}
+    stop = stop or threading.Event()
+
+    # Without existing, files present at startup are passed over
+    skip = not existing
+    while not stop.is_set():
+        for path in poll_new_files(dump_dir, directories, time.time(), settle, skip):
+            pipeline.publish(path)
+
+        skip = False
+        stop.wait(interval)
+
+def main():
+    logging.basicConfig(
+        level=(logging.INFO),
+        format="%(levelname)s:%(name)s: %(message)s"
+    )
+
+    arg_parser = argparse.ArgumentParser(description = "Parse archived pages as they are downloaded")
+    arg_parser.add_argument("mode", choices = ["download", "watch"])
+    arg_parser.add_argument("--dump-dir", default = "waybackdump")
+    arg_parser.add_argument("--output", default = "parsed.sqlite", help = "SQLite store to append to")
+    arg_parser.add_argument("--processes", type = int, default = multiprocessing.cpu_count())
+    arg_parser.add_argument("--max-pending", type = int, default = 256,
+        help = "Queued files before the producer is blocked")
+    arg_parser.add_argument("--interval", type = float, default = 10.0, help = "Watch poll interval")
+    arg_parser.add_argument("--existing", action = "store_true",
+        help = "In watch mode, also parse files already present at startup")
+    arg_parser.add_argument("--keep-all", action = "store_true", help = "Don't skip filtered items")
+    args = arg_parser.parse_args()
+
+    # Stop cleanly on SIGTERM too, flushing what has been parsed. Raising from
+    # the handler could break into the queue code, and setting the event here
+    # could deadlock on its lock, so a thread sets it and the loops return
+    stop = threading.Event()
+    def terminate(signum, frame):
+        threading.Thread(target = stop.set).start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    item_filter = None if args.keep_all else ItemDatabaseFilter()
+    pipeline = ParsePipeline(args.dump_dir, args.output, args.processes, args.max_pending,
+        item_filter = item_filter)
+    pipeline.start()
+
+    try:
+        if args.mode == "download":
+            import download
+
+            dumps = download.build_dumps(args.dump_dir)
+            for dump in dumps:
+                dump.on_written = pipeline.publish
+
+            download.run_dumps(dumps, stop = stop)
+        else:
+            watch(args.dump_dir, pipeline, args.interval, existing = args.existing, stop = stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+quarantine.py
+
+Fault tolerant parse runs. Files that fail to parse are recorded in a
+quarantine manifest instead of aborting the run, and can be re-parsed on their
+own after a parser fix
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+
+class ParseTimeout(BaseException):
+    # Not an Exception, so the parser's own except Exception handlers for bad
+    # tooltips don't swallow it and carry on with the file
+    pass
+
+def _raise_timeout(signum, frame):
+    raise ParseTimeout("File parse exceeded its time budget")
+
+class QuarantineManifest(object):
+    """
+    Failed work items keyed by path, with the traceback, the parser class and
+    a hash of the file content at the time of the failure
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                for entry in json.load(f):
+                    self.entries[entry["path"]] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, work_item, error):
+        path, patchLevel, parser, source = work_item
+
+        digest = None
+        try:
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            pass
+
+        self.entries[path] = {
+            "path": path,
+            "patchLevel": patchLevel,
+            "parser": parser.__name__,
+            "source": source,
+            "sha1": digest,
+            "traceback": error,
+            "quarantined_at": int(time.time())
+        }
+
+    def remove(self, path):
+        self.entries.pop(path, None)
+
+    def work_items(self, parsers):
+        """
+        Rebuild the work items of the quarantined files. parsers maps parser
+        class names back to the classes
+        """
+        for path in sorted(self.entries):
+            entry = self.entries[path]
+            source = tuple(entry["source"]) if entry["source"] is not None else None
+
+            yield entry["path"], entry["patchLevel"], parsers[entry["parser"]], source
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            json.dump([self.entries[path] for path in sorted(self.entries)], f, indent = 1)
+
+        os.rename(tmp_filename, self.filename)
+
+def _worker_loop(func, conn, time_budget):
+    # Ctrl+C is handled by the parent, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        work_item = conn.recv()
+        if work_item is None:
+            break
+
+        # Soft budget, interrupts anything still running Python bytecode. Time
+        # spent inside a single C call such as a regex match is covered by the
+        # parent killing the worker
+        if time_budget:
+            signal.signal(signal.SIGALRM, _raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, time_budget)
+
+        try:
+            result = (func(work_item), None)
+        except (Exception, ParseTimeout):
+            result = ([], traceback.format_exc())
+        finally:
+            if time_budget:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+        conn.send(result)
+
+class _Worker(object):
+    def __init__(self, func, time_budget):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target = _worker_loop,
+            args = (func, child_conn, time_budget))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.work_item = None
+        self.started = None
+
+    def send(self, work_item):
+        self.work_item = work_item
+        self.started = time.time()
+        self.conn.send(work_item)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+class GuardedWorkerPool(object):
+    """
+    Runs func(work_item) in worker processes with one file in flight per worker.
+    Exceptions are returned instead of raised, and a worker that dies or blows
+    well past the time budget is killed and replaced, failing only its file
+    """
+    def __init__(self, func, processes = 1, time_budget = None, grace = 5.0):
+        self.func = func
+        self.processes = max(1, processes)
+        self.time_budget = time_budget
+        self.grace = grace
+
+    def imap_unordered(self, work_items):
+        """
+        Yield (work_item, result, error) as files finish. error is None on
+        success, otherwise a traceback or a description of the failure
+        """
+        work_items = iter(work_items)
+        workers = [_Worker(self.func, self.time_budget) for i in range(self.processes)]
+        idle = list(workers)
+        busy = []
+        exhausted = False
+
+        try:
+            while True:
+                while idle and not exhausted:
+                    try:
+                        work_item = next(work_items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    worker = idle.pop()
+                    worker.send(work_item)
+                    busy.append(worker)
+
+                if not busy:
+                    break
+
+                progressed = False
+                for worker in list(busy):
+                    failure = None
+
+                    if worker.conn.poll():
+                        try:
+                            result, error = worker.conn.recv()
+                        except (EOFError, IOError):
+                            failure = "Worker exited while parsing"
+                        else:
+                            busy.remove(worker)
+                            idle.append(worker)
+                            progressed = True
+                            yield worker.work_item, result, error
+                            continue
+
+                    elif not worker.process.is_alive():
+                        failure = "Worker died with exit code %s" % (worker.process.exitcode,)
+
+                    elif self.time_budget and time.time() - worker.started > self.time_budget + self.grace:
+                        failure = "Killed after exceeding the %.1fs time budget" % (self.time_budget,)
+
+                    if failure is not None:
+                        worker.kill()
+                        busy.remove(worker)
+                        workers.remove(worker)
+
+                        replacement = _Worker(self.func, self.time_budget)
+                        workers.append(replacement)
+                        idle.append(replacement)
+                        progressed = True
+
+                        yield worker.work_item, [], failure
+
+                if not progressed:
+                    busy[0].conn.poll(0.05)
+        finally:
+            for worker in workers:
+                worker.stop()
@@ -0,0 +1,199 @@
+"""
+sampling.py
+
+Parse a small, reproducible sample of the dump instead of all of it, and
+extrapolate the parse metrics to the whole corpus. Used by parser.py --sample:
+
+    python parser.py --sample 400 --sample-seed 7
+
+Files are grouped into strata by site and patch level, and with --catalog by
+the page layout the catalog recorded for their (snapshot, site) directory.
+Layouts are read from the markers each parser looks for near the start of
+the page, once per directory rather than for every file. Every stratum gets its share of the sample, at least min_per_stratum
+files, drawn with a random generator seeded from the seed and the stratum so
+the same files come back run after run. Totals are estimated per stratum and
+summed, with 95% confidence intervals from the stratified variance
+"""
+
+import gzip
+import math
+import random
+import re
+
+from collections import OrderedDict
+
+from parser import GZIP_MAGIC, ZSTD_MAGIC, parse_file, read_page
+
+# Markers of the page layouts the parsers handle, looked for in the page head
+LAYOUT_MARKERS = OrderedDict([
+    ("wowitem", re.compile(r"class=[\"']?wowitem", re.IGNORECASE)),
+    ("font-name", re.compile(r"<font\s+color=[\"']?#", re.IGNORECASE)),
+    ("ttb-table", re.compile(r"<table\s+class=[\"']?ttb", re.IGNORECASE)),
+    ("ttb-script", re.compile(r"\"<table class=ttb")),
+])
+
+# Per file counts reported, in order. parse_file fills all but errors
+SAMPLE_METRICS = ["items", "no_id", "no_name", "discarded", "quality_0", "quality_1", "quality_2",
+    "quality_3", "quality_4", "quality_5", "errors"]
+
+def page_head(file_path, size = 65536):
+    with open(file_path, "rb") as f:
+        head = f.read(size)
+
+        if head.startswith(GZIP_MAGIC):
+            f.seek(0)
+            return gzip.GzipFile(fileobj = f).read(size)
+
+    if head.startswith(ZSTD_MAGIC):
+        return read_page(file_path)[:size]
+
+    return head
+
+def page_layout(file_path):
+    """
+    Names of the layout markers found in the page, "none" if there are none
+    """
+    head = page_head(file_path)
+    found = [name for name, pattern in LAYOUT_MARKERS.iteritems() if pattern.search(head)]
+
+    return "+".join(found) or "none"
+
+def stratify(work_items, layouts = None):
+    """
+    {(site, patchLevel, layout): [work_item, ...]}, each list sorted by path.
+    layouts is {unit ID: layout} of the (snapshot, site) directories, such as
+    catalog.SnapshotCatalog.unit_layouts(). Without it, or for directories
+    it doesn't know, the layout is "any"
+    """
+    if layouts is None:
+        layouts = {}
+
+    strata = {}
+    for work_item in work_items:
+        path, patchLevel, parser, source = work_item
+        layout = layouts.get("%s/%s" % source) or "any"
+        strata.setdefault((source[1], patchLevel, layout), []).append(work_item)
+
+    for stratum in strata:
+        strata[stratum].sort()
+
+    return strata
+
+def draw_sample(strata, sample_size, seed = 1, min_per_stratum = 2):
+    """
+    {stratum: sampled work items}. The sample is split in proportion to the
+    stratum sizes, with at least min_per_stratum files from each stratum
+    """
+    total = sum(len(files) for files in strata.itervalues())
+    sample = {}
+
+    for stratum in sorted(strata):
+        files = strata[stratum]
+        share = int(round(sample_size * float(len(files)) / total)) if total else 0
+        count = min(len(files), max(min_per_stratum, share))
+
+        rnd = random.Random("%s:%s:%s:%s" % ((seed,) + stratum))
+        sample[stratum] = rnd.sample(files, count)
+
+    return sample
+
+def parse_sample(sample, store = None, item_filter = None):
+    """
+    Parse the sampled files, adding versions to store if given. Returns
+    {stratum: [per file stats dict, ...]}
+    """
+    results = {}
+    for stratum in sorted(sample):
+        results[stratum] = []
+        for work_item in sample[stratum]:
+            stats = {}
+            try:
+                parsed = parse_file(*work_item, item_filter = item_filter, stats = stats)
+            except Exception:
+                stats = {"errors": 1}
+                parsed = []
+
+            if store is not None:
+                for item_id, patchLevel, item in parsed:
+                    store.add_item(item_id, patchLevel, item)
+
+            results[stratum].append(stats)
+
+    return results
+
+def _mean_variance(values):
+    mean = sum(values) / float(len(values))
+    if len(values) < 2:
+        return mean, 0.0
+
+    return mean, sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+def stratified_total(strata_sizes, results, metric, z = 1.96):
+    """
+    (estimated corpus total, confidence interval half width) of a per file
+    count, from the stratum sizes and the sampled files' stats
+    """
+    total = 0.0
+    variance = 0.0
+    for stratum, size in strata_sizes.iteritems():
+        values = [stats.get(metric, 0) for stats in results.get(stratum, ())]
+        if not values:
+            continue
+
+        mean, sample_variance = _mean_variance(values)
+        total += size * mean
+        # Finite population correction, a fully sampled stratum adds nothing
+        variance += size * size * (1.0 - float(len(values)) / size) * sample_variance / len(values)
+
+    return total, z * math.sqrt(variance)
+
+def stratified_ratio(strata_sizes, results, metric, denominator, z = 1.96):
+    """
+    (estimated corpus ratio of two per file counts, half width), with the
+    linearised variance of a combined ratio estimator
+    """
+    numerator_total = stratified_total(strata_sizes, results, metric)[0]
+    denominator_total = stratified_total(strata_sizes, results, denominator)[0]
+    if denominator_total == 0:
+        return 0.0, 0.0
+
+    ratio = numerator_total / denominator_total
+    variance = 0.0
+    for stratum, size in strata_sizes.iteritems():
+        residuals = [stats.get(metric, 0) - ratio * stats.get(denominator, 0) for stats in results.get(stratum, ())]
+        if not residuals:
+            continue
+
+        mean, sample_variance = _mean_variance(residuals)
+        variance += size * size * (1.0 - float(len(residuals)) / size) * sample_variance / len(residuals)
+
+    return ratio, z * math.sqrt(variance) / denominator_total
+
+def sample_report(strata, results):
+    """
+    Lines extrapolating the sampled metrics to the full corpus
+    """
+    strata_sizes = dict((stratum, len(files)) for stratum, files in strata.iteritems())
+
+    # Every tooltip found ends up kept, without an ID, without a name or discarded
+    for stats_list in results.itervalues():
+        for stats in stats_list:
+            stats["tooltips"] = sum(stats.get(metric, 0) for metric in ("items", "no_id", "no_name", "discarded"))
+            stats["files"] = 1
+
+    lines = ["Sampled %d of %d files in %d strata" % (sum(len(stats) for stats in results.itervalues()),
+        sum(strata_sizes.itervalues()), len(strata))]
+
+    for stratum in sorted(strata):
+        lines.append("  %-24s %4d %-24s %6d files, %4d sampled" % (stratum + (strata_sizes[stratum],
+            len(results.get(stratum, ())))))
+
+    lines.append("Estimated corpus totals (95% CI), % of tooltips (errors: % of files):")
+    for metric in SAMPLE_METRICS:
+        total, total_error = stratified_total(strata_sizes, results, metric)
+        ratio, ratio_error = stratified_ratio(strata_sizes, results, metric,
+            "files" if metric == "errors" else "tooltips")
+        lines.append("  %-10s %12.0f +- %-10.0f %6.2f%% +- %.2f%%" % (metric, total, total_error,
+            ratio * 100.0, ratio_error * 100.0))
+
+    return lines
@@ -0,0 +1,184 @@
+"""
+serializers.py
+
+Interchangeable on-disk formats for the parsed item store:
+
+    dump_store(items, "parsed.pickle")
+    items = load_store("parsed.pickle")
+
+The format comes from the file extension unless given: .json is the
+parsed.json format, with its offset index and fingerprint tree, .msgpack is
+msgpack and .pickle is cPickle. The "fastjson" format writes the same JSON
+with ujson, when installed.
+
+JSON has no int keys or sets, so loading it turns keys back into ints and
+rebuilds every version. msgpack keeps the int keys and only needs the
+versions rebuilt. Pickle stores the ItemStore as is, version sources included,
+and loads without any conversion
+"""
+
+import cPickle
+
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from items import *
+
+# Items per pickle record, the pickler memo is cleared between records so
+# writing a sharded store stays bounded
+PICKLE_BATCH_SIZE = 1000
+
+class StoreSerializer(object):
+    """
+    A format has dump(item_store, filename) and load(filename), which returns
+    an ItemStore
+    """
+    name = None
+    extensions = []
+
+    def available(self):
+        return True
+
+class JsonSerializer(StoreSerializer):
+    name = "json"
+    extensions = [".json"]
+
+    def dump(self, item_store, filename):
+        dump_parsed_json(item_store, filename)
+
+    def load(self, filename):
+        return load_parsed_json(filename)
+
+class FastJsonSerializer(StoreSerializer):
+    """
+    parsed.json written and read with ujson. No index or fingerprint tree
+    """
+    name = "fastjson"
+    extensions = []
+
+    def available(self):
+        return ujson is not None
+
+    def dump(self, item_store, filename):
+        with open(filename, "wb") as f:
+            f.write("{")
+            for count, item_id in enumerate(item_store):
+                if count > 0:
+                    f.write(", ")
+                patches = item_store[item_id]
+                f.write('"%d": %s' % (item_id, ujson.dumps(dict((str(patch), list(patches[patch]))
+                    for patch in patches))))
+            f.write("}")
+
+    def load(self, filename):
+        item_data = ItemStore()
+        with open(filename, "rb") as f:
+            tmp = ujson.load(f)
+
+        # Convert keys back to int, json has no int keys
+        for item_id, patches in tmp.iteritems():
+            for patch, versions in patches.iteritems():
+                for itemv in versions:
+                    item_data.add_item(int(item_id), int(patch), ItemVersion(itemv))
+
+        return item_data
+
+class MsgpackSerializer(StoreSerializer):
+    """
+    One [item_id, [[patch, [version, ...]], ...]] array per item
+    """
+    name = "msgpack"
+    extensions = [".msgpack"]
+
+    def available(self):
+        return msgpack is not None
+
+    def dump(self, item_store, filename):
+        packer = msgpack.Packer(use_bin_type = True)
+        with open(filename, "wb") as f:
+            for item_id in item_store:
+                patches = item_store[item_id]
+                f.write(packer.pack([item_id, [[patch, list(patches[patch])] for patch in patches]]))
+
+    def load(self, filename):
+        item_data = ItemStore()
+        with open(filename, "rb") as f:
+            for item_id, patches in msgpack.Unpacker(f, raw = False):
+                item_data[item_id] = dict((patch, [ItemVersion(itemv) for itemv in versions])
+                    for patch, versions in patches)
+
+        return item_data
+
+class PickleSerializer(StoreSerializer):
+    """
+    cPickle at the highest protocol this Python has, 2 on Python 2. Items are
+    written in batches of PICKLE_BATCH_SIZE (item_id, patches) pairs
+    """
+    name = "pickle"
+    extensions = [".pickle", ".pkl"]
+
+    def dump(self, item_store, filename):
+        with open(filename, "wb") as f:
+            pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+            batch = []
+            for item_id in item_store:
+                batch.append((item_id, item_store[item_id]))
+                if len(batch) >= PICKLE_BATCH_SIZE:
+                    pickler.dump(batch)
+                    pickler.clear_memo()
+                    batch = []
+
+            if batch:
+                pickler.dump(batch)
+
+    def load(self, filename):
+        item_data = ItemStore()
+        with open(filename, "rb") as f:
+            unpickler = cPickle.Unpickler(f)
+            while True:
+                try:
+                    batch = unpickler.load()
+                except EOFError:
+                    break
+                item_data.update(batch)
+
+        return item_data
+
+SERIALIZERS = OrderedDict((serializer.name, serializer) for serializer in [
+    JsonSerializer(), FastJsonSerializer(), MsgpackSerializer(), PickleSerializer()])
+
+def serializer_for(filename, format = None):
+    """
+    The serializer for a format name, or else for the file extension
+    """
+    if format is None:
+        for serializer in SERIALIZERS.itervalues():
+            if any(filename.endswith(extension) for extension in serializer.extensions):
+                format = serializer.name
+                break
+        else:
+            format = "json"
+
+    if format not in SERIALIZERS:
+        raise ValueError("Unknown store format %s" % (format,))
+
+    serializer = SERIALIZERS[format]
+    if not serializer.available():
+        raise RuntimeError("The %s store format needs a package that is not installed" % (format,))
+
+    return serializer
+
+def dump_store(item_store, filename, format = None):
+    serializer_for(filename, format).dump(item_store, filename)
+
+def load_store(filename, format = None):
+    return serializer_for(filename, format).load(filename)
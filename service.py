@@ -0,0 +1,294 @@
+"""
+service.py
+
+Keep the item database, the parsed store and the concensus versions loaded
+between requests, and answer them over a small local HTTP API instead of
+reloading parsed.json for every question:
+
+    python service.py --socket /tmp/items.sock
+    curl --unix-socket /tmp/items.sock http://localhost/item/19165
+    curl --unix-socket /tmp/items.sock "http://localhost/diff?items=19000-19100&from=107&to=106"
+    curl --unix-socket /tmp/items.sock "http://localhost/diff?items=19165&format=sql"
+    curl --unix-socket /tmp/items.sock -X POST http://localhost/parse
+    curl --unix-socket /tmp/items.sock http://localhost/status
+
+Without --socket the service listens on 127.0.0.1:8765. ItemService is usable
+on its own from Python without running a server
+"""
+
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import os
+import signal
+import socket
+import SocketServer
+import StringIO
+import threading
+import time
+import traceback
+import urlparse
+
+from build_patch_difference import ItemPatchData, build_spell_index, build_sql_migration, parse_item_ids
+from items import *
+from parser import iter_work_items, parse_work_items
+from spellindex import SpellIndex
+from sqlitestore import SqliteItemDatabase
+
+class ItemService(object):
+    """
+    The loaded store plus a cache of concensus versions by (item_id, patch).
+    Cache entries of items touched by an incremental parse are dropped
+    """
+    def __init__(self, parsed_file = "parsed.json", sqlite = None, dump_dir = "waybackdump",
+            item_filter = None):
+        self.parsed_file = parsed_file
+        self.sqlite = sqlite
+        self.dump_dir = dump_dir
+        self.item_filter = item_filter
+
+        self.store = ItemStore()
+        self.concensus_cache = {}
+        self.spell_index = SpellIndex()
+
+        # Dump files already reflected in the store
+        self.parsed_files = set()
+
+        self.loaded_at = None
+        self.load_seconds = None
+        self.requests = 0
+
+    def load(self):
+        start = time.time()
+        load_item_db()
+
+        if self.sqlite:
+            self.store = SqliteItemDatabase(self.sqlite).load_store()
+        elif os.path.exists(self.parsed_file):
+            self.store = load_parsed_json(self.parsed_file)
+        else:
+            self.store = ItemStore()
+
+        self.spell_index = build_spell_index(self.sqlite, [self.store])
+
+        # Whatever is in the dump now was parsed into the loaded store
+        self.parsed_files = set()
+        if os.path.isdir(self.dump_dir):
+            self.parsed_files.update(work_item[0] for work_item in iter_work_items(self.dump_dir))
+
+        self.concensus_cache.clear()
+
+        self.loaded_at = time.time()
+        self.load_seconds = self.loaded_at - start
+
+    def resolve(self, key):
+        """
+        Item ID for an ID or an exact item name, -1 if unknown
+        """
+        if key.isdigit():
+            return int(key)
+
+        return ItemNameToID(key)
+
+    def item_history(self, item_id):
+        return {
+            "item_id": item_id,
+            "name": ID_TO_NAME_HASH.get(item_id),
+            "patches": self.store.get(item_id, {})
+        }
+
+    def diff(self, item_ids, from_patch, to_patch):
+        """
+        ItemPatchData diff of the given items, concensus versions come from the
+        shared cache
+        """
+        to_data = ItemPatchData(to_patch, self.concensus_cache)
+        to_data.build_patch_data(self.store, item_ids)
+        to_data.filter()
+
+        from_data = ItemPatchData(from_patch, self.concensus_cache)
+        from_data.build_patch_data(self.store, item_ids)
+        from_data.filter()
+
+        return to_data.calculate_diff(from_data)
+
+    def parse_new_files(self, save = False):
+        """
+        Parse dump files that appeared since the last load or parse into the
+        store, and forget the concensus of every item they touched. With save,
+        the new versions are written back to parsed.json or the SQLite store
+        """
+        work_items = [work_item for work_item in iter_work_items(self.dump_dir)
+            if work_item[0] not in self.parsed_files] if os.path.isdir(self.dump_dir) else []
+
+        parsed = parse_work_items(work_items, item_filter = self.item_filter)
+        parsed.merge_into(self.store)
+        self.spell_index.add_store(parsed)
+        self.parsed_files.update(work_item[0] for work_item in work_items)
+
+        touched = set(parsed)
+        for key in self.concensus_cache.keys():
+            if key[0] in touched:
+                del self.concensus_cache[key]
+
+        if save and len(parsed):
+            if self.sqlite:
+                SqliteItemDatabase(self.sqlite).append(parsed)
+            else:
+                dump_parsed_json(self.store, self.parsed_file)
+
+        return {"files": len(work_items), "items": len(touched)}
+
+    def status(self):
+        return {
+            "items": len(self.store),
+            "parsed_files": len(self.parsed_files),
+            "cached_concensus": len(self.concensus_cache),
+            "spell_tooltips": len(self.spell_index),
+            "load_seconds": self.load_seconds,
+            "uptime": time.time() - self.loaded_at if self.loaded_at else None,
+            "requests": self.requests
+        }
+
+class ItemServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        service = self.server.service
+        service.requests += 1
+
+        try:
+            if url.path.startswith("/item/"):
+                item_id = service.resolve(urlparse.unquote(url.path[len("/item/"):]))
+                if item_id not in service.store:
+                    self.send_json(404, {"error": "Unknown item"})
+                    return
+                self.send_json(200, service.item_history(item_id))
+
+            elif url.path == "/diff":
+                if "items" not in query:
+                    self.send_json(400, {"error": "items is required"})
+                    return
+
+                diff = service.diff(parse_item_ids(query["items"]),
+                    int(query.get("from", 107)), int(query.get("to", 106)))
+
+                if query.get("format") == "sql":
+                    out = StringIO.StringIO()
+                    build_sql_migration(out, diff, service.spell_index)
+                    self.send_body(200, "text/plain", out.getvalue())
+                else:
+                    self.send_json(200, diff)
+
+            elif url.path == "/status":
+                self.send_json(200, service.status())
+
+            else:
+                self.send_json(404, {"error": "Unknown path"})
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+        except Exception:
+            self.send_json(500, {"error": traceback.format_exc()})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        service = self.server.service
+        service.requests += 1
+
+        if url.path != "/parse":
+            self.send_json(404, {"error": "Unknown path"})
+            return
+
+        try:
+            self.send_json(200, service.parse_new_files(save = query.get("save") == "1"))
+        except Exception:
+            self.send_json(500, {"error": traceback.format_exc()})
+
+    def send_json(self, status, obj):
+        self.send_body(status, "application/json", json.dumps(obj, cls = CustomEncoder))
+
+    def send_body(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Unix socket peers have an empty address
+        print "%s %s" % (self.client_address[0] if self.client_address else "local", format % args)
+
+class ItemServiceServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ItemServiceHandler)
+        self.service = service
+
+class UnixItemServiceServer(ItemServiceServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+        # HTTPServer.server_bind expects a host and port
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    httplib connection to a service listening on a unix socket
+    """
+    def __init__(self, path, timeout = None):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+        self.timeout = timeout
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description = "Serve item history and patch diffs from memory")
+    arg_parser.add_argument("--parsed", default = "parsed.json", help = "parsed.json to load")
+    arg_parser.add_argument("--sqlite", metavar = "FILE", help = "Load from a SQLite store instead")
+    arg_parser.add_argument("--dump-dir", default = "waybackdump", help = "Dump parsed incrementally by POST /parse")
+    arg_parser.add_argument("--socket", metavar = "PATH", help = "Listen on a unix socket")
+    arg_parser.add_argument("--host", default = "127.0.0.1")
+    arg_parser.add_argument("--port", type = int, default = 8765)
+    arg_parser.add_argument("--keep-all", action = "store_true", help = "Don't skip filtered items when parsing")
+    args = arg_parser.parse_args()
+
+    service = ItemService(args.parsed, args.sqlite, args.dump_dir,
+        None if args.keep_all else ItemDatabaseFilter())
+    service.load()
+    print "Loaded %d items in %.1fs" % (len(service.store), service.load_seconds)
+
+    if args.socket:
+        server = UnixItemServiceServer(args.socket, service)
+    else:
+        server = ItemServiceServer((args.host, args.port), service)
+    print "Listening on %s" % (args.socket or "%s:%d" % (args.host, args.port),)
+
+    # Stop cleanly on SIGTERM too, removing the socket. Raising from the
+    # handler would be swallowed if it lands inside a request, and shutdown()
+    # waits for serve_forever to return, so it runs on a thread of its own
+    def terminate(signum, frame):
+        threading.Thread(target = server.shutdown).start()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+shardstore.py
+
+An ItemStore that does not have to fit in memory. Items are partitioned into
+shards by item ID range, a bounded number of shards is kept resident and the
+rest are spilled to pickle files:
+
+    store = ShardedItemStore("shards", shard_size = 2000, max_resident = 4)
+    parse_work_items(iter_work_items("waybackdump"), store)
+    dump_parsed_json(store, "parsed.json")
+
+Versions added to a spilled shard are buffered and appended to its file as
+extra pickle records, so parsing in snapshot order does not thrash the LRU.
+A shard file is compacted back into one record when the shard is next evicted.
+
+store[item_id] returns a read only copy, a change made in place would be lost
+when its shard is evicted. Items are changed through add_item, merge_item,
+store[item_id] = patches or del store[item_id]
+"""
+
+import cPickle
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+
+from items import *
+
+class ReadOnlyPatches(dict):
+    """
+    Copy of the {patch: versions} of one item, versions in tuples. Changes
+    raise instead of going missing on the next eviction
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Items of a ShardedItemStore are read only, use add_item, merge_item or "
+            "store[item_id] = patches")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    # Pickled and copied as a plain dict
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+class ShardedItemStore(object):
+    def __init__(self, directory = None, shard_size = 2000, max_resident = 4, max_pending = 10000):
+        self._owns_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix = "itemshards-")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # A store starts out empty, drop shards left over from an earlier run
+        for name in os.listdir(self.directory):
+            if name.startswith("shard-"):
+                os.remove(os.path.join(self.directory, name))
+
+        self.shard_size = shard_size
+        self.max_resident = max(1, max_resident)
+        self.max_pending = max_pending
+
+        # shard_id -> ItemStore, least recently used first
+        self._resident = OrderedDict()
+        self._dirty = set()
+
+        # shard_id -> ItemStore of versions added while the shard was spilled
+        self._pending = {}
+        self._pending_count = 0
+
+        self._ids = set()
+        self._shard_ids = set()
+
+        self.loads = 0
+        self.spills = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Drop all shards, removing the spill directory if the store created it
+        """
+        self._resident.clear()
+        self._pending.clear()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, True)
+
+    def shard_of(self, item_id):
+        return item_id // self.shard_size
+
+    def shard_range(self, shard_id):
+        # Item IDs in the shard, low inclusive and high exclusive
+        return shard_id * self.shard_size, (shard_id + 1) * self.shard_size
+
+    def _filename(self, shard_id):
+        return os.path.join(self.directory, "shard-%06d.pickle" % (shard_id,))
+
+    def _shard(self, shard_id):
+        if shard_id in self._resident:
+            self._resident[shard_id] = self._resident.pop(shard_id)
+            return self._resident[shard_id]
+
+        store = ItemStore()
+        filename = self._filename(shard_id)
+        records = 0
+
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                while True:
+                    try:
+                        record = cPickle.load(f)
+                    except EOFError:
+                        break
+                    record.merge_into(store)
+                    records += 1
+            self.loads += 1
+
+        if shard_id in self._pending:
+            pending = self._pending.pop(shard_id)
+            pending.merge_into(store)
+            self._pending_count -= sum(len(versions) for item_id in pending
+                for versions in pending[item_id].itervalues())
+
+            # Only in memory until the shard is written back
+            self._dirty.add(shard_id)
+
+        # Compact files with appended records when the shard is next evicted
+        if records > 1:
+            self._dirty.add(shard_id)
+
+        self._resident[shard_id] = store
+        self._evict()
+
+        return store
+
+    def _evict(self):
+        while len(self._resident) > self.max_resident:
+            shard_id, store = self._resident.popitem(last = False)
+            if shard_id in self._dirty:
+                self._write(shard_id, store)
+                self._dirty.discard(shard_id)
+
+    def _write(self, shard_id, store):
+        filename = self._filename(shard_id)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            cPickle.dump(store, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, filename)
+
+        self.spills += 1
+
+    def _flush_pending(self):
+        for shard_id, pending in self._pending.iteritems():
+            with open(self._filename(shard_id), "ab") as f:
+                cPickle.dump(pending, f, cPickle.HIGHEST_PROTOCOL)
+
+        self._pending = {}
+        self._pending_count = 0
+
+    def flush(self):
+        """
+        Write every modified shard and buffered version to disk
+        """
+        for shard_id, store in self._resident.iteritems():
+            if shard_id in self._dirty:
+                self._write(shard_id, store)
+        self._dirty.clear()
+
+        self._flush_pending()
+
+    def release(self):
+        """
+        Halve the resident shard limit and the version buffer, writing out
+        the shards dropped and the buffered versions. Used under memory
+        pressure, returns (shards dropped, buffered versions written)
+        """
+        resident = len(self._resident)
+        pending = self._pending_count
+        self.max_resident = max(1, self.max_resident // 2)
+        self.max_pending = max(100, self.max_pending // 2)
+
+        self._evict()
+        self._flush_pending()
+
+        return resident - len(self._resident), pending
+
+    def add_item(self, item_id, patchLevel, item):
+        shard_id = self.shard_of(item_id)
+        self._ids.add(item_id)
+        self._shard_ids.add(shard_id)
+
+        if shard_id in self._resident:
+            self._resident[shard_id].add_item(item_id, patchLevel, item)
+            self._dirty.add(shard_id)
+            return
+
+        if shard_id not in self._pending:
+            self._pending[shard_id] = ItemStore()
+        self._pending[shard_id].add_item(item_id, patchLevel, item)
+
+        self._pending_count += 1
+        if self._pending_count >= self.max_pending:
+            self._flush_pending()
+
+    def merge_item(self, item_id, patches):
+        shard_id = self.shard_of(item_id)
+        self._shard(shard_id).merge_item(item_id, patches)
+
+        self._dirty.add(shard_id)
+        self._ids.add(item_id)
+        self._shard_ids.add(shard_id)
+
+    def merge_into(self, base):
+        """
+        Merges data in this store into the base store, one shard at a time
+        """
+        for low, high, shard in self.shards():
+            shard.merge_into(base)
+
+    def shards(self):
+        """
+        Yield (low, high, ItemStore) for each shard in item ID order, loading one
+        shard at a time. The yielded store is read only
+        """
+        for shard_id in sorted(self._shard_ids):
+            shard = self._shard(shard_id)
+
+            low, high = self.shard_range(shard_id)
+            yield low, high, shard
+
+    def __contains__(self, item_id):
+        return item_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for shard_id in sorted(self._shard_ids):
+            for item_id in sorted(self._shard(shard_id).keys()):
+                yield item_id
+
+    def keys(self):
+        return list(self)
+
+    def __getitem__(self, item_id):
+        if item_id not in self._ids:
+            raise KeyError(item_id)
+
+        shard_id = self.shard_of(item_id)
+        patches = self._shard(shard_id)[item_id]
+        return ReadOnlyPatches((patch, tuple(versions)) for patch, versions in patches.iteritems())
+
+    def get(self, item_id, default = None):
+        if item_id not in self._ids:
+            return default
+
+        return self[item_id]
+
+    def __setitem__(self, item_id, patches):
+        shard_id = self.shard_of(item_id)
+        shard = self._shard(shard_id)
+        shard[item_id] = dict((patch, list(versions)) for patch, versions in patches.iteritems())
+
+        self._dirty.add(shard_id)
+        self._ids.add(item_id)
+        self._shard_ids.add(shard_id)
+
+    def __delitem__(self, item_id):
+        if item_id not in self._ids:
+            raise KeyError(item_id)
+
+        shard_id = self.shard_of(item_id)
+        del self._shard(shard_id)[item_id]
+
+        self._dirty.add(shard_id)
+        self._ids.discard(item_id)
@@ -0,0 +1,163 @@
+"""
+spellindex.py
+
+Look up spell IDs for effects parsed without one from their tooltip text.
+Early Thottbot "Equip:" rows and broken itemeffectlink hrefs leave effects with
+spellId -1, the same tooltip usually shows up elsewhere in the parsed data
+with a known ID:
+
+    spells = SpellIndex()
+    spells.add_store(load_parsed_json("parsed.json"))
+    spells.resolve(u"Equip: Improves your chance to hit by 1%.")
+
+Tooltips are compared by their signature: lowercased words with whitespace
+collapsed and every number replaced by #, plus the numbers themselves. An
+exact signature match is a dict lookup. Otherwise candidates with the same
+numbers are gathered through a word index and the most similar word set wins,
+so "Improves" and "Increases" wordings of one spell still meet
+"""
+
+import re
+
+from collections import Counter
+
+from items import *
+
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+WORD_RE = re.compile(r"[a-z#]+")
+
+def tooltip_signature(tooltip):
+    """
+    (shape, numbers) for a tooltip, e.g. ("equip: improves your chance to hit by #%.", ("1",))
+    """
+    text = tooltip.lower()
+    numbers = tuple(NUMBER_RE.findall(text))
+    shape = " ".join(NUMBER_RE.sub("#", text).split())
+
+    return shape, numbers
+
+class SpellIndex(object):
+    def __init__(self, min_similarity = 0.6):
+        self.min_similarity = min_similarity
+
+        # signature -> Counter of spell IDs seen with it
+        self._spells = {}
+
+        # Built on first lookup: signature -> most common spell ID, and
+        # (numbers, word) -> signatures for near matches
+        self._best = None
+        self._words = None
+        self._postings = None
+
+        # tooltip -> spell ID, tooltips repeat across items and snapshots
+        self._resolved = {}
+
+        self.exact = 0
+        self.near = 0
+        self.unresolved = 0
+
+    def __len__(self):
+        return len(self._spells)
+
+    def add(self, tooltip, spell_id):
+        if not tooltip or spell_id < 0:
+            return
+
+        signature = tooltip_signature(tooltip)
+        if signature not in self._spells:
+            self._spells[signature] = Counter()
+        self._spells[signature][spell_id] += 1
+
+        self._best = None
+
+    def add_store(self, item_store):
+        """
+        Index every effect with a known spell ID in the store, one pass
+        """
+        for item_id in item_store:
+            for versions in item_store[item_id].itervalues():
+                for itemv in versions:
+                    for effect in itemv["effects"]:
+                        self.add(effect["tooltip"], effect["spellId"])
+
+    def build(self):
+        """
+        Build the lookup tables, otherwise done on the first lookup after an add
+        """
+        self._best = {}
+        self._words = {}
+        self._postings = {}
+
+        for signature, counts in self._spells.iteritems():
+            # Ties go to the lowest ID so the choice does not depend on load order
+            self._best[signature] = min(counts, key = lambda spell_id: (-counts[spell_id], spell_id))
+
+            shape, numbers = signature
+            words = frozenset(WORD_RE.findall(shape))
+            self._words[signature] = words
+            for word in words:
+                self._postings.setdefault((numbers, word), []).append(signature)
+
+        self._resolved = {}
+
+    def _near_match(self, signature):
+        shape, numbers = signature
+        words = frozenset(WORD_RE.findall(shape))
+        if not words:
+            return None
+
+        overlaps = Counter()
+        for word in words:
+            for candidate in self._postings.get((numbers, word), ()):
+                overlaps[candidate] += 1
+
+        best = None
+        for candidate, overlap in overlaps.iteritems():
+            similarity = float(overlap) / len(words | self._words[candidate])
+            if similarity < self.min_similarity:
+                continue
+
+            # Most similar first, ties broken by signature for stable output
+            key = (-similarity, candidate)
+            if best is None or key < best:
+                best = key
+
+        return best[1] if best is not None else None
+
+    def resolve(self, tooltip):
+        """
+        Spell ID for the tooltip, -1 if nothing close enough is indexed
+        """
+        if self._best is None:
+            self.build()
+
+        if not tooltip:
+            self.unresolved += 1
+            return -1
+
+        if tooltip in self._resolved:
+            spell_id, kind = self._resolved[tooltip]
+        else:
+            signature = tooltip_signature(tooltip)
+            if signature in self._best:
+                spell_id, kind = self._best[signature], "exact"
+            else:
+                candidate = self._near_match(signature)
+                if candidate is not None:
+                    spell_id, kind = self._best[candidate], "near"
+                else:
+                    spell_id, kind = -1, "unresolved"
+
+            self._resolved[tooltip] = (spell_id, kind)
+
+        if kind == "exact":
+            self.exact += 1
+        elif kind == "near":
+            self.near += 1
+        else:
+            self.unresolved += 1
+        return spell_id
+
+    def resolution_rate(self):
+        lookups = self.exact + self.near + self.unresolved
+        return float(self.exact + self.near) / lookups if lookups else 0.0
@@ -0,0 +1,266 @@
+"""
+sqlitestore.py
+
+SQLite output backend for the parsed items. Versions are normalized into
+items, versions, effects and resistances tables so build_patch_difference.py
+can pull only the rows it needs for a patch instead of loading parsed.json
+"""
+
+import os
+import sqlite3
+import time
+
+from items import *
+
+# Scalar ItemVersion fields, in versions table column order
+VERSION_FIELDS = ["name", "quality", "slot", "itemType", "armor", "bonding", "mindamage",
+    "maxdamage", "speed", "requiredlevel", "stamina", "strength", "spirit", "intellect",
+    "agility", "flavour", "quest", "trade_good"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    item_id INTEGER PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS versions (
+    version_id INTEGER PRIMARY KEY,
+    item_id INTEGER NOT NULL,
+    patch INTEGER NOT NULL,
+    source TEXT,
+    snapshot TEXT,
+    loaded_at INTEGER,
+    %s
+);
+CREATE TABLE IF NOT EXISTS effects (
+    version_id INTEGER NOT NULL,
+    idx INTEGER,
+    spellId INTEGER,
+    tooltip TEXT
+);
+CREATE TABLE IF NOT EXISTS resistances (
+    version_id INTEGER NOT NULL,
+    school TEXT,
+    value INTEGER
+);
+""" % (",\n    ".join(VERSION_FIELDS),)
+
+# Created after the bulk load, inserting into indexed tables is a lot slower
+INDEXES = """
+CREATE INDEX IF NOT EXISTS versions_item_patch ON versions (item_id, patch);
+CREATE INDEX IF NOT EXISTS versions_patch ON versions (patch);
+CREATE INDEX IF NOT EXISTS effects_version ON effects (version_id);
+CREATE INDEX IF NOT EXISTS effects_spell ON effects (spellId);
+CREATE INDEX IF NOT EXISTS resistances_version ON resistances (version_id);
+"""
+
+DROP_INDEXES = """
+DROP INDEX IF EXISTS versions_item_patch;
+DROP INDEX IF EXISTS versions_patch;
+DROP INDEX IF EXISTS effects_version;
+DROP INDEX IF EXISTS effects_spell;
+DROP INDEX IF EXISTS resistances_version;
+"""
+
+def _text(value):
+    # item_db.csv names are byte strings, sqlite wants unicode
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+
+    return value
+
+class SqliteItemDatabase(object):
+    def __init__(self, filename, batch_size = 10000):
+        self.filename = filename
+        self.batch_size = batch_size
+
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename)
+            self._conn.executescript(SCHEMA)
+
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def write_store(self, item_store):
+        """
+        Replace the database contents with the given store. Rows are inserted in
+        batches inside a single transaction, and indexes are built afterwards
+        """
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+        conn = self.conn
+        # Nothing to recover if a fresh bulk load dies half way, just rerun it
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.executescript(DROP_INDEXES)
+
+        with conn:
+            self.append_store(item_store)
+
+        self.create_indexes()
+        self.close()
+
+    def create_indexes(self):
+        self.conn.executescript(INDEXES)
+
+    def append(self, item_store):
+        """
+        Add the versions in the store to the existing contents in one transaction,
+        for writers producing versions as they go
+        """
+        with self.conn:
+            self.append_store(item_store)
+
+    def append_store(self, item_store):
+        """
+        Insert all versions in the store without committing, callers own the
+        transaction
+        """
+        conn = self.conn
+        loaded_at = int(time.time())
+
+        row = conn.execute("SELECT MAX(version_id) FROM versions").fetchone()
+        version_id = row[0] or 0
+
+        items = []
+        versions = []
+        effects = []
+        resistances = []
+
+        def flush():
+            conn.executemany("INSERT OR IGNORE INTO items VALUES (?, ?)", items)
+            conn.executemany("INSERT INTO versions VALUES (%s)" % (
+                ", ".join(["?"] * (6 + len(VERSION_FIELDS))),), versions)
+            conn.executemany("INSERT INTO effects VALUES (?, ?, ?, ?)", effects)
+            conn.executemany("INSERT INTO resistances VALUES (?, ?, ?)", resistances)
+
+            del items[:]
+            del versions[:]
+            del effects[:]
+            del resistances[:]
+
+        for item_id in item_store:
+            items.append((item_id, _text(ID_TO_NAME_HASH.get(item_id))))
+
+            for patch in item_store[item_id]:
+                for itemv in item_store[item_id][patch]:
+                    version_id += 1
+
+                    source, snapshot = None, None
+                    if itemv.source is not None:
+                        snapshot, source = itemv.source
+
+                    versions.append((version_id, item_id, patch, source, snapshot, loaded_at) +
+                        tuple(_text(itemv.get(field)) for field in VERSION_FIELDS))
+
+                    for effect in itemv["effects"]:
+                        effects.append((version_id, effect["index"], effect["spellId"], _text(effect["tooltip"])))
+
+                    for school in itemv["resistances"]:
+                        if itemv["resistances"][school] != 0:
+                            resistances.append((version_id, school, itemv["resistances"][school]))
+
+            if len(versions) >= self.batch_size:
+                flush()
+
+        flush()
+
+    def _load_selected(self, where, params):
+        """
+        Build an ItemStore from the versions matching the where clause. The matching
+        version IDs go into a temp table so effects and resistances are fetched
+        through their version_id indexes
+        """
+        conn = self.conn
+        store = ItemStore()
+
+        conn.execute("DROP TABLE IF EXISTS temp.selected")
+        conn.execute("CREATE TEMP TABLE selected (version_id INTEGER PRIMARY KEY)")
+        conn.execute("INSERT INTO selected SELECT version_id FROM versions WHERE %s" % (where,), params)
+
+        versions = {}
+        columns = ", ".join(["v.%s" % (field,) for field in VERSION_FIELDS])
+        for row in conn.execute("SELECT v.version_id, v.item_id, v.patch, v.snapshot, v.source, %s "
+                "FROM versions v JOIN selected s ON v.version_id = s.version_id" % (columns,)):
+            itemv = ItemVersion.new()
+            for field, value in zip(VERSION_FIELDS, row[5:]):
+                if isinstance(value, basestring):
+                    value = STRING_POOL.intern(value)
+                itemv[field] = value
+
+            # Booleans come back from sqlite as ints
+            itemv["quest"] = bool(itemv["quest"])
+            itemv["trade_good"] = bool(itemv["trade_good"])
+
+            if row[3] is not None:
+                itemv.source = (row[3], row[4])
+
+            versions[row[0]] = (row[1], row[2], itemv)
+
+        for version_id, idx, spell_id, tooltip in conn.execute("SELECT e.version_id, e.idx, "
+                "e.spellId, e.tooltip FROM effects e JOIN selected s ON e.version_id = s.version_id "
+                "ORDER BY e.rowid"):
+            versions[version_id][2]["effects"].append(ItemSpell(idx, spell_id, STRING_POOL.intern(tooltip)))
+
+        for version_id, school, value in conn.execute("SELECT r.version_id, r.school, r.value "
+                "FROM resistances r JOIN selected s ON r.version_id = s.version_id"):
+            versions[version_id][2]["resistances"][school] = value
+
+        for item_id, patch, itemv in versions.itervalues():
+            store.add_item(item_id, patch, itemv)
+
+        conn.execute("DROP TABLE temp.selected")
+
+        return store
+
+    def load_store(self):
+        return self._load_selected("1", ())
+
+    def load_items(self, item_ids):
+        item_ids = list(item_ids)
+        store = ItemStore()
+
+        # Stay under the sqlite bound parameter limit
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start:start + 500]
+            self._load_selected("item_id IN (%s)" % (", ".join(["?"] * len(chunk)),),
+                chunk).merge_into(store)
+
+        return store
+
+    def known_effects(self):
+        """
+        (tooltip, spellId) of every stored effect with a known spell ID
+        """
+        return self.conn.execute("SELECT tooltip, spellId FROM effects WHERE spellId >= 0")
+
+    def load_patch_inputs(self, patch_level, id_range = None):
+        """
+        The store ItemPatchData.build_patch_data needs for patch_level: for each
+        item, only the versions of its latest patch at or before patch_level.
+        Items first seen after patch_level get an empty entry at that later
+        patch so they are treated the same as with the full store. id_range is
+        an optional (low, high) item ID range, high exclusive
+        """
+        low, high = id_range or (0, 2 ** 62)
+
+        store = self._load_selected("version_id IN (SELECT v.version_id FROM versions v JOIN "
+            "(SELECT item_id, MAX(patch) AS patch FROM versions WHERE patch <= ? "
+            "AND item_id >= ? AND item_id < ? GROUP BY item_id) latest "
+            "ON v.item_id = latest.item_id AND v.patch = latest.patch)", (patch_level, low, high))
+
+        for item_id, first_patch in self.conn.execute("SELECT item_id, MIN(patch) FROM versions "
+                "WHERE item_id >= ? AND item_id < ? GROUP BY item_id HAVING MIN(patch) > ?",
+                (low, high, patch_level)):
+            store[item_id] = { first_patch: [] }
+
+        return store
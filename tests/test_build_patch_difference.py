@@ -0,0 +1,84 @@
+"""
+Patch views and lazily built diffs against the store copies and the
+calculate_diff they replaced
+"""
+
+import json
+import random
+import unittest
+
+from benchmark import PATCH_LEVELS, legacy_calculate_diff, legacy_content_key, legacy_patch_data, synthetic_store
+from build_patch_difference import ItemPatchData, build_patch_views
+from items import *
+
+class TestPatchViews(unittest.TestCase):
+    def test_selections_match_store_copies(self):
+        store = synthetic_store(2000)
+
+        views = build_patch_views(store, PATCH_LEVELS)
+        for patch_level in PATCH_LEVELS:
+            item_store, filtered = legacy_patch_data(store, patch_level)
+            self.assertEqual(dict(views[patch_level].filtered_item_store.patches),
+                dict((item_id, filtered[item_id].keys()[0]) for item_id in filtered))
+
+class TestConflicts(unittest.TestCase):
+    def setUp(self):
+        store = synthetic_store(2000)
+        rnd = random.Random(1)
+
+        # Snapshots disagreeing with each other
+        for item_id in store:
+            for patch in store[item_id]:
+                variants = []
+                for itemv in store[item_id][patch]:
+                    roll = rnd.random()
+                    if roll < 0.15:
+                        itemv = ItemVersion(itemv)
+                        itemv["stamina"] += 1
+                    elif roll < 0.25:
+                        itemv = ItemVersion(itemv)
+                        itemv["resistances"] = dict(itemv["resistances"], fire = rnd.randint(1, 10))
+                    elif roll < 0.3:
+                        itemv = ItemVersion(itemv)
+                        itemv["flavour"] = "\"Snapshot %d\"" % (rnd.randint(0, 100),)
+                    variants.append(itemv)
+                store[item_id][patch] = variants
+
+        self.patch_data = []
+        for patch_level in (106, 107):
+            data = ItemPatchData(patch_level)
+            data.build_patch_data(store)
+            data.filter()
+            self.patch_data.append(data)
+
+    def test_diff_views_match_calculate_diff(self):
+        to_data, from_data = self.patch_data
+        pairs = []
+        for data in self.patch_data:
+            for item_id in data.filtered_item_store:
+                versions = data.filtered_item_store[item_id].values()[0]
+                pairs += [(versions[0], other) for other in versions[1:]]
+        for item_id in to_data.filtered_item_store:
+            if item_id in from_data.filtered_item_store:
+                pairs.append((from_data.filtered_item_store[item_id].values()[0][0],
+                    to_data.filtered_item_store[item_id].values()[0][0]))
+
+        self.assertTrue(any(not other.matches(me) for me, other in pairs))
+        for me, other in pairs:
+            self.assertEqual(other.matches(me), legacy_content_key(me) == legacy_content_key(other))
+            if not other.matches(me):
+                self.assertEqual(me.diff_view(other).materialize(), legacy_calculate_diff(me, other))
+
+    def test_concensus_counts_identical_snapshots(self):
+        data = self.patch_data[0]
+        for item_id in data.filtered_item_store:
+            versions = data.filtered_item_store[item_id].values()[0]
+            counts = {}
+            for version in versions:
+                counts[version.fingerprint()] = counts.get(version.fingerprint(), 0) + 1
+
+            concensus = data.build_item_concensus(versions)
+            self.assertEqual(counts[concensus.fingerprint()], max(counts.values()))
+
+if __name__ == "__main__":
+    unittest.main()
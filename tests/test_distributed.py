@@ -0,0 +1,62 @@
+"""
+A coordinator with a lost lease and a worker process against the single
+process parse
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from benchmark import quietly, synthetic_dump
+from distributed import ParseCoordinator, iter_work_units, serve
+from parser import iter_work_items, parse_work_items
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def version_keys(store):
+    return sorted((item_id, patch, itemv.fingerprint()) for item_id in store
+        for patch in store[item_id] for itemv in store[item_id][patch])
+
+class TestParseCoordinator(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.dump_dir = os.path.join(self.workdir, "waybackdump")
+        synthetic_dump(self.dump_dir, snapshots = 3, depth = 2, files_per_dir = 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_lost_lease_is_reissued(self):
+        expected = version_keys(quietly(lambda: parse_work_items(iter_work_items(self.dump_dir))))
+
+        coordinator = ParseCoordinator(list(iter_work_units(self.dump_dir)), lease_timeout = 1.0)
+        # A worker that leased a unit and was never heard from again
+        self.assertIn("unit", coordinator.lease(0))
+
+        socket_path = os.path.join(self.workdir, "coordinator.sock")
+        server = threading.Thread(target = serve, args = (coordinator, socket_path, 3600.0))
+        server.daemon = True
+        server.start()
+
+        with open(os.devnull, "wb") as devnull:
+            worker = subprocess.Popen([sys.executable, os.path.join(PACKAGE_DIR, "distributed.py"), "worker",
+                "--connect", socket_path, "--dump-dir", self.dump_dir, "--keep-all"],
+                stdout = devnull, stderr = devnull)
+            try:
+                server.join(60.0)
+            finally:
+                if worker.poll() is None:
+                    worker.kill()
+                worker.wait()
+
+        self.assertTrue(coordinator.finished.is_set())
+        self.assertEqual(coordinator.failed, {})
+        self.assertEqual(coordinator.reissued, 1)
+        self.assertEqual(version_keys(coordinator.store), expected)
+
+if __name__ == "__main__":
+    unittest.main()
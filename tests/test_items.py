@@ -0,0 +1,119 @@
+"""
+Stores and parsed.json against the plain in-memory ItemStore: sharded
+stores, indexed loads, fingerprint trees and the serializers
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import build_patch_difference
+
+from benchmark import quietly, synthetic_store
+from compare_parsed import compare_fingerprint_trees
+from items import *
+from serializers import SERIALIZERS
+from shardstore import ShardedItemStore
+
+def store_roots(store):
+    return dict((item_id, item_fingerprints(store[item_id])[0]) for item_id in store)
+
+class ItemsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.store = synthetic_store(2000)
+        self.json_file = os.path.join(self.workdir, "parsed.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+class TestShardedItemStore(ItemsTestCase):
+    def diff_keys(self, store):
+        keys = []
+        load_input = lambda patch_level, low, high: store
+        for to_data, from_data, diff in quietly(lambda: list(build_patch_difference.iter_shard_diffs(
+                106, 107, load_input, 200))):
+            keys += [(item_id, diff[item_id]["removed"]) for item_id in diff]
+        return sorted(keys)
+
+    def test_matches_plain_store(self):
+        # Versions arrive in random item order, as they do when parsing snapshot by snapshot
+        versions = [(item_id, patch, itemv) for item_id in self.store for patch in self.store[item_id]
+            for itemv in self.store[item_id][patch]]
+        random.Random(1).shuffle(versions)
+
+        with ShardedItemStore(os.path.join(self.workdir, "shards"), 200, 2, max_pending = 400) as store:
+            for item_id, patch, itemv in versions:
+                store.add_item(item_id, patch, itemv)
+
+            self.assertEqual(sorted(store), sorted(self.store))
+            self.assertEqual(store_roots(store), store_roots(self.store))
+            self.assertTrue(store.loads > 0)
+            self.assertEqual(self.diff_keys(store), self.diff_keys(self.store))
+
+            dump_parsed_json(store, self.json_file)
+        self.assertEqual(store_roots(load_parsed_json(self.json_file)), store_roots(self.store))
+
+    def test_items_are_read_only(self):
+        item_id = sorted(self.store)[0]
+        with ShardedItemStore(os.path.join(self.workdir, "shards"), 200, 1) as store:
+            store[item_id] = self.store[item_id]
+            patches = store[item_id]
+
+            self.assertRaises(TypeError, patches.__setitem__, 0, [])
+            self.assertIsInstance(patches.values()[0], tuple)
+
+class TestParsedJson(ItemsTestCase):
+    def test_indexed_load_matches_full_load(self):
+        dump_parsed_json(self.store, self.json_file)
+        item_ids = sorted(self.store)
+        one = set([item_ids[7]])
+        low = item_ids[len(item_ids) // 2]
+
+        full = load_parsed_json(self.json_file)
+        single = load_parsed_items(self.json_file, item_ids = one)
+        ranged = load_parsed_items(self.json_file, id_range = (low, low + 500))
+
+        self.assertEqual(set(single), one)
+        self.assertEqual(set(ranged), set(item_id for item_id in full if low <= item_id < low + 500))
+        for item_id in ranged:
+            self.assertEqual(item_fingerprints(ranged[item_id]), item_fingerprints(full[item_id]))
+
+    def test_fingerprint_tree_finds_changes(self):
+        dump_parsed_json(self.store, os.path.join(self.workdir, "parsed_old.json"))
+
+        # A parser change touching a few items
+        rnd = random.Random(1)
+        expected = {}
+        for item_id in rnd.sample(sorted(self.store), 10):
+            patch = rnd.choice(sorted(self.store[item_id]))
+            itemv = ItemVersion(self.store[item_id][patch][0])
+            itemv["flavour"] = "\"Changed\""
+            self.store[item_id][patch] = [itemv]
+            expected[item_id] = [patch]
+        removed = rnd.choice([item_id for item_id in sorted(self.store) if item_id not in expected])
+        del self.store[removed]
+        expected[removed] = "removed"
+        dump_parsed_json(self.store, self.json_file)
+
+        old = FingerprintTree(parsed_fingerprint_filename(os.path.join(self.workdir, "parsed_old.json")))
+        new = FingerprintTree(parsed_fingerprint_filename(self.json_file))
+        self.assertEqual(compare_fingerprint_trees(old, new), expected)
+        self.assertTrue(new.buckets_read < len(new.buckets))
+
+class TestSerializers(ItemsTestCase):
+    def test_round_trip(self):
+        expected = store_roots(self.store)
+
+        for name, serializer in SERIALIZERS.iteritems():
+            if not serializer.available():
+                continue
+
+            filename = os.path.join(self.workdir, "parsed.%s" % (name,))
+            serializer.dump(self.store, filename)
+            self.assertEqual(store_roots(serializer.load(filename)), expected, name)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+The parse paths against each other on generated dumps: the streaming walk,
+worker pools, compressed pages, the memory governor and the fragment
+cache all have to produce the same store
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmark import fragment_dump, legacy_iter_work_items, legacy_parse_directory, listing_dump, quietly, \
+    synthetic_dump
+from catalog import SnapshotCatalog
+from fragmentcache import FragmentCache
+from governor import MemoryGovernor, tree_memory
+from items import *
+from parser import iter_directory_files, iter_work_items, parse_work_items
+from shardstore import ShardedItemStore
+
+def store_roots(store):
+    return dict((item_id, item_fingerprints(store[item_id])[0]) for item_id in store)
+
+class ParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.dump_dir = os.path.join(self.workdir, "waybackdump")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def parse(self, work_items = None, **kwargs):
+        if work_items is None:
+            work_items = iter_work_items(self.dump_dir)
+        return quietly(lambda: parse_work_items(work_items, **kwargs))
+
+class TestParseWorkItems(ParserTestCase):
+    def setUp(self):
+        super(TestParseWorkItems, self).setUp()
+        synthetic_dump(self.dump_dir, snapshots = 3, depth = 2, files_per_dir = 5)
+
+    def test_matches_legacy_walk(self):
+        legacy = ItemStore()
+        for item_dir, patchLevel, parser in legacy_iter_work_items(self.dump_dir):
+            quietly(lambda: legacy_parse_directory(item_dir, patchLevel, parser)).merge_into(legacy)
+
+        self.assertEqual(store_roots(self.parse()), store_roots(legacy))
+
+    def test_pool_matches_single_process(self):
+        self.assertEqual(store_roots(self.parse(processes = 2)), store_roots(self.parse()))
+
+    def test_compressed_pages(self):
+        import download
+
+        compressions = ["gzip"]
+        if download.zstandard is not None:
+            compressions.append("zstd")
+
+        expected = store_roots(self.parse())
+        for compression in compressions:
+            target = os.path.join(self.workdir, compression)
+            for path in iter_directory_files(self.dump_dir):
+                dest = os.path.join(target, os.path.relpath(path, self.dump_dir))
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+
+                with open(path, "rb") as src:
+                    with download.open_compressed(dest, compression) as f:
+                        f.write(src.read())
+
+            self.assertEqual(store_roots(self.parse(iter_work_items(target))), expected)
+
+    def test_cost_balanced_chunks_cover_every_file(self):
+        catalog = SnapshotCatalog()
+        catalog.refresh(self.dump_dir)
+        work_items = list(iter_work_items(self.dump_dir))
+
+        for processes in (1, 4):
+            chunks = catalog.cost_balanced_chunks(work_items, processes)
+            self.assertEqual(sorted(work_item[0] for chunk in chunks for work_item in chunk),
+                sorted(work_item[0] for work_item in work_items))
+
+class TestGovernedParse(ParserTestCase):
+    def setUp(self):
+        super(TestGovernedParse, self).setUp()
+        listing_dump(self.dump_dir, 4, 100)
+
+    def test_matches_natural_parse(self):
+        expected = store_roots(self.parse())
+
+        for processes in (1, 2):
+            # Far below what the parse needs, so every action is taken
+            governor = MemoryGovernor(tree_memory() + 1048576, interval = 0.01, batch_size = 2)
+            with ShardedItemStore(os.path.join(self.workdir, "shards-%d" % (processes,)), 500,
+                    max_resident = 100) as store:
+                self.parse(store = store, processes = processes, governor = governor)
+                self.assertEqual(store_roots(store), expected)
+
+    def test_worker_error_raises(self):
+        work_items = list(iter_work_items(self.dump_dir))
+        work_items.insert(len(work_items) // 2, (os.path.join(self.dump_dir, "missing.html"),) + work_items[0][1:])
+        governor = MemoryGovernor(float("inf"), interval = 0.1, batch_size = 2)
+
+        self.assertRaises(IOError, self.parse, work_items, store = ItemStore(), processes = 2,
+            governor = governor)
+
+class TestFragmentCache(ParserTestCase):
+    def setUp(self):
+        super(TestFragmentCache, self).setUp()
+        fragment_dump(self.dump_dir, 3, 30)
+
+    def test_cached_parse_matches(self):
+        expected = store_roots(self.parse(item_filter = ItemDatabaseFilter()))
+
+        cache_file = os.path.join(self.workdir, "fragments.sqlite")
+        runs = [("cold cache", cache_file, 1), ("warm cache", cache_file, 1),
+            ("2 processes, cold cache", os.path.join(self.workdir, "shared.sqlite"), 2)]
+        for name, filename, processes in runs:
+            cache = FragmentCache(filename)
+            try:
+                store = self.parse(processes = processes, item_filter = ItemDatabaseFilter(),
+                    fragment_cache = cache)
+            finally:
+                cache.close()
+            self.assertEqual(store_roots(store), expected, name)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+The item service against the one-off build_patch_difference.py run
+"""
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from benchmark import synthetic_store
+from items import *
+from service import UnixHTTPConnection
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TestItemService(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.workdir, "items.sock")
+        self.devnull = open(os.devnull, "wb")
+        self.service = None
+
+        store = synthetic_store(2000)
+        self.item_ids = random.Random(1).sample(sorted(item_id for item_id in store
+            if item_id in ID_TO_NAME_HASH), 20)
+        dump_parsed_json(store, os.path.join(self.workdir, "parsed.json"))
+
+    def tearDown(self):
+        if self.service is not None and self.service.poll() is None:
+            self.service.terminate()
+            deadline = time.time() + 10.0
+            while self.service.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if self.service.poll() is None:
+                self.service.kill()
+            self.service.wait()
+        self.devnull.close()
+        shutil.rmtree(self.workdir)
+
+    def request(self, path):
+        conn = UnixHTTPConnection(self.socket_path)
+        conn.request("GET", path)
+        body = conn.getresponse().read()
+        conn.close()
+        return body
+
+    def test_diff_matches_cli(self):
+        items = ",".join(str(item_id) for item_id in self.item_ids)
+        cli_output = subprocess.check_output([sys.executable, os.path.join(PACKAGE_DIR,
+            "build_patch_difference.py"), "--items", items], cwd = self.workdir)
+
+        self.service = subprocess.Popen([sys.executable, os.path.join(PACKAGE_DIR, "service.py"),
+            "--socket", self.socket_path, "--dump-dir", os.path.join(self.workdir, "waybackdump")],
+            cwd = self.workdir, stdout = self.devnull, stderr = self.devnull)
+        while not os.path.exists(self.socket_path):
+            self.assertIsNone(self.service.poll())
+            time.sleep(0.05)
+
+        diff_path = "/diff?items=%s&format=sql" % (items,)
+        first_sql = self.request(diff_path)
+        self.assertEqual(self.request(diff_path), first_sql)
+        self.assertTrue(cli_output.endswith(first_sql))
+
+        history = json.loads(self.request("/item/%d" % (self.item_ids[0],)))
+        self.assertEqual(history["item_id"], self.item_ids[0])
+
+if __name__ == "__main__":
+    unittest.main()